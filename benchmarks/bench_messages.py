@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+
+# Python Imports
+import sys
+import time
+import math
+import optparse
+import StringIO
+
+# Project Imports
+import benchutil
+import messages
+import spatial
+
+
+__doc__ = """
+Micro benchmarks for the messages codec: the scalar helpers, RobotInfo and
+FieldInfo encoding and decoding over a range of frame sizes, the memory
+use and iteration speed of FieldHistory against a list of FieldInfos, and
+the tracker's per frame update (with numpy).
+"""
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def measure(func, min_time):
+    """
+    Calls func repeatedly for at least min_time seconds, returns the number
+    of calls and the seconds per call
+    """
+    calls = 0
+    batch = 1
+    start = time.time()
+    elapsed = 0
+    while elapsed < min_time:
+        for i in xrange(0, batch):
+            func()
+        calls += batch
+        batch *= 2
+        elapsed = time.time() - start
+    return calls, elapsed / calls
+
+def run_case(results, name, func, min_time, **extra):
+    calls, per_call = measure(func, min_time)
+    result = {'name' : name, 'calls' : calls, 'usec_per_call' : per_call * 1e6,
+              'calls_per_sec' : 1.0 / per_call}
+    result.update(extra)
+    results.append(result)
+
+def bench_helpers(results, min_time):
+    run_case(results, 'compress_float', lambda: messages.compress_float(117.8),
+             min_time)
+    run_case(results, 'pack_angle', lambda: messages.pack_angle(math.pi * 0.7),
+             min_time)
+
+    data = messages.pack_angle(-math.pi * 0.3)
+    run_case(results, 'unpack_angle', lambda: messages.unpack_angle(data),
+             min_time)
+
+    robot = messages.RobotInfo(3, math.pi * 0.3, messages.Vector2D(3.5, 6))
+    run_case(results, 'RobotInfo.pack', robot.pack, min_time)
+
+    data = robot.pack()
+    run_case(results, 'RobotInfo.unpack',
+             lambda: messages.RobotInfo.unpack(data), min_time)
+
+def bench_field_info(results, min_time, sizes):
+    shift = (121.92, 60.96, 0.1)
+    for num_robots, num_balls in sizes:
+        frame = benchutil.make_detection_frame(num_robots, num_balls)
+        field_info = messages.FieldInfo(frame, *shift)
+        data = field_info.pack()
+        extra = {'robots' : num_robots, 'balls' : num_balls,
+                 'bytes' : len(data)}
+
+        run_case(results, 'FieldInfo.__init__',
+                 lambda: messages.FieldInfo(frame, *shift), min_time, **extra)
+        run_case(results, 'FieldInfo.send_data',
+                 lambda: field_info.send_data(StringIO.StringIO()), min_time,
+                 **extra)
+        run_case(results, 'FieldInfo.unpack',
+                 lambda: messages.FieldInfo.unpack(data), min_time, **extra)
+
+        if messages.numpy is not None:
+            run_case(results, 'ArrayFieldInfo.pack',
+                     lambda: messages.ArrayFieldInfo(frame, *shift).pack(),
+                     min_time, **extra)
+            run_case(results, 'ArrayFieldInfo.unpack',
+                     lambda: messages.ArrayFieldInfo.unpack(data), min_time,
+                     **extra)
+
+def object_size(field_info):
+    """
+    Rough bytes used by a FieldInfo and everything it holds
+    """
+    objs = [field_info, field_info.header, field_info.robots,
+            field_info.balls]
+    for robot in field_info.robots:
+        objs.extend((robot, robot.id, robot.heading, robot.pos, robot.pos.x,
+                     robot.pos.y))
+    for ball in field_info.balls:
+        objs.extend((ball, ball.x, ball.y))
+
+    size = sum([sys.getsizeof(obj) for obj in objs])
+    for obj in objs:
+        if hasattr(obj, '__dict__'):
+            size += sys.getsizeof(obj.__dict__)
+    return size
+
+def bench_history(results, min_time, num_frames = 1000, robots = 12,
+                  balls = 2):
+    shift = (121.92, 60.96, 0.1)
+    field_infos = []
+    history = messages.FieldHistory()
+    for i in xrange(0, num_frames):
+        frame = benchutil.make_detection_frame(robots, balls, seed = i)
+        field_info = messages.FieldInfo(frame, *shift)
+        field_infos.append(field_info)
+        history.append(field_info)
+
+    extra = {'robots' : robots, 'balls' : balls, 'frames' : num_frames}
+    objects_bytes = sum([object_size(field_info)
+                         for field_info in field_infos])
+    results.append(dict(name = 'memory per frame',
+                        FieldInfo_bytes = objects_bytes / num_frames,
+                        FieldHistory_bytes = history.nbytes() / num_frames,
+                        **extra))
+
+    def sum_objects():
+        total = 0.0
+        for field_info in field_infos:
+            for robot in field_info.robots:
+                total += robot.id + robot.heading + robot.pos.x + robot.pos.y
+        return total
+
+    def sum_history():
+        total = 0.0
+        for index, ID, heading, x, y in history.iter_robots():
+            total += ID + heading + x + y
+        return total
+
+    run_case(results, 'iterate robots, FieldInfo list', sum_objects,
+             min_time, **extra)
+    run_case(results, 'iterate robots, FieldHistory', sum_history, min_time,
+             **extra)
+    def walk_history():
+        for field_info in history:
+            pass
+
+    run_case(results, 'rebuild FieldInfos, FieldHistory', walk_history,
+             min_time, **extra)
+    run_case(results, 'sum robot x, FieldHistory', lambda:
+             sum(history.robot_x), min_time, **extra)
+
+def bench_tracker(results, min_time, sizes):
+    import tracker
+
+    for num_robots, num_balls in sizes:
+        frame = benchutil.make_detection_frame(num_robots, num_balls)
+        frame_tracker = tracker.Tracker()
+        frame_tracker.update(frame)
+        extra = {'robots' : num_robots, 'balls' : num_balls}
+
+        def update():
+            frame.t_capture += 1 / 60.0
+            frame_tracker.update(frame)
+
+        run_case(results, 'Tracker.update', update, min_time, **extra)
+
+def bench_spatial(results, min_time, sizes):
+    for num_robots, num_balls in sizes:
+        frame = benchutil.make_detection_frame(num_robots, num_balls)
+        field_info = messages.FieldInfo(frame, 121.92, 60.96, 0.1)
+        index = spatial.FieldIndex(field_info)
+        robot_ids = [robot.id for robot in field_info.robots] or [0]
+        extra = {'robots' : num_robots, 'balls' : num_balls}
+
+        def build():
+            spatial.FieldIndex(field_info)
+
+        subscriptions = [spatial.Subscription(max_balls = 3,
+                                              robot_id = robot_id)
+                         for robot_id in robot_ids]
+        region = spatial.Subscription(region = (0, 0, 64, 127))
+
+        def tailor():
+            for subscription in subscriptions:
+                subscription.apply(index)
+
+        def scan():
+            # What tailor does without the index
+            for robot_id in robot_ids:
+                robot = index.robot(robot_id)
+                if robot is not None:
+                    sorted(field_info.balls, key = lambda ball:
+                           (ball.x - robot.pos.x) ** 2 +
+                           (ball.y - robot.pos.y) ** 2)[:3]
+
+        run_case(results, 'FieldIndex()', build, min_time, **extra)
+        run_case(results, 'Subscription.apply nearest x robots', tailor,
+                 min_time, **extra)
+        run_case(results, 'Subscription.apply region',
+                 lambda: region.apply(index), min_time, **extra)
+        run_case(results, 'sort balls x robots', scan, min_time, **extra)
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = optparse.OptionParser()
+    parser.set_defaults(min_time = 0.2, json = False)
+    parser.add_option("-t", "--min-time", dest="min_time", type="float",
+                      help="Seconds to run each case for")
+    parser.add_option("-j", "--json", dest="json", action="store_true",
+                      help="Print machine readable JSON results")
+    (options, args) = parser.parse_args(argv[1:])
+
+    results = []
+    bench_helpers(results, options.min_time)
+    bench_field_info(results, options.min_time, benchutil.FRAME_SIZES)
+    bench_history(results, options.min_time)
+    bench_spatial(results, options.min_time, benchutil.FRAME_SIZES)
+    if messages.numpy is not None:
+        bench_tracker(results, options.min_time, benchutil.FRAME_SIZES)
+    benchutil.report('messages', results, options.json)
+
+if __name__ == "__main__":
+    sys.exit(main())
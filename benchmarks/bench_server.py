@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+
+# Python Imports
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import optparse
+import threading
+import subprocess
+
+# Project Imports
+import benchutil
+import messages
+
+
+__doc__ = """
+End to end benchmark of the server.  Synthetic SSL_WrapperPackets are sent
+over loopback multicast to server.py running in --test mode, which writes to
+N files standing in for the bluetooth ports.  Every frame carries a sequence
+number in the ids of its first two robots, so the bytes read back from each
+file can be matched to their send time.
+"""
+
+SEQ_BASE = 250
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def set_sequence(frame, seq):
+    frame.robots_yellow[0].robot_id = seq // SEQ_BASE
+    frame.robots_yellow[1].robot_id = seq % SEQ_BASE
+
+def get_sequence(field_info):
+    return field_info.robots[0].id * SEQ_BASE + field_info.robots[1].id
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class OutputReader(threading.Thread):
+    """
+    Follows a consumer's output file, and records when each frame shows up
+    """
+
+    def __init__(self, path, send_times, poll = 0.0005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._path = path
+        self._send_times = send_times
+        self._poll = poll
+        self._stopped = threading.Event()
+        self.latencies = []
+        self.frames = 0
+        self.bytes = 0
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        data = ''
+        fd = os.open(self._path, os.O_RDONLY)
+        while True:
+            stopping = self._stopped.is_set()
+            chunk = os.read(fd, 65536)
+            now = time.time()
+            if chunk:
+                self.bytes += len(chunk)
+                data = self._parse(data + chunk, now)
+            elif stopping:
+                break
+            else:
+                time.sleep(self._poll)
+        os.close(fd)
+
+    def _parse(self, data, now):
+        """
+        Handles every complete frame in data, returns what is left over
+        """
+        sync_size = len(messages.SYNC_MARKER)
+        while True:
+            start = data.find(messages.SYNC_MARKER)
+            if start < 0:
+                return data
+            offset = start + sync_size
+            if len(data) < offset + messages.Header.PACKED_SIZE:
+                return data[start:]
+
+            header = messages.Header.unpack(data, offset)
+            size = messages.field_struct(header.num_robots,
+                                         header.num_balls).size
+            if len(data) < offset + size:
+                return data[start:]
+
+            field_info = messages.FieldInfo.unpack(data, offset)
+            seq = get_sequence(field_info)
+            if seq in self._send_times:
+                self.latencies.append(now - self._send_times[seq])
+            self.frames += 1
+            data = data[offset + size:]
+
+def run_benchmark(options):
+    workdir = tempfile.mkdtemp(prefix = 'bench_server')
+    prefix = os.path.join(workdir, 'rfcomm')
+    server_path = os.path.join(benchutil.SRC_DIR, 'server.py')
+
+    proc = subprocess.Popen([sys.executable, server_path, '--test',
+                             '--devprefix', prefix,
+                             '--host', options.group,
+                             '--port', str(options.port),
+                             '--engine', options.engine,
+                             '--encode-workers', str(options.encode_workers)],
+                            stdout = open(os.devnull, 'w'))
+    try:
+        # Give the server time to start watching, then "connect" the bricks
+        time.sleep(options.startup)
+        paths = []
+        for i in xrange(0, options.consumers):
+            path = '%s%d' % (prefix, i)
+            open(path, 'w').close()
+            paths.append(path)
+        time.sleep(options.startup)
+
+        send_times = {}
+        readers = [OutputReader(path, send_times) for path in paths]
+        for reader in readers:
+            reader.start()
+
+        # Send the packets
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+        packet = benchutil.make_wrapper_packet(max(2, options.robots),
+                                               options.balls)
+        interval = 0
+        if options.rate > 0:
+            interval = 1.0 / options.rate
+
+        start = time.time()
+        for seq in xrange(0, options.frames):
+            set_sequence(packet.detection, seq)
+            packet.detection.frame_number = seq
+            data = packet.SerializeToString()
+
+            send_times[seq] = time.time()
+            sock.sendto(data, (options.group, options.port))
+
+            if interval:
+                delay = start + (seq + 1) * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        send_time = time.time() - start
+
+        time.sleep(options.drain)
+        for reader in readers:
+            reader.stop()
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait()
+        shutil.rmtree(workdir, True)
+
+    # Results
+    results = []
+    for path, reader in zip(paths, readers):
+        results.append({
+            'consumer' : os.path.basename(path),
+            'engine' : options.engine,
+            'encode_workers' : options.encode_workers,
+            'frames_sent' : options.frames,
+            'frames_written' : reader.frames,
+            'send_fps' : options.frames / send_time,
+            'written_fps' : reader.frames / send_time,
+            'bytes_written' : reader.bytes,
+            'latency_p50_ms' : to_ms(benchutil.percentile(reader.latencies,
+                                                          50)),
+            'latency_p99_ms' : to_ms(benchutil.percentile(reader.latencies,
+                                                          99)),
+            })
+    return results
+
+def to_ms(seconds):
+    if seconds is None:
+        return None
+    return seconds * 1000
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = optparse.OptionParser()
+    parser.set_defaults(group = '224.5.23.2', port = 10102, consumers = 4,
+                        frames = 2000, rate = 300, robots = 12, balls = 10,
+                        engine = 'threads', encode_workers = 0,
+                        startup = 1.0, drain = 1.0,
+                        json = False)
+    parser.add_option("-g", "--group", dest="group", type="string",
+                      help="Multicast group to send to")
+    parser.add_option("-p", "--port", dest="port", type="int",
+                      help="Multicast port to send to")
+    parser.add_option("-c", "--consumers", dest="consumers", type="int",
+                      help="Number of file backed consumers")
+    parser.add_option("-n", "--frames", dest="frames", type="int",
+                      help="Number of frames to send")
+    parser.add_option("-r", "--rate", dest="rate", type="float",
+                      help="Frames per second to send (0 is flat out)")
+    parser.add_option("--robots", dest="robots", type="int",
+                      help="Robots per frame (at least 2)")
+    parser.add_option("--balls", dest="balls", type="int",
+                      help="Balls per frame")
+    parser.add_option("-e", "--engine", dest="engine", type="choice",
+                      choices = ['threads', 'reactor'],
+                      help="Server engine to run")
+    parser.add_option("-w", "--encode-workers", dest="encode_workers",
+                      type="int", help="Server encoder processes")
+    parser.add_option("--startup", dest="startup", type="float",
+                      help="Seconds to wait for the server to start")
+    parser.add_option("--drain", dest="drain", type="float",
+                      help="Seconds to wait for the output after sending")
+    parser.add_option("-j", "--json", dest="json", action="store_true",
+                      help="Print machine readable JSON results")
+    (options, args) = parser.parse_args(argv[1:])
+
+    results = run_benchmark(options)
+    benchutil.report('server', results, options.json)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# Python Imports
+import os
+import sys
+import json
+import math
+import random
+
+
+__doc__ = """
+Shared helpers for the benchmarks: puts src/ on the path, makes synthetic
+detection frames and reports results as text or JSON.
+"""
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'src')
+sys.path.insert(0, SRC_DIR)
+
+# Project Imports
+import proto.messages_robocup_ssl_detection_pb2 as ssl_detection
+import proto.messages_robocup_ssl_wrapper_pb2 as ssl_wrapper
+
+# (robots, balls) frame sizes to run, up to the 254 object header cap
+FRAME_SIZES = [(0, 1), (6, 1), (12, 10), (20, 60), (20, 234), (254, 254)]
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def fill_detection_frame(frame, num_robots, num_balls, seed = 0):
+    """
+    Fills the frame with robots and balls at random positions (in mm, inside
+    what the server's default shift and scale can pack)
+    """
+    rand = random.Random(seed)
+    frame.frame_number = 0
+    frame.t_capture = 0
+    frame.t_sent = 0
+    frame.camera_id = 0
+
+    for i in xrange(0, num_robots):
+        if i % 2:
+            robot = frame.robots_blue.add()
+        else:
+            robot = frame.robots_yellow.add()
+        robot.confidence = 1
+        robot.robot_id = i % 12
+        robot.x = rand.uniform(-1200, 50)
+        robot.y = rand.uniform(-600, 600)
+        robot.orientation = rand.uniform(-math.pi, math.pi)
+        robot.pixel_x = 0
+        robot.pixel_y = 0
+
+    for i in xrange(0, num_balls):
+        ball = frame.balls.add()
+        ball.confidence = 1
+        ball.x = rand.uniform(-1200, 50)
+        ball.y = rand.uniform(-600, 600)
+        ball.pixel_x = 0
+        ball.pixel_y = 0
+
+    return frame
+
+def make_detection_frame(num_robots, num_balls, seed = 0):
+    return fill_detection_frame(ssl_detection.SSL_DetectionFrame(),
+                                num_robots, num_balls, seed)
+
+def make_wrapper_packet(num_robots, num_balls, seed = 0):
+    packet = ssl_wrapper.SSL_WrapperPacket()
+    fill_detection_frame(packet.detection, num_robots, num_balls, seed)
+    return packet
+
+def percentile(values, pct):
+    """
+    Returns the pct (0-100) percentile of values, nearest rank
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def report(name, results, as_json):
+    """
+    Prints the list of result dicts, as a single JSON document or a table
+    """
+    if as_json:
+        print json.dumps({'benchmark' : name, 'results' : results},
+                         indent = 2, sort_keys = True)
+        return
+
+    print name
+    for result in results:
+        items = sorted(result.items())
+        print '  ' + '  '.join(['%s=%s' % (key, format_value(value))
+                                for key, value in items])
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.4g' % value
+    return str(value)
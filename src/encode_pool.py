@@ -0,0 +1,401 @@
+# Standard Imports
+import os
+import time
+import select
+import signal
+import threading
+import unittest
+import multiprocessing
+
+# Project Imports
+import messages
+import proto.messages_robocup_ssl_detection_pb2 as ssl_detection
+
+
+__doc__ = """
+Moves FieldInfo construction and packing out of the server process.  Raw
+SSL_DetectionFrame bytes are handed to a pool of worker processes, which
+pack the frame straight into a slot of a shared memory buffer.  The server
+process copies the finished payload out of the slot and hands it on, in the
+order the frames were submitted.
+
+Every worker has its own pair of pipes, so the server knows which frames
+each one holds.  When a worker dies its frames are written off and the rest
+carry on without it.
+"""
+
+# Room for the sync marker and a FieldInfo with 24 robots and 8 balls
+DEFAULT_SLOT_SIZE = 256
+
+# Sizes reported in place of a payload size
+OVERSIZED = -1
+FAILED = -2
+LOST = -3
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def encode_worker(jobs, results, buf, slot_size):
+    """
+    Worker process loop: receives (seq, slot, data, transform) jobs on the
+    jobs connection, packs the frame into its slot of buf and sends back
+    (seq, size) on results.  The size is OVERSIZED if the frame doesn't fit
+    in a slot, FAILED if it could not be packed at all.  Stops on None.
+    """
+    # Ctrl-C goes to the server, which shuts us down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    frame = ssl_detection.SSL_DetectionFrame()
+    marker_size = len(messages.SYNC_MARKER)
+
+    while True:
+        try:
+            job = jobs.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        seq, slot, data, transform = job
+
+        try:
+            frame.ParseFromString(data)
+            field_info = messages.FieldInfo(frame, *transform)
+            size = marker_size + field_info.packed_size()
+            if size > slot_size:
+                size = OVERSIZED
+            else:
+                offset = slot * slot_size
+                buf[offset:offset + marker_size] = messages.SYNC_MARKER
+                field_info.pack_into(buf, offset + marker_size)
+        except Exception:
+            # One bad frame must not take the worker down
+            size = FAILED
+        results.send((seq, size))
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class WorkerHandle(object):
+    """
+    The server's end of one worker process, its pipes and the seqs of the
+    frames it was given and hasn't sent back
+    """
+
+    def __init__(self, buf, slot_size):
+        jobs_reader, self.jobs = multiprocessing.Pipe(duplex = False)
+        self.results, results_writer = multiprocessing.Pipe(duplex = False)
+        self.process = multiprocessing.Process(
+            target = encode_worker,
+            args = (jobs_reader, results_writer, buf, slot_size))
+        self.process.daemon = True
+        self.process.start()
+
+        # Only the worker holds these now, so its death reads as EOF
+        jobs_reader.close()
+        results_writer.close()
+
+        self.assigned = set()
+
+class ProcessEncoder(object):
+    """
+    Encodes detection frames on a pool of worker processes.  Each frame in
+    flight holds one slot of the shared buffer, when every slot is taken new
+    frames are dropped (and counted) until the workers catch up.  Finished
+    payloads are given to deliver(payload, context) from a collector thread,
+    in submission order, along with the context they were submitted with.
+    Frames which fail to encode, or were held by a worker which died, are
+    counted and skipped.
+    """
+
+    def __init__(self, deliver, workers = None, slots = None,
+                 slot_size = DEFAULT_SLOT_SIZE):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if slots is None:
+            slots = workers * 2
+
+        self._deliver = deliver
+        self._slot_size = slot_size
+        self._buf = multiprocessing.RawArray('c', slots * slot_size)
+
+        self._lock = threading.Lock()
+        self._free_slots = range(0, slots)
+        self._in_flight = {}
+        self._next_seq = 0
+        self._closing = False
+
+        # Counters
+        self.submitted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.oversized = 0
+        self.failed = 0
+        self.lost = 0
+        self.dead_workers = 0
+
+        self._workers = [WorkerHandle(self._buf, slot_size)
+                         for i in xrange(0, workers)]
+        self._live = list(self._workers)
+
+        self._collector = threading.Thread(target = self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def submit(self, data, transform, context = None):
+        """
+        Queues the encoded SSL_DetectionFrame data for packing with the
+        given messages.FieldTransform, returns False if it had to be dropped
+        """
+        self._lock.acquire()
+        if not self._free_slots or not self._live:
+            self.dropped += 1
+            self._lock.release()
+            return False
+
+        slot = self._free_slots.pop()
+        seq = self._next_seq
+        self._next_seq += 1
+        self._in_flight[seq] = (slot, context)
+        worker = min(self._live, key = lambda worker: len(worker.assigned))
+        worker.assigned.add(seq)
+        self.submitted += 1
+        self._lock.release()
+
+        try:
+            worker.jobs.send((seq, slot, data, (transform.x_shift,
+                                                transform.y_shift,
+                                                transform.scale)))
+        except (IOError, OSError):
+            # The worker is gone, the collector writes the frame off when
+            # it sees the worker's results pipe close
+            pass
+        return True
+
+    def _finish(self, worker, seq, size):
+        """
+        Frees the frame's slot, returns its (payload, context), the payload
+        is None if there isn't one
+        """
+        self._lock.acquire()
+        slot, context = self._in_flight.pop(seq)
+        worker.assigned.discard(seq)
+        if size == OVERSIZED:
+            self.oversized += 1
+        elif size == FAILED:
+            self.failed += 1
+        elif size == LOST:
+            self.lost += 1
+
+        payload = None
+        if size >= 0:
+            offset = slot * self._slot_size
+            payload = self._buf[offset:offset + size]
+        self._free_slots.append(slot)
+        self._lock.release()
+        return payload, context
+
+    def _worker_gone(self, worker):
+        """
+        Stops giving the worker frames, returns the (seq, LOST) results of
+        the ones it still held
+        """
+        self._lock.acquire()
+        self._live.remove(worker)
+        seqs = sorted(worker.assigned)
+        if not self._closing:
+            self.dead_workers += 1
+        self._lock.release()
+
+        if not self._closing:
+            print "Encoder worker %d died, %d frames lost" % \
+                (worker.process.pid, len(seqs))
+        return [(seq, LOST) for seq in seqs]
+
+    def _collect(self):
+        # Results which came back before an earlier frame's
+        waiting = {}
+        next_seq = 0
+
+        while True:
+            self._lock.acquire()
+            live = list(self._live)
+            self._lock.release()
+            if not live:
+                break
+
+            readable, writable, errors = select.select(
+                [worker.results for worker in live], [], [])
+            for worker in live:
+                if worker.results not in readable:
+                    continue
+                try:
+                    results = [worker.results.recv()]
+                except EOFError:
+                    results = self._worker_gone(worker)
+
+                for seq, size in results:
+                    waiting[seq] = self._finish(worker, seq, size)
+
+            while next_seq in waiting:
+                payload, context = waiting.pop(next_seq)
+                next_seq += 1
+                if payload is not None:
+                    self.delivered += 1
+                    self._deliver(payload, context)
+
+    def close(self):
+        """
+        Stops the workers and the collector, frames still in flight are lost
+        """
+        self._closing = True
+        for worker in self._workers:
+            try:
+                worker.jobs.send(None)
+            except (IOError, OSError):
+                pass
+        for worker in self._workers:
+            worker.process.join()
+        self._collector.join()
+
+        for worker in self._workers:
+            worker.jobs.close()
+            worker.results.close()
+
+    def stats_line(self):
+        return "encoder: %d/%d workers %d submitted %d delivered %d dropped " \
+            "%d oversized %d failed %d lost" % \
+            (len(self._live), len(self._workers), self.submitted,
+             self.delivered, self.dropped, self.oversized, self.failed,
+             self.lost)
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestProcessEncoder(unittest.TestCase):
+    def setUp(self):
+        self.payloads = []
+        self.contexts = []
+        self.done = threading.Event()
+        self.expected = 0
+        self.transform = messages.FieldTransform(60.0, 30.0, 0.5)
+
+    def deliver(self, payload, context):
+        self.payloads.append(payload)
+        self.contexts.append(context)
+        if len(self.payloads) == self.expected:
+            self.done.set()
+
+    def make_frames(self, count):
+        frames = []
+        for i in xrange(0, count):
+            frame = messages.make_test_detectionframe()
+            frame.frame_number = i
+            frame.camera_id = 0
+            frame.t_capture = frame.t_sent = i
+            frame.balls[0].x = i
+            for obj in list(frame.balls) + list(frame.robots_yellow) + \
+                list(frame.robots_blue):
+                obj.confidence = 1
+                obj.pixel_x = obj.pixel_y = 0
+            frames.append(frame)
+        return frames
+
+    def test_order(self):
+        frames = self.make_frames(40)
+        self.expected = len(frames)
+        encoder = ProcessEncoder(self.deliver, workers = 3,
+                                 slots = len(frames))
+        for frame in frames:
+            self.assertTrue(encoder.submit(frame.SerializeToString(),
+                                           self.transform,
+                                           frame.frame_number))
+        self.done.wait(10)
+        encoder.close()
+
+        expected = [messages.SYNC_MARKER +
+                    messages.FieldInfo(frame,
+                                       transform = self.transform).pack()
+                    for frame in frames]
+        self.assertEquals(expected, self.payloads)
+        self.assertEquals(range(0, 40), self.contexts)
+        self.assertEquals(40, encoder.delivered)
+
+    def test_full(self):
+        frames = self.make_frames(3)
+        self.expected = 1
+        encoder = ProcessEncoder(self.deliver, workers = 1, slots = 1)
+        results = [encoder.submit(frame.SerializeToString(), self.transform)
+                   for frame in frames]
+        self.done.wait(10)
+        encoder.close()
+
+        self.assertEquals([True, False, False], results)
+        self.assertEquals(2, encoder.dropped)
+
+    def test_oversized(self):
+        frame = self.make_frames(1)[0]
+        self.expected = 1
+        encoder = ProcessEncoder(self.deliver, workers = 1, slot_size = 8)
+        encoder.submit(frame.SerializeToString(), self.transform)
+        encoder.submit(frame.SerializeToString(), self.transform)
+        self.done.wait(0.5)
+        encoder.close()
+
+        self.assertEquals([], self.payloads)
+        self.assertEquals(2, encoder.oversized)
+
+    def test_bad_frame(self):
+        frame = self.make_frames(1)[0]
+        self.expected = 1
+        encoder = ProcessEncoder(self.deliver, workers = 1, slots = 2)
+        encoder.submit('\xff\xff\xff', self.transform, 'bad')
+        encoder.submit(frame.SerializeToString(), self.transform, 'good')
+        self.done.wait(10)
+        encoder.close()
+
+        # The worker lives on and the frame after the bad one gets through
+        self.assertEquals(['good'], self.contexts)
+        self.assertEquals((1, 1), (encoder.failed, encoder.delivered))
+
+    def test_dead_worker(self):
+        frames = self.make_frames(8)
+        encoder = ProcessEncoder(self.deliver, workers = 2,
+                                 slots = len(frames))
+
+        # Frames handed to the stopped worker are stuck until it dies
+        dead = encoder._workers[0].process
+        os.kill(dead.pid, signal.SIGSTOP)
+        for frame in frames[:4]:
+            encoder.submit(frame.SerializeToString(), self.transform,
+                           frame.frame_number)
+        os.kill(dead.pid, signal.SIGKILL)
+        dead.join()
+
+        # Once the death is noticed every frame goes to the other worker
+        deadline = time.time() + 10
+        while encoder.dead_workers == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        for frame in frames[4:]:
+            self.assertTrue(encoder.submit(frame.SerializeToString(),
+                                           self.transform,
+                                           frame.frame_number))
+
+        deadline = time.time() + 10
+        while encoder.delivered + encoder.lost < len(frames) and \
+              time.time() < deadline:
+            time.sleep(0.01)
+        encoder.close()
+
+        self.assertEquals(1, encoder.dead_workers)
+        self.assertTrue(encoder.lost > 0)
+        self.assertEquals(len(frames), encoder.delivered + encoder.lost)
+        self.assertEquals(sorted(self.contexts), self.contexts)
+        self.assertEquals(range(4, 8), self.contexts[-4:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+# Standard Imports
+import os
+import json
+import socket
+import tempfile
+import threading
+import unittest
+
+
+__doc__ = """
+Per stage latency histograms for following frames from capture to the
+serial port.  Each histogram is only ever recorded into from one thread, so
+recording takes no locks, and readers (the stats log line and the UNIX
+socket endpoint) just take a slightly stale look at the counts.
+"""
+
+# Stages timed once per frame before the consumers
+PIPELINE_STAGES = ('vision', 'parse', 'encode', 'put')
+
+# Stages timed by every consumer
+CONSUMER_STAGES = ('queue', 'write', 'total', 'capture', 'replaced',
+                   'skipped')
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class FrameTiming(object):
+    """
+    The times a frame passed through the shared stages of the server, all
+    from time.time() except t_capture which is ssl-vision's clock
+    """
+
+    def __init__(self, received, t_capture = None):
+        self.received = received
+        self.parsed = received
+        self.t_capture = t_capture
+
+class Histogram(object):
+    """
+    Log linear histogram in the style of HdrHistogram.  Values are kept in
+    microseconds in buckets no wider than 1/64th of their value, up to
+    max_value seconds (larger values are counted as max_value).
+    """
+
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+    SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+
+    def __init__(self, max_value = 60.0):
+        self._max_us = int(max_value * 1e6)
+        self.counts = [0] * (self._index(self._max_us) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, us):
+        if us < cls.SUB_BUCKET_COUNT:
+            return us
+        shift = us.bit_length() - cls.SUB_BUCKET_BITS
+        return cls.SUB_BUCKET_COUNT + (shift - 1) * cls.SUB_BUCKET_HALF + \
+            (us >> shift) - cls.SUB_BUCKET_HALF
+
+    @classmethod
+    def _highest_value(cls, index):
+        """
+        The largest value counted in the bucket at index
+        """
+        if index < cls.SUB_BUCKET_COUNT:
+            return index
+        shift = (index - cls.SUB_BUCKET_COUNT) // cls.SUB_BUCKET_HALF + 1
+        mantissa = (index - cls.SUB_BUCKET_COUNT) % cls.SUB_BUCKET_HALF + \
+            cls.SUB_BUCKET_HALF
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        us = int(seconds * 1e6)
+        if us < 0:
+            # Clocks of different machines can be a little off
+            us = 0
+        elif us > self._max_us:
+            us = self._max_us
+
+        self.counts[self._index(us)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, pct):
+        """
+        Value in seconds which pct percent of the recorded values are at or
+        below
+        """
+        if self.count == 0:
+            return 0.0
+
+        wanted = max(1, int(round(self.count * pct / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._highest_value(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / 1e6 / self.count
+
+    def snapshot(self):
+        """
+        Summary of the histogram in milliseconds
+        """
+        return {'count' : self.count,
+                'mean_ms' : self.mean() * 1000,
+                'p50_ms' : self.percentile(50) * 1000,
+                'p90_ms' : self.percentile(90) * 1000,
+                'p99_ms' : self.percentile(99) * 1000,
+                'p999_ms' : self.percentile(99.9) * 1000,
+                'max_ms' : self.max / 1e3}
+
+class LatencyStats(object):
+    """
+    A named set of stage histograms
+    """
+
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+        self.histograms = dict([(stage, Histogram()) for stage in stages])
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    def snapshot(self):
+        return dict([(stage, self.histograms[stage].snapshot())
+                     for stage in self.stages])
+
+    def stats_line(self):
+        """
+        p50/p99/max in milliseconds of every stage which has seen a frame
+        """
+        parts = []
+        for stage in self.stages:
+            histogram = self.histograms[stage]
+            if histogram.count:
+                parts.append("%s %.2f/%.2f/%.2f (%d)" %
+                             (stage, histogram.percentile(50) * 1000,
+                              histogram.percentile(99) * 1000,
+                              histogram.max / 1e3, histogram.count))
+        return "%s latency ms p50/p99/max: %s" % (self.name, " ".join(parts))
+
+class StatsServer(threading.Thread):
+    """
+    Serves a JSON snapshot of every LatencyStats returned by collect() to
+    each client which connects to the UNIX socket at path, ie:
+
+      socat - UNIX-CONNECT:/tmp/server-stats
+    """
+
+    def __init__(self, path, collect):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._path = path
+        self._collect = collect
+        self._stopped = False
+
+        if os.path.exists(path):
+            os.remove(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(5)
+
+    def snapshot(self):
+        return json.dumps(dict([(stats.name, stats.snapshot())
+                                for stats in self._collect()]),
+                          sort_keys = True)
+
+    def run(self):
+        while not self._stopped:
+            try:
+                client, address = self._sock.accept()
+            except socket.error:
+                break
+
+            try:
+                client.sendall(self.snapshot() + '\n')
+            except socket.error:
+                pass
+            client.close()
+
+    def stop(self):
+        self._stopped = True
+        # Wakes up the accept
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self.join()
+        self._sock.close()
+        os.remove(self._path)
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestHistogram(unittest.TestCase):
+    def test_small_values_exact(self):
+        histogram = Histogram()
+        for us in xrange(0, 100):
+            histogram.record(us / 1e6)
+        self.assertEquals(49e-6, histogram.percentile(50))
+        self.assertEquals(99e-6, histogram.percentile(100))
+
+    def test_bucket_precision(self):
+        for us in (128, 129, 1000, 12345, 999999, 30000000):
+            index = Histogram._index(us)
+            highest = Histogram._highest_value(index)
+            self.assertTrue(highest >= us)
+            self.assertTrue(highest - us <= us / 64)
+            self.assertEquals(index, Histogram._index(highest))
+            self.assertEquals(index + 1, Histogram._index(highest + 1))
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for i in xrange(0, 990):
+            histogram.record(0.001)
+        for i in xrange(0, 10):
+            histogram.record(0.5)
+
+        self.assertAlmostEquals(0.001, histogram.percentile(50), 4)
+        self.assertAlmostEquals(0.001, histogram.percentile(99), 4)
+        self.assertAlmostEquals(0.5, histogram.percentile(99.9), 2)
+        self.assertEquals(0.5, histogram.max / 1e6)
+
+    def test_clamping(self):
+        histogram = Histogram(max_value = 1.0)
+        histogram.record(-0.5)
+        histogram.record(5.0)
+        self.assertEquals(0, histogram.percentile(50))
+        self.assertEquals(1.0, histogram.percentile(100))
+
+class TestStatsServer(unittest.TestCase):
+    def test_snapshot(self):
+        stats = LatencyStats('pipeline', PIPELINE_STAGES)
+        stats.record('parse', 0.002)
+
+        path = os.path.join(tempfile.mkdtemp(), 'stats')
+        server = StatsServer(path, lambda: [stats])
+        server.start()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        data = ''
+        while not data.endswith('\n'):
+            data += client.recv(4096)
+        client.close()
+        server.stop()
+        os.rmdir(os.path.dirname(path))
+
+        snapshot = json.loads(data)
+        self.assertEquals(1, snapshot['pipeline']['parse']['count'])
+        self.assertEquals(0, snapshot['pipeline']['encode']['count'])
+        self.assertAlmostEquals(2.0, snapshot['pipeline']['parse']['p50_ms'],
+                                1)
+
+if __name__ == '__main__':
+    unittest.main()
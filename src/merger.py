@@ -0,0 +1,249 @@
+# Standard Imports
+import math
+import unittest
+
+# Project Imports
+import proto.messages_robocup_ssl_detection_pb2 as ssl_detection
+
+
+__doc__ = """
+Fuses the detection frames of several ssl-vision cameras into one frame of
+the whole field, so consumers get complete frames instead of alternating
+partial views.
+"""
+
+# camera_id given to merged frames
+MERGED_CAMERA_ID = 0xFFFF
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def merge_robots(frames, team):
+    """
+    Returns the robots of the given team ('robots_yellow' or 'robots_blue')
+    from all frames, keeping only the most confident sighting of each id
+    """
+    best = {}
+    unknown = []
+    for frame in frames:
+        for robot in getattr(frame, team):
+            if not robot.HasField('robot_id'):
+                unknown.append(robot)
+                continue
+
+            current = best.get(robot.robot_id, None)
+            if current is None or robot.confidence > current.confidence:
+                best[robot.robot_id] = robot
+
+    robots = [best[robot_id] for robot_id in sorted(best.keys())]
+    robots.extend(unknown)
+    return robots
+
+def merge_balls(frames, merge_distance):
+    """
+    Returns the balls from all frames, where balls closer than merge_distance
+    to a more confident ball are treated as the same ball seen twice
+    """
+    balls = []
+    for frame in frames:
+        balls.extend(frame.balls)
+    balls.sort(key = lambda ball: ball.confidence, reverse = True)
+
+    merged = []
+    for ball in balls:
+        for kept in merged:
+            if math.hypot(ball.x - kept.x, ball.y - kept.y) < merge_distance:
+                break
+        else:
+            merged.append(ball)
+
+    return merged
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class FrameMerger(object):
+    """
+    Keeps the latest frame from every camera and builds one fused frame per
+    time window.  A fused frame is published once every active camera has
+    sent a new frame, or once frames arrive from past the end of the current
+    window.  Cameras which have not been heard from in camera_timeout seconds
+    (of capture time) are left out.
+    """
+
+    def __init__(self, window = 1/60.0, merge_distance = 50.0,
+                 camera_timeout = 0.5):
+        self._window = window
+        self._merge_distance = merge_distance
+        self._camera_timeout = camera_timeout
+
+        # camera_id -> copy of that camera's latest frame
+        self._frames = {}
+        # Cameras which sent a frame since the last publish
+        self._fresh = set()
+        self._window_start = None
+
+        # Counters
+        self.frames_in = 0
+        self.frames_out = 0
+        self._frame_number = 0
+
+    def add(self, frame):
+        """
+        Stores a copy of the frame, returns a merged SSL_DetectionFrame if
+        this completes the current window, otherwise None.
+        """
+        self.frames_in += 1
+
+        # Frames past the end of the window close it
+        merged = None
+        if self._fresh and \
+           frame.t_capture >= self._window_start + self._window:
+            merged = self._publish()
+
+        stored = self._frames.get(frame.camera_id, None)
+        if stored is None:
+            stored = ssl_detection.SSL_DetectionFrame()
+            self._frames[frame.camera_id] = stored
+        stored.CopyFrom(frame)
+
+        if not self._fresh:
+            self._window_start = frame.t_capture
+        self._fresh.add(frame.camera_id)
+
+        # Everyone has reported in
+        if merged is None and self._fresh.issuperset(self._active_cameras()):
+            merged = self._publish()
+
+        return merged
+
+    def _active_cameras(self):
+        newest = max([frame.t_capture for frame in self._frames.itervalues()])
+        return [camera_id for camera_id, frame in self._frames.iteritems()
+                if newest - frame.t_capture <= self._camera_timeout]
+
+    def _publish(self):
+        frames = [self._frames[camera_id]
+                  for camera_id in self._active_cameras()]
+
+        merged = ssl_detection.SSL_DetectionFrame()
+        merged.frame_number = self._frame_number
+        merged.camera_id = MERGED_CAMERA_ID
+        merged.t_capture = max([frame.t_capture for frame in frames])
+        merged.t_sent = max([frame.t_sent for frame in frames])
+
+        for team in ('robots_yellow', 'robots_blue'):
+            for robot in merge_robots(frames, team):
+                getattr(merged, team).add().CopyFrom(robot)
+
+        for ball in merge_balls(frames, self._merge_distance):
+            merged.balls.add().CopyFrom(ball)
+
+        self._fresh.clear()
+        self._frame_number += 1
+        self.frames_out += 1
+        return merged
+
+    def stats_line(self):
+        """
+        One line summary of the merge counters for periodic logging
+        """
+        return "merge: %d frames in %d merged frames out, %d cameras" % \
+            (self.frames_in, self.frames_out, len(self._frames))
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+def make_camera_frame(camera_id, t_capture, robots = (), balls = ()):
+    """
+    Makes a frame with the given (team, id, x, y, confidence) robots and
+    (x, y, confidence) balls
+    """
+    frame = ssl_detection.SSL_DetectionFrame()
+    frame.camera_id = camera_id
+    frame.frame_number = 1
+    frame.t_capture = t_capture
+    frame.t_sent = t_capture
+
+    for team, robot_id, x, y, confidence in robots:
+        robot = getattr(frame, team).add()
+        robot.robot_id = robot_id
+        robot.x = x
+        robot.y = y
+        robot.confidence = confidence
+
+    for x, y, confidence in balls:
+        ball = frame.balls.add()
+        ball.x = x
+        ball.y = y
+        ball.confidence = confidence
+
+    return frame
+
+class TestFrameMerger(unittest.TestCase):
+    def prime(self, merger):
+        """
+        Gets the merger to know about cameras 0 and 1 with nothing pending
+        """
+        merger.add(make_camera_frame(0, 1.0))
+        merger.add(make_camera_frame(1, 1.0))
+        self.assertNotEquals(None, merger.add(make_camera_frame(0, 1.01)))
+
+    def test_single_camera(self):
+        merger = FrameMerger()
+        merged = merger.add(make_camera_frame(0, 1.0, balls = [(1, 2, 1)]))
+        self.assertEquals(1, len(merged.balls))
+        self.assertEquals(MERGED_CAMERA_ID, merged.camera_id)
+
+    def test_waits_for_all_cameras(self):
+        merger = FrameMerger(window = 0.1)
+        self.prime(merger)
+
+        self.assertEquals(None, merger.add(make_camera_frame(0, 1.05)))
+        merged = merger.add(make_camera_frame(1, 1.06))
+        self.assertEquals(1.06, merged.t_capture)
+
+    def test_window_timeout(self):
+        merger = FrameMerger(window = 0.1)
+        self.prime(merger)
+        frames_out = merger.frames_out
+
+        self.assertEquals(None, merger.add(make_camera_frame(0, 1.05)))
+        merged = merger.add(make_camera_frame(0, 1.2))
+        self.assertEquals(1.05, merged.t_capture)
+        self.assertEquals(frames_out + 1, merger.frames_out)
+
+    def test_stale_camera_dropped(self):
+        merger = FrameMerger(camera_timeout = 0.5)
+        self.prime(merger)
+        self.assertNotEquals(None, merger.add(make_camera_frame(0, 5.0)))
+
+    def test_dedup(self):
+        merger = FrameMerger(window = 0.1, merge_distance = 50)
+        self.prime(merger)
+
+        merger.add(make_camera_frame(
+            0, 1.05,
+            robots = [('robots_yellow', 3, 10, 10, 0.5),
+                      ('robots_blue', 3, 500, 500, 0.9)],
+            balls = [(100, 100, 0.4), (900, 900, 0.8)]))
+        merged = merger.add(make_camera_frame(
+            1, 1.06,
+            robots = [('robots_yellow', 3, 20, 20, 0.7)],
+            balls = [(110, 110, 0.9)]))
+
+        self.assertEquals(1, len(merged.robots_yellow))
+        self.assertEquals(20, merged.robots_yellow[0].x)
+        self.assertEquals(1, len(merged.robots_blue))
+
+        self.assertEquals(2, len(merged.balls))
+        self.assertEquals([110, 900],
+                          sorted([ball.x for ball in merged.balls]))
+
+if __name__ == '__main__':
+    unittest.main()
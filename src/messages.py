@@ -1,9 +1,17 @@
 
 # Standard Imports
+import array
 import struct
 import unittest
 import math
 import StringIO
+import itertools
+
+# Optional Imports
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Project Imports
 import proto.messages_robocup_ssl_detection_pb2 as ssl_detection
@@ -18,6 +26,44 @@ which the bluetooth device can read.
 
 # TODO: deal with signed heading floats!!!
 
+# Default transform from ssl-vision millimeters to packed field units
+X_SHIFT = 121.92
+Y_SHIFT = 121.92/2.0
+SCALE = 0.1
+
+# Largest position compress_float can hold
+MAX_PACKED_FLOAT = 127.0
+
+# RobotInfo teams (not packed, the bricks tell robots apart by id)
+TEAM_YELLOW = 0
+TEAM_BLUE = 1
+
+# Marks the start of each FieldInfo message on the wire
+SYNC_MARKER = struct.pack('BB',255,255)
+
+# Marks the start of each TrackedFieldInfo message on the wire, no packed
+# value is ever 255 so either marker can only show up at a message start
+TRACKED_SYNC_MARKER = struct.pack('BB',255,254)
+
+# Fastest velocity in packed units per second compress_velocity can hold
+MAX_PACKED_VELOCITY = 127
+
+# An angle's magnitude in radians times this is its packed byte
+TWO_PI = 2*math.pi
+ANGLE_SCALE = 254/math.pi
+
+# Decoded value of every packed byte, FLOAT_TABLE[raw] for compressed floats
+# and ANGLE_TABLE[sign != 0][raw] for angles
+FLOAT_TABLE = tuple([raw * 0.5 for raw in xrange(0, 256)])
+ANGLE_TABLE = (tuple([raw * 0.5 * (math.pi/254) * 2.0
+                      for raw in xrange(0, 256)]),
+               tuple([-(raw * 0.5 * (math.pi/254) * 2.0)
+                      for raw in xrange(0, 256)]))
+
+if numpy is not None:
+    _float_table_array = numpy.array(FLOAT_TABLE)
+    _angle_table_array = numpy.array(ANGLE_TABLE)
+
 # Free helper functions
 
 #-----------------------------------------------------------------------------#
@@ -27,11 +73,14 @@ which the bluetooth device can read.
 def compress_float(num):
     """
     Packs a floating point number with a value of 0.0 to 127.0, with a 
-    percision of 0.5 into a single byte (max value 254)
+    percision of 0.5 into a single byte (max value 254).  Values outside
+    that range (objects off the field and boundary) pack as the nearest end.
     """
     raw_num = int(round(num*2.0))
     if raw_num > 254:
         res = 254
+    elif raw_num < 0:
+        res = 0
     else:
         res = raw_num
         
@@ -41,7 +90,7 @@ def uncompress_float(packedNum):
     """
     Reverse the effects of packing the float
     """
-    return packedNum * 0.5    
+    return FLOAT_TABLE[packedNum]
 
 def compress_int(num):
     """
@@ -54,44 +103,136 @@ def compress_int(num):
 def uncompress_int(num):
     return num
 
-def pack_angle(angle):
+def compress_velocity(num):
     """
-    This packs the an angle with ~single degree precision into two bytes
+    Packs a velocity of -127.0 to 127.0 to the nearest whole number, offset
+    by 127 so the byte stays in 0 to 254 like every other packed value
+    """
+    raw_num = int(round(num))
+    if raw_num > MAX_PACKED_VELOCITY:
+        raw_num = MAX_PACKED_VELOCITY
+    elif raw_num < -MAX_PACKED_VELOCITY:
+        raw_num = -MAX_PACKED_VELOCITY
+    return raw_num + MAX_PACKED_VELOCITY
+
+def uncompress_velocity(num):
+    return num - MAX_PACKED_VELOCITY
+
+def compress_confidence(confidence):
+    """
+    Packs a confidence of 0.0 to 1.0 as a whole percentage
+    """
+    return compress_int(max(0.0, confidence) * 100)
+
+def uncompress_confidence(num):
+    return num / 100.0
+
+def quantize_angle(angle):
+    """
+    The arithmetic behind encode_angle, without any branches so it works the
+    same on a float or a NumPy array of them.  Returns (negative, magnitude)
+    where magnitude is the rounded but not yet integer magnitude byte.
     """
     # Remove "excess" angle (ie. extra multiples of 2pi)
-    angle = angle % (2*math.pi)
+    angle = angle % TWO_PI
 
     # Make the angle between -pi and pi
-    if angle > math.pi:
-        angle -= 2*math.pi
+    angle = angle - TWO_PI * (angle > math.pi)
 
-    # Scale the angle down into to down into 254 values
-    scaled_angle = angle * (254/math.pi) / 2.0
+    # Scale the size of the angle into 254 values, rounding half up
+    return angle < 0, (abs(angle) * ANGLE_SCALE + 0.5) // 1.0
 
-    # Determine sign
-    sign = 0
-    if scaled_angle < 0:
-        sign = 1
+def encode_angle(angle):
+    """
+    Returns the (sign, magnitude) byte values that pack_angle writes out
+    """
+    negative, magnitude = quantize_angle(angle)
+    return int(negative), int(magnitude)
 
-    return struct.pack('BB', sign, compress_float(math.fabs(scaled_angle)))
+def pack_angle(angle):
+    """
+    This packs the an angle with ~single degree precision into two bytes
+    """
+    return struct.pack('BB', *encode_angle(angle))
 
 def unpack_angle(data, unpack_offset = 0):
     """
     This unpacks results from the angle compression
     """
-    # Unpack and uncompress the data
     sign, raw_scaled_angle = struct.unpack_from('BB', data, 
                                                 offset = unpack_offset)
-    scaled_angle = uncompress_float(raw_scaled_angle)
-    
-    # Unscale the data from its scaled form
-    angle = scaled_angle * (math.pi/254) * 2.0
+    return decode_angle(sign, raw_scaled_angle)
 
-    # The sign value designates negative numbers
-    if sign:
-        angle = -angle;
+def decode_angle(sign, raw_scaled_angle):
+    """
+    Reverse of encode_angle, turns the sign and magnitude bytes into radians
+    """
+    return ANGLE_TABLE[sign != 0][raw_scaled_angle]
 
-    return angle
+# Compiled structs for whole FieldInfo messages, keyed by object counts
+_field_structs = {}
+
+def field_struct(num_robots, num_balls, ball_size = 2):
+    """
+    Returns a cached struct.Struct which packs an entire FieldInfo message,
+    the Header followed by every RobotInfo and ball position, in one call.
+    Pass Ball.PACKED_SIZE as the ball_size for a TrackedFieldInfo.
+    """
+    key = (num_robots, num_balls, ball_size)
+    compiled = _field_structs.get(key, None)
+    if compiled is None:
+        size = Header.PACKED_SIZE + RobotInfo.PACKED_SIZE * num_robots + \
+               ball_size * num_balls
+        compiled = struct.Struct('%dB' % size)
+        _field_structs[key] = compiled
+    return compiled
+
+# Array versions of the helpers, these need numpy
+
+def round_array(nums):
+    """
+    Rounds half away from zero like the builtin round (numpy.round rounds
+    half to even, which would not match the scalar helpers)
+    """
+    return numpy.copysign(numpy.floor(numpy.fabs(nums) + 0.5), nums)
+
+def compress_float_array(nums):
+    """
+    Array version of compress_float, returns the packed values as uint8
+    """
+    raw_nums = round_array(numpy.asarray(nums, dtype = numpy.float64) * 2.0)
+    return numpy.clip(raw_nums, 0, 254).astype(numpy.uint8)
+
+def compress_int_array(nums):
+    """
+    Array version of compress_int, returns the packed values as uint8
+    """
+    raw_nums = round_array(numpy.asarray(nums, dtype = numpy.float64))
+    if raw_nums.size and raw_nums.min() < 0:
+        raise ValueError("Can not compress negative ints")
+    return numpy.minimum(raw_nums, 254).astype(numpy.uint8)
+
+def encode_angle_array(angles):
+    """
+    Array version of encode_angle, returns uint8 arrays of signs and
+    magnitudes
+    """
+    negative, magnitudes = quantize_angle(
+        numpy.asarray(angles, dtype = numpy.float64))
+    return negative.astype(numpy.uint8), magnitudes.astype(numpy.uint8)
+
+def uncompress_float_array(raw_nums):
+    """
+    Array version of uncompress_float, a gather from FLOAT_TABLE
+    """
+    return _float_table_array[raw_nums]
+
+def decode_angle_array(signs, raw_scaled_angles):
+    """
+    Array version of decode_angle, a gather from ANGLE_TABLE
+    """
+    rows = (numpy.asarray(signs) != 0).astype(numpy.intp)
+    return _angle_table_array[rows, raw_scaled_angles]
 
 
 #-----------------------------------------------------------------------------#
@@ -103,6 +244,8 @@ class Vector2D(object):
     Simple X,Y position
     """
     
+    __slots__ = ('x', 'y')
+
     PACKED_SIZE = 2
 
     def __init__(self,x,y):
@@ -142,25 +285,85 @@ class Vector2D(object):
             return result
         return not result
 
-# TODO: FINISH ME
 class Ball(object):
     """
-    Represents ball position and size over the wire
+    A tracked ball: its position, velocity in position units per second and
+    how sure the tracker is of it (0 to 1)
     """
-    PACKED_SIZE = Vector2D.PACKED_SIZE + 1
-    
+
+    __slots__ = ('pos', 'velocity', 'confidence')
+
+    PACKED_SIZE = Vector2D.PACKED_SIZE + 2 + 1
+
+    def __init__(self, pos, velocity = None, confidence = 1.0):
+        if velocity is None:
+            velocity = Vector2D(0, 0)
+        self.pos = pos
+        self.velocity = velocity
+        self.confidence = confidence
+
+    def predict(self, dt):
+        """
+        Where the ball will be dt seconds from now if it keeps going
+        """
+        return Vector2D(self.pos.x + self.velocity.x * dt,
+                        self.pos.y + self.velocity.y * dt)
+
+    def pack(self):
+        """Returns the object encoded in a binary string"""
+        return struct.pack('BBBBB',
+                           compress_float(self.pos.x),
+                           compress_float(self.pos.y),
+                           compress_velocity(self.velocity.x),
+                           compress_velocity(self.velocity.y),
+                           compress_confidence(self.confidence))
+
+    @staticmethod
+    def unpack(data, unpack_offset = 0):
+        """Returns and object build from the packed data"""
+        raw_x, raw_y, raw_vx, raw_vy, raw_confidence = \
+            struct.unpack_from('BBBBB', data, offset = unpack_offset)
+        return Ball(Vector2D(uncompress_float(raw_x), uncompress_float(raw_y)),
+                    Vector2D(uncompress_velocity(raw_vx),
+                             uncompress_velocity(raw_vy)),
+                    uncompress_confidence(raw_confidence))
+
+    # Boiler plate methods
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return "Ball %s v:%s %.2f" % (self.pos, self.velocity, self.confidence)
+
+    def __eq__(self, other):
+        if isinstance(other, Ball):
+            return (self.pos == other.pos) and \
+                (self.velocity == other.velocity) and \
+                (self.confidence == other.confidence)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
 
 class RobotInfo(object):
     """
-    Describes the id, position, heading of a robot on the field
+    Describes the id, position, heading of a robot on the field, and its
+    team when that is known (it isn't packed)
     """
     
+    __slots__ = ('id', 'heading', 'pos', 'team')
+
     PACKED_SIZE = 1 + 2 + Vector2D.PACKED_SIZE
 
-    def __init__(self, ID, heading, pos):
+    def __init__(self, ID, heading, pos, team = None):
         self.id = ID
         self.heading = heading
         self.pos = pos
+        self.team = team
 
     def pack(self):
         """Returns the object encoded in a binary string"""
@@ -207,6 +410,8 @@ class Header(object):
     Includes the number of following RobotInfo and Vector2D ball positions
     """
 
+    __slots__ = ('num_robots', 'num_balls')
+
     PACKED_SIZE = 2
     
     def __init__(self, num_robots, num_balls):
@@ -235,30 +440,88 @@ class Header(object):
     def __repr__(self):
         return "Header(robo#: %d ball# %d)" % (self.num_robots, self.num_balls)
 
+    def __eq__(self, other):
+        if isinstance(other, Header):
+            return (self.num_robots == other.num_robots) and \
+                (self.num_balls == other.num_balls)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+class FieldTransform(object):
+    """
+    Affine map from ssl-vision millimeters to packed field units,
+    (x * scale + x_shift, y * scale + y_shift).  Build one per field
+    geometry and share it between frames.
+    """
+
+    def __init__(self, x_shift = 0, y_shift = 0, scale = 1):
+        self.x_shift = x_shift
+        self.y_shift = y_shift
+        self.scale = scale
+
+        # Millimeters per packed step (compress_float keeps 0.5 units)
+        self.resolution = 0.5 / scale
+
+    def apply(self, x, y):
+        return (x * self.scale) + self.x_shift, (y * self.scale) + self.y_shift
+
+    @staticmethod
+    def from_field_size(field_size, max_value = MAX_PACKED_FLOAT):
+        """
+        Builds the transform for the given SSL_GeometryFieldSize which maps
+        the field and its boundary onto 0 to max_value.  Both axes share the
+        scale of the longer one, so distances and headings stay true, and the
+        origin moves to the corner of the boundary.  Raises ValueError for an
+        empty field.
+        """
+        length = field_size.field_length + 2 * field_size.boundary_width
+        width = field_size.field_width + 2 * field_size.boundary_width
+        if length <= 0 or width <= 0:
+            raise ValueError("Bad field size: %d x %d" % (length, width))
+
+        scale = float(max_value) / max(length, width)
+        return FieldTransform(length * scale / 2.0, width * scale / 2.0, scale)
+
+    def __repr__(self):
+        return "FieldTransform(x_shift: %f y_shift: %f scale: %f)" % \
+            (self.x_shift, self.y_shift, self.scale)
 
 class FieldInfo(object):
     """
     Contains all the info about the robots and balls on the field
     """
+
+    __slots__ = ('robots', 'balls', 'header', 'transform')
+
+    # Packed bytes per ball
+    BALL_SIZE = Vector2D.PACKED_SIZE
     
     def __init__(self, detection_packet = None,
-                 x_shift = 0, y_shift = 0, scale = 1):
+                 x_shift = 0, y_shift = 0, scale = 1, transform = None):
         self.robots = []
         self.balls = []
         self.header = None
-        self._x_shift = x_shift
-        self._y_shift = y_shift
-        self._scale = scale
+        if transform is None:
+            transform = FieldTransform(x_shift, y_shift, scale)
+        self.transform = transform
         
         if detection_packet is not None:
             # Build up robots 
             for robot in detection_packet.robots_yellow:
                 self.robots.append(RobotInfo(robot.robot_id, robot.orientation,
-                                             self._parse_pos(robot)))
+                                             self._parse_pos(robot),
+                                             TEAM_YELLOW))
 
             for robot in detection_packet.robots_blue:
                 self.robots.append(RobotInfo(robot.robot_id, robot.orientation,
-                                             self._parse_pos(robot)))
+                                             self._parse_pos(robot),
+                                             TEAM_BLUE))
 
             # Build up balls
             for ball in detection_packet.balls:
@@ -269,47 +532,97 @@ class FieldInfo(object):
             self.header = Header(len(self.robots), len(self.balls))
 
     def _parse_pos(self, obj):
-        return Vector2D((obj.x * self._scale) + self._x_shift,
-                        (obj.y * self._scale) + self._y_shift)
+        transform = self.transform
+        return Vector2D((obj.x * transform.scale) + transform.x_shift,
+                        (obj.y * transform.scale) + transform.y_shift)
 
-    def send_data(self, fileobj):
+    def pack(self):
         """
-        Serializes and writes all the data to the given file descriptor
+        Returns the whole message, header, robots and balls, encoded in a
+        single binary string
         """
+        data = bytearray(self.packed_size())
+        self.pack_into(data)
+        return str(data)
 
-        # Put everything in a big list, because the have the same interface,
-        # and send into the file obj
+    def pack_into(self, buf, offset = 0):
+        """
+        Packs the whole message into the given writable buffer (ie. a
+        bytearray) at the given offset, with one struct call
+        """
+        values = [compress_int(self.header.num_robots),
+                  compress_int(self.header.num_balls)]
 
-        to_send = [self.header]
-        to_send.extend(self.robots)
-        to_send.extend(self.balls)
-        
-        # Send robots
-        for item in to_send:
-            data = item.pack()
-            fileobj.write(data)
+        for robot in self.robots:
+            sign, raw_heading = encode_angle(robot.heading)
+            values.extend((compress_int(robot.id), sign, raw_heading,
+                           compress_float(robot.pos.x),
+                           compress_float(robot.pos.y)))
 
-    @staticmethod
-    def unpack(data):
-        offset = 0
-        field_info = FieldInfo()
-        
-        # Header
-        field_info.header = Header.unpack(data)
-        offset += Header.PACKED_SIZE
-        
-        # Robots
-        for i in xrange(0, field_info.header.num_robots):
-            field_info.robots.append(RobotInfo.unpack(data, offset))
-            offset += RobotInfo.PACKED_SIZE
+        self._pack_balls(values)
 
-        # Balls
-        for i in xrange(0, field_info.header.num_balls):
-            field_info.balls.append(Vector2D.unpack(data, offset))
-            offset += Vector2D.PACKED_SIZE
+        field_struct(len(self.robots), len(self.balls),
+                     self.BALL_SIZE).pack_into(buf, offset, *values)
+
+    def _pack_balls(self, values):
+        """
+        Adds the packed values of the balls to values
+        """
+        for ball in self.balls:
+            values.extend((compress_float(ball.x), compress_float(ball.y)))
+
+    def packed_size(self):
+        """The number of bytes pack will produce"""
+        return field_struct(len(self.robots), len(self.balls),
+                            self.BALL_SIZE).size
+
+    def send_data(self, fileobj):
+        """
+        Serializes and writes all the data to the given file descriptor
+        """
+        fileobj.write(self.pack())
 
+    @classmethod
+    def unpack(cls, data, unpack_offset = 0):
+        """
+        Returns an object built from the packed data, which can be any
+        buffer, memoryviews are read in place without copying
+        """
+        view = memoryview(data)
+        field_info = cls()
+
+        # Header
+        field_info.header = Header.unpack(view, unpack_offset)
+        num_robots = field_info.header.num_robots
+        num_balls = field_info.header.num_balls
+
+        # Everything else comes out in one pass
+        values = field_struct(num_robots, num_balls,
+                              cls.BALL_SIZE).unpack_from(view, unpack_offset)
+
+        # Robots, the values are looked up straight from the decode tables
+        floats = FLOAT_TABLE
+        angles = ANGLE_TABLE
+        end = Header.PACKED_SIZE + RobotInfo.PACKED_SIZE * num_robots
+        robots = field_info.robots
+        for i in xrange(Header.PACKED_SIZE, end, RobotInfo.PACKED_SIZE):
+            ID, sign, raw_heading, raw_x, raw_y = values[i:i + 5]
+            robots.append(RobotInfo(uncompress_int(ID),
+                                    angles[sign != 0][raw_heading],
+                                    Vector2D(floats[raw_x], floats[raw_y])))
+
+        field_info._unpack_balls(values, end)
         return field_info
 
+    def _unpack_balls(self, values, start):
+        """
+        Fills in the balls from the unpacked values, which begin at start
+        """
+        floats = FLOAT_TABLE
+        balls = self.balls
+        for i in xrange(start, len(values), self.BALL_SIZE):
+            balls.append(Vector2D(floats[values[i]], floats[values[i + 1]]))
+
     def __str__(self):
         return self.__repr__()
         
@@ -322,6 +635,486 @@ class FieldInfo(object):
             string_io.write("Ball: %s\n" % ball)
         return string_io.getvalue()
 
+class TrackedFieldInfo(FieldInfo):
+    """
+    A FieldInfo from the tracker (see tracker.py), its balls are Ball objects
+    which carry their velocity and confidence on the wire.  It is sent after
+    TRACKED_SYNC_MARKER so readers can tell it from a plain FieldInfo.
+    """
+
+    __slots__ = ()
+
+    BALL_SIZE = Ball.PACKED_SIZE
+
+    def _pack_balls(self, values):
+        for ball in self.balls:
+            values.extend((compress_float(ball.pos.x),
+                           compress_float(ball.pos.y),
+                           compress_velocity(ball.velocity.x),
+                           compress_velocity(ball.velocity.y),
+                           compress_confidence(ball.confidence)))
+
+    def predict(self, dt):
+        """
+        Returns a copy with the balls moved dt seconds along
+        """
+        field_info = TrackedFieldInfo(transform = self.transform)
+        field_info.header = self.header
+        field_info.robots = self.robots
+        field_info.balls = [Ball(ball.predict(dt), ball.velocity,
+                                 ball.confidence) for ball in self.balls]
+        return field_info
+
+    def _unpack_balls(self, values, start):
+        floats = FLOAT_TABLE
+        balls = self.balls
+        for i in xrange(start, len(values), Ball.PACKED_SIZE):
+            raw_x, raw_y, raw_vx, raw_vy, raw_confidence = values[i:i + 5]
+            balls.append(Ball(Vector2D(floats[raw_x], floats[raw_y]),
+                              Vector2D(uncompress_velocity(raw_vx),
+                                       uncompress_velocity(raw_vy)),
+                              uncompress_confidence(raw_confidence)))
+
+class ArrayFieldInfo(object):
+    """
+    A FieldInfo which keeps its robots and balls as NumPy arrays, so the
+    position transform and compression are done for the whole frame at once.
+    It packs to exactly the same bytes as FieldInfo.
+    """
+
+    def __init__(self, detection_packet = None,
+                 x_shift = 0, y_shift = 0, scale = 1, transform = None):
+        if numpy is None:
+            raise ImportError("ArrayFieldInfo requires numpy")
+
+        if transform is None:
+            transform = FieldTransform(x_shift, y_shift, scale)
+        self.transform = transform
+
+        robots = []
+        balls = []
+        if detection_packet is not None:
+            robots = list(itertools.chain(detection_packet.robots_yellow,
+                                          detection_packet.robots_blue))
+            balls = detection_packet.balls
+
+        # Pull everything we need out of the packet in one pass per value
+        self.robot_ids = self._gather(robots, 'robot_id')
+        self.robot_headings = self._gather(robots, 'orientation')
+        self.robot_x = self._shift_x(self._gather(robots, 'x'))
+        self.robot_y = self._shift_y(self._gather(robots, 'y'))
+
+        self.ball_x = self._shift_x(self._gather(balls, 'x'))
+        self.ball_y = self._shift_y(self._gather(balls, 'y'))
+
+        self.header = Header(len(self.robot_ids), len(self.ball_x))
+
+    @staticmethod
+    def _gather(objs, name):
+        return numpy.fromiter((getattr(obj, name) for obj in objs),
+                              dtype = numpy.float64, count = len(objs))
+
+    def _shift_x(self, xs):
+        return (xs * self.transform.scale) + self.transform.x_shift
+
+    def _shift_y(self, ys):
+        return (ys * self.transform.scale) + self.transform.y_shift
+
+    def pack(self):
+        """
+        Returns the whole message encoded in a binary string
+        """
+        num_robots = len(self.robot_ids)
+        num_balls = len(self.ball_x)
+        robot_end = Header.PACKED_SIZE + RobotInfo.PACKED_SIZE * num_robots
+
+        data = numpy.empty(field_struct(num_robots, num_balls).size,
+                           dtype = numpy.uint8)
+
+        # Header
+        data[0] = compress_int(num_robots)
+        data[1] = compress_int(num_balls)
+
+        # Robots, one row per robot in wire order
+        robots = data[Header.PACKED_SIZE:robot_end].reshape(
+            num_robots, RobotInfo.PACKED_SIZE)
+        robots[:, 0] = compress_int_array(self.robot_ids)
+        robots[:, 1], robots[:, 2] = encode_angle_array(self.robot_headings)
+        robots[:, 3] = compress_float_array(self.robot_x)
+        robots[:, 4] = compress_float_array(self.robot_y)
+
+        # Balls
+        balls = data[robot_end:].reshape(num_balls, Vector2D.PACKED_SIZE)
+        balls[:, 0] = compress_float_array(self.ball_x)
+        balls[:, 1] = compress_float_array(self.ball_y)
+
+        return data.tobytes()
+
+    def send_data(self, fileobj):
+        """
+        Serializes and writes all the data to the given file descriptor
+        """
+        fileobj.write(self.pack())
+
+    @staticmethod
+    def unpack(data, unpack_offset = 0):
+        """
+        Returns an ArrayFieldInfo built from the packed data, every value is
+        gathered from the decode tables a whole column at a time
+        """
+        header = Header.unpack(data, unpack_offset)
+        num_robots = header.num_robots
+        num_balls = header.num_balls
+        robot_end = Header.PACKED_SIZE + RobotInfo.PACKED_SIZE * num_robots
+
+        raw = numpy.frombuffer(data, dtype = numpy.uint8,
+                               count = field_struct(num_robots,
+                                                    num_balls).size,
+                               offset = unpack_offset)
+        robots = raw[Header.PACKED_SIZE:robot_end].reshape(
+            num_robots, RobotInfo.PACKED_SIZE)
+        balls = raw[robot_end:].reshape(num_balls, Vector2D.PACKED_SIZE)
+
+        field_info = ArrayFieldInfo()
+        field_info.header = header
+        field_info.robot_ids = robots[:, 0].astype(numpy.float64)
+        field_info.robot_headings = decode_angle_array(robots[:, 1],
+                                                       robots[:, 2])
+        field_info.robot_x = uncompress_float_array(robots[:, 3])
+        field_info.robot_y = uncompress_float_array(robots[:, 4])
+        field_info.ball_x = uncompress_float_array(balls[:, 0])
+        field_info.ball_y = uncompress_float_array(balls[:, 1])
+        return field_info
+
+    def to_field_info(self):
+        """
+        Returns the same contents as a normal object based FieldInfo
+        """
+        field_info = FieldInfo()
+        field_info.header = Header(self.header.num_robots,
+                                   self.header.num_balls)
+        for ID, heading, x, y in zip(self.robot_ids, self.robot_headings,
+                                     self.robot_x, self.robot_y):
+            field_info.robots.append(RobotInfo(int(ID), float(heading),
+                                               Vector2D(float(x), float(y))))
+        for x, y in zip(self.ball_x, self.ball_y):
+            field_info.balls.append(Vector2D(float(x), float(y)))
+        return field_info
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return repr(self.to_field_info())
+
+class FieldHistory(object):
+    """
+    Stores a sequence of FieldInfo frames as a struct of arrays: every robot
+    and ball value goes in a flat typed array, instead of an object per robot
+    and ball per frame.  The robots of frame i are at the indices
+    robot_start[i] to robot_start[i + 1] of the robot arrays, the balls
+    likewise with ball_start, and robot_frames and ball_frames give the
+    frame of every robot and ball.  Robot teams are stored as NO_TEAM when
+    unknown.  Frames can only be appended.
+
+    What this buys is memory, several times less than a list of FieldInfos,
+    and fast whole column work such as sum(history.robot_x).  Iterating is
+    not faster: iter_robots and iter_balls run about as fast as walking the
+    objects of a list of FieldInfos, and rebuilding FieldInfos is several
+    times slower than keeping them.
+    """
+
+    NO_TEAM = -1
+
+    def __init__(self):
+        self.timestamps = array.array('d')
+        self.robot_start = array.array('L', [0])
+        self.ball_start = array.array('L', [0])
+        self.robot_frames = array.array('I')
+        self.ball_frames = array.array('I')
+
+        self.robot_ids = array.array('L')
+        self.robot_teams = array.array('b')
+        self.robot_headings = array.array('d')
+        self.robot_x = array.array('d')
+        self.robot_y = array.array('d')
+        self.ball_x = array.array('d')
+        self.ball_y = array.array('d')
+
+    def append(self, field_info, timestamp = 0.0):
+        index = len(self.timestamps)
+        robots = field_info.robots
+        self.robot_frames.extend([index] * len(robots))
+        self.robot_ids.extend([robot.id for robot in robots])
+        self.robot_teams.extend([self._team_code(robot.team)
+                                 for robot in robots])
+        self.robot_headings.extend([robot.heading for robot in robots])
+        self.robot_x.extend([robot.pos.x for robot in robots])
+        self.robot_y.extend([robot.pos.y for robot in robots])
+        self.robot_start.append(len(self.robot_ids))
+
+        balls = field_info.balls
+        self.ball_frames.extend([index] * len(balls))
+        self.ball_x.extend([ball.x for ball in balls])
+        self.ball_y.extend([ball.y for ball in balls])
+        self.ball_start.append(len(self.ball_x))
+
+        self.timestamps.append(timestamp)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _team_code(self, team):
+        if team is None:
+            return self.NO_TEAM
+        return team
+
+    def _robot(self, ID, team, heading, x, y):
+        if team == self.NO_TEAM:
+            team = None
+        return RobotInfo(ID, heading, Vector2D(x, y), team)
+
+    def _ranges(self, index):
+        if index < 0:
+            index += len(self.timestamps)
+        if index < 0 or index >= len(self.timestamps):
+            raise IndexError("FieldHistory index out of range")
+        return (self.robot_start[index], self.robot_start[index + 1],
+                self.ball_start[index], self.ball_start[index + 1])
+
+    def __getitem__(self, index):
+        """
+        Rebuilds the FieldInfo of the given frame
+        """
+        robot_begin, robot_end, ball_begin, ball_end = self._ranges(index)
+
+        field_info = FieldInfo()
+        robot = self._robot
+        field_info.robots = [
+            robot(*values) for values in
+            itertools.izip(self.robot_ids[robot_begin:robot_end],
+                           self.robot_teams[robot_begin:robot_end],
+                           self.robot_headings[robot_begin:robot_end],
+                           self.robot_x[robot_begin:robot_end],
+                           self.robot_y[robot_begin:robot_end])]
+        field_info.balls = [
+            Vector2D(x, y) for x, y in
+            itertools.izip(self.ball_x[ball_begin:ball_end],
+                           self.ball_y[ball_begin:ball_end])]
+        field_info.header = Header(robot_end - robot_begin,
+                                   ball_end - ball_begin)
+        return field_info
+
+    def __iter__(self):
+        """
+        Rebuilds every FieldInfo in order, walking the arrays once
+        """
+        islice = itertools.islice
+        robot = self._robot
+        robots = itertools.izip(self.robot_ids, self.robot_teams,
+                                self.robot_headings, self.robot_x,
+                                self.robot_y)
+        balls = itertools.izip(self.ball_x, self.ball_y)
+        robot_start = self.robot_start
+        ball_start = self.ball_start
+
+        for index in xrange(0, len(self.timestamps)):
+            num_robots = robot_start[index + 1] - robot_start[index]
+            num_balls = ball_start[index + 1] - ball_start[index]
+
+            field_info = FieldInfo()
+            field_info.robots = [robot(*values) for values in
+                                 islice(robots, num_robots)]
+            field_info.balls = [Vector2D(x, y) for x, y in
+                                islice(balls, num_balls)]
+            field_info.header = Header(num_robots, num_balls)
+            yield field_info
+
+    def iter_robots(self):
+        """
+        Yields (frame_index, id, heading, x, y) for every robot of every
+        frame, straight from the arrays
+        """
+        return itertools.izip(self.robot_frames, self.robot_ids,
+                              self.robot_headings, self.robot_x, self.robot_y)
+
+    def iter_balls(self):
+        """
+        Yields (frame_index, x, y) for every ball of every frame
+        """
+        return itertools.izip(self.ball_frames, self.ball_x, self.ball_y)
+
+    def pack(self, index):
+        """
+        Returns the given frame encoded just like FieldInfo.pack
+        """
+        robot_begin, robot_end, ball_begin, ball_end = self._ranges(index)
+        num_robots = robot_end - robot_begin
+        num_balls = ball_end - ball_begin
+
+        values = [compress_int(num_robots), compress_int(num_balls)]
+        for i in xrange(robot_begin, robot_end):
+            sign, raw_heading = encode_angle(self.robot_headings[i])
+            values.extend((compress_int(self.robot_ids[i]), sign, raw_heading,
+                           compress_float(self.robot_x[i]),
+                           compress_float(self.robot_y[i])))
+        for i in xrange(ball_begin, ball_end):
+            values.extend((compress_float(self.ball_x[i]),
+                           compress_float(self.ball_y[i])))
+
+        return field_struct(num_robots, num_balls).pack(*values)
+
+    def nbytes(self):
+        """
+        Bytes used by the arrays' contents
+        """
+        arrays = (self.timestamps, self.robot_start, self.ball_start,
+                  self.robot_frames, self.ball_frames, self.robot_ids,
+                  self.robot_teams, self.robot_headings, self.robot_x, self.robot_y,
+                  self.ball_x, self.ball_y)
+        return sum([len(a) * a.itemsize for a in arrays])
+
+def split_slots(data, unpack_offset = 0):
+    """
+    Splits a packed FieldInfo into its Header counts and a list of the packed
+    strings of every robot and ball (its slots), in wire order
+    """
+    header = Header.unpack(data, unpack_offset)
+    slots = []
+
+    offset = unpack_offset + Header.PACKED_SIZE
+    for i in xrange(0, header.num_robots):
+        slots.append(data[offset:offset + RobotInfo.PACKED_SIZE])
+        offset += RobotInfo.PACKED_SIZE
+
+    for i in xrange(0, header.num_balls):
+        slots.append(data[offset:offset + Vector2D.PACKED_SIZE])
+        offset += Vector2D.PACKED_SIZE
+
+    return (header.num_robots, header.num_balls), slots
+
+class DeltaEncoder(object):
+    """
+    Encodes a stream of FieldInfos as key frames, a frame type byte and a
+    sequence byte followed by the full packed FieldInfo, and delta frames
+    which only carry the robots and balls whose packed (quantized) values
+    changed since the frame before:
+
+      frame type byte, sequence byte, bitmask of changed slots (bit i % 7 of
+      byte i / 7 is slot i, robots first then balls), then the packed
+      changed slots in order
+
+    Masks only use 7 bits a byte, so like every other packed value they stay
+    below 255 and can never look like a sync marker.  The sequence counts
+    every frame modulo SEQ_MODULUS, a reader which missed one can tell from
+    the next delta and waits for a key frame instead of applying it.
+
+    A key frame is sent whenever the object counts change, every
+    keyframe_interval frames so a reader can resync, and whenever a delta
+    would not be smaller.
+    """
+
+    KEY_FRAME = 0
+    DELTA_FRAME = 1
+
+    SLOTS_PER_MASK_BYTE = 7
+    SEQ_MODULUS = 255
+
+    def __init__(self, keyframe_interval = 30):
+        self._keyframe_interval = keyframe_interval
+        self._counts = None
+        self._slots = None
+        self._since_key = 0
+        self._seq = -1
+
+    def encode(self, field_info):
+        """
+        Returns the next key or delta frame for the given FieldInfo
+        """
+        return self.encode_packed(field_info.pack())
+
+    def encode_packed(self, data):
+        """
+        Same as encode, but takes an already packed FieldInfo
+        """
+        counts, slots = split_slots(data)
+        self._seq = (self._seq + 1) % self.SEQ_MODULUS
+
+        if self._slots is not None and counts == self._counts and \
+           self._since_key < self._keyframe_interval:
+            per_byte = self.SLOTS_PER_MASK_BYTE
+            mask = bytearray((len(slots) + per_byte - 1) // per_byte)
+            changed = []
+            for i, (slot, old_slot) in enumerate(zip(slots, self._slots)):
+                if slot != old_slot:
+                    mask[i // per_byte] |= 1 << (i % per_byte)
+                    changed.append(slot)
+
+            delta = chr(self.DELTA_FRAME) + chr(self._seq) + str(mask) + \
+                ''.join(changed)
+            if len(delta) < len(data) + 2:
+                self._slots = slots
+                self._since_key += 1
+                return delta
+
+        # Key frame
+        self._counts = counts
+        self._slots = slots
+        self._since_key = 0
+        return chr(self.KEY_FRAME) + chr(self._seq) + data
+
+class DeltaDecoder(object):
+    """
+    Rebuilds FieldInfos from the frames made by a DeltaEncoder
+    """
+
+    def __init__(self):
+        self._counts = None
+        self._slots = None
+        self._seq = None
+
+    def decode(self, data, unpack_offset = 0):
+        """
+        Returns the FieldInfo for the given key or delta frame, raises
+        ValueError for a delta frame before any key frame, or after a missed
+        frame (every delta until the next key frame is refused then)
+        """
+        frame_type = ord(data[unpack_offset])
+        seq = ord(data[unpack_offset + 1])
+        offset = unpack_offset + 2
+
+        if frame_type == DeltaEncoder.KEY_FRAME:
+            self._counts, self._slots = split_slots(data, offset)
+        elif frame_type == DeltaEncoder.DELTA_FRAME:
+            if self._slots is None:
+                raise ValueError("Delta frame without a key frame")
+            expected = (self._seq + 1) % DeltaEncoder.SEQ_MODULUS
+            if seq != expected:
+                self._slots = None
+                raise ValueError("Missed frames before delta %d (expected "
+                                 "%d)" % (seq, expected))
+
+            per_byte = DeltaEncoder.SLOTS_PER_MASK_BYTE
+            mask_size = (len(self._slots) + per_byte - 1) // per_byte
+            mask = bytearray(data[offset:offset + mask_size])
+            offset += mask_size
+
+            num_robots = self._counts[0]
+            for i in xrange(0, len(self._slots)):
+                if mask[i // per_byte] & (1 << (i % per_byte)):
+                    if i < num_robots:
+                        size = RobotInfo.PACKED_SIZE
+                    else:
+                        size = Vector2D.PACKED_SIZE
+                    self._slots[i] = data[offset:offset + size]
+                    offset += size
+        else:
+            raise ValueError("Unknown frame type: %d" % frame_type)
+        self._seq = seq
+
+        header = Header(*self._counts).pack()
+        return FieldInfo.unpack(header + ''.join(self._slots))
+
 #-----------------------------------------------------------------------------#
 #                                T E S T S                                    #
 #-----------------------------------------------------------------------------#
@@ -330,6 +1123,9 @@ class TestFunctions(unittest.TestCase):
     def test_compress_float(self):
         self.assertEquals(10, compress_float(5.0))
         self.assertEquals(5, compress_float(2.5))
+        self.assertEquals(0, compress_float(-0.2))
+        self.assertEquals(0, compress_float(-1000.0))
+        self.assertEquals(254, compress_float(500.0))
 
     def test_uncompress_float(self):
         self.assertEquals(7.5, uncompress_float(15))
@@ -359,6 +1155,31 @@ class TestFunctions(unittest.TestCase):
         self.assertAlmostEqual(-math.pi * 0.5, unpack_angle(data), 2)
 
 
+class TestAngleCodec(unittest.TestCase):
+    def old_encode_angle(self, angle):
+        # encode_angle as it was before it went branch free
+        angle = angle % (2*math.pi)
+        if angle > math.pi:
+            angle -= 2*math.pi
+        scaled_angle = angle * (254/math.pi) / 2.0
+        sign = 0
+        if scaled_angle < 0:
+            sign = 1
+        return sign, compress_float(math.fabs(scaled_angle))
+
+    def test_encode_matches_old(self):
+        angles = [i * 0.0123 - 10.0 for i in xrange(0, 2000)] + \
+                 [0.0, -0.0, math.pi, -math.pi, 2*math.pi, math.pi / 254]
+        for angle in angles:
+            self.assertEquals(self.old_encode_angle(angle),
+                              encode_angle(angle))
+
+    def test_decode_table(self):
+        for raw in xrange(0, 256):
+            angle = raw * 0.5 * (math.pi/254) * 2.0
+            self.assertEquals(angle, decode_angle(0, raw))
+            self.assertEquals(-angle, decode_angle(1, raw))
+
 class TestVector2D(unittest.TestCase):
 
     def test_pack_unpack(self):
@@ -480,6 +1301,10 @@ class TestFieldInfo(unittest.TestCase):
         field_info = FieldInfo(self.frame)
         self.check_field_info(field_info)
 
+        # Teams only live in the objects, they aren't packed
+        teams = [TEAM_YELLOW] * len(self.frame.robots_yellow) + \
+                [TEAM_BLUE] * len(self.frame.robots_blue)
+        self.assertEqual(teams, [robot.team for robot in field_info.robots])
 
     def test_send_data(self):
         fileobj = StringIO.StringIO()
@@ -503,6 +1328,370 @@ class TestFieldInfo(unittest.TestCase):
         field_info2 = FieldInfo.unpack(fileobj.getvalue())
         self.check_field_info(field_info2)
 
+    def test_pack_matches_items(self):
+        field_info = FieldInfo(self.frame)
+        items = [field_info.header] + field_info.robots + field_info.balls
+        expected = ''.join([item.pack() for item in items])
+
+        self.assertEquals(expected, field_info.pack())
+
+    def test_pack_into_unpack_memoryview(self):
+        field_info = FieldInfo(self.frame)
+        buf = bytearray(3 + field_info.packed_size())
+        field_info.pack_into(buf, 3)
+
+        field_info2 = FieldInfo.unpack(memoryview(buf), 3)
+        self.check_field_info(field_info2)
+
+    def test_slots(self):
+        field_info = FieldInfo(self.frame)
+        for obj in [field_info, field_info.header, field_info.robots[0],
+                    field_info.balls[0]]:
+            self.assertFalse(hasattr(obj, '__dict__'))
+            self.assertRaises(AttributeError, setattr, obj, 'extra', 1)
+
+class TestTrackedFieldInfo(unittest.TestCase):
+    def setUp(self):
+        self.field_info = TrackedFieldInfo()
+        self.field_info.robots = [RobotInfo(3, 0.0, Vector2D(10, 20))]
+        self.field_info.balls = [Ball(Vector2D(50, 60.5), Vector2D(-30, 200),
+                                      0.87),
+                                 Ball(Vector2D(0, 127))]
+        self.field_info.header = Header(1, 2)
+
+    def test_velocity_codec(self):
+        self.assertEquals([0, 127, 254, 254, 0],
+                          [compress_velocity(v)
+                           for v in (-127, 0, 127, 500.0, -1e9)])
+        self.assertEquals(-3, uncompress_velocity(compress_velocity(-3.2)))
+
+    def test_pack_unpack(self):
+        data = self.field_info.pack()
+        self.assertEquals(Header.PACKED_SIZE + RobotInfo.PACKED_SIZE +
+                          2 * Ball.PACKED_SIZE, len(data))
+        self.assertEquals(''.join([item.pack() for item in
+                                   [self.field_info.header] +
+                                   self.field_info.robots +
+                                   self.field_info.balls]), data)
+        self.assertFalse('\xff' in data)
+
+        field_info = TrackedFieldInfo.unpack(data)
+        self.assertEquals(self.field_info.robots, field_info.robots)
+        self.assertEquals([Ball(Vector2D(50, 60.5), Vector2D(-30, 127), 0.87),
+                           Ball(Vector2D(0, 127))], field_info.balls)
+
+    def test_predict(self):
+        moved = self.field_info.predict(0.1)
+        self.assertEquals(Vector2D(47, 80.5), moved.balls[0].pos)
+        self.assertEquals(Vector2D(50, 60.5), self.field_info.balls[0].pos)
+
+class TestFieldHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = FieldHistory()
+        self.field_infos = []
+        for i in xrange(0, 4):
+            frame = make_test_detectionframe()
+            frame.balls[0].x += i
+            for j in xrange(0, i):
+                robot = frame.robots_blue.add()
+                robot.x = j * 10
+                robot.y = i
+                robot.robot_id = j
+                robot.orientation = -j
+
+            field_info = FieldInfo(frame)
+            self.field_infos.append(field_info)
+            self.history.append(field_info, timestamp = i * 0.5)
+
+    def test_round_trip(self):
+        self.assertEquals(4, len(self.history))
+        for i, field_info in enumerate(self.history):
+            expected = self.field_infos[i]
+            self.assertEquals(expected.header, field_info.header)
+            self.assertEquals(expected.robots, field_info.robots)
+            self.assertEquals(expected.balls, field_info.balls)
+            self.assertEquals(expected.pack(), self.history.pack(i))
+
+        self.assertEquals(self.field_infos[-1].robots, self.history[-1].robots)
+        self.assertRaises(IndexError, self.history.__getitem__, 4)
+
+    def test_teams(self):
+        expected = [[robot.team for robot in field_info.robots]
+                    for field_info in self.field_infos]
+        self.assertEquals(set([TEAM_YELLOW, TEAM_BLUE]),
+                          set(expected[-1]))
+        self.assertEquals(expected,
+                          [[robot.team for robot in field_info.robots]
+                           for field_info in self.history])
+        self.assertEquals(expected[2],
+                          [robot.team for robot in self.history[2].robots])
+
+        # Unknown teams stay unknown
+        field_info = FieldInfo()
+        field_info.robots = [RobotInfo(3, 0.0, Vector2D(1, 2))]
+        field_info.balls = []
+        field_info.header = Header(1, 0)
+        self.history.append(field_info)
+        self.assertEquals(None, self.history[-1].robots[0].team)
+
+    def test_iter(self):
+        robots = [(i, robot.id, robot.heading, robot.pos.x, robot.pos.y)
+                  for i, field_info in enumerate(self.field_infos)
+                  for robot in field_info.robots]
+        self.assertEquals(robots, list(self.history.iter_robots()))
+
+        balls = [(i, ball.x, ball.y)
+                 for i, field_info in enumerate(self.field_infos)
+                 for ball in field_info.balls]
+        self.assertEquals(balls, list(self.history.iter_balls()))
+
+    def test_nbytes(self):
+        # 14 robots, 8 balls and 4 frames
+        self.assertEquals(14 * (self.history.robot_ids.itemsize + 3 * 8) +
+                          8 * 2 * 8 + 4 * 8 +
+                          5 * 2 * self.history.robot_start.itemsize +
+                          14 * self.history.robot_teams.itemsize +
+                          (14 + 8) * self.history.robot_frames.itemsize,
+                          self.history.nbytes())
+
+class TestFieldTransform(unittest.TestCase):
+    def setUp(self):
+        field = ssl_wrapper.SSL_WrapperPacket().geometry.field
+        field.field_length = 6050
+        field.field_width = 4050
+        field.boundary_width = 250
+        self.transform = FieldTransform.from_field_size(field)
+
+    def test_corners(self):
+        self.assertEquals((0, 0), self.transform.apply(-3275, -2275))
+        x, y = self.transform.apply(3275, 2275)
+        self.assertAlmostEquals(MAX_PACKED_FLOAT, x)
+        self.assertAlmostEquals(2275 * 127.0 / 3275, y)
+        self.assertAlmostEquals(6550 / 254.0, self.transform.resolution)
+
+    def test_field_info(self):
+        frame = make_test_detectionframe()
+        frame.robots_blue[0].x = 3275
+        field_info = FieldInfo(frame, transform = self.transform)
+
+        x, y = self.transform.apply(frame.balls[0].x, frame.balls[0].y)
+        self.assertEquals(Vector2D(x, y), field_info.balls[0])
+
+        # The blue robot sits on the far boundary, the top of the range
+        data = field_info.pack()
+        self.assertEquals(254, ord(data[Header.PACKED_SIZE +
+                                        RobotInfo.PACKED_SIZE + 3]))
+
+    def test_outside_boundary(self):
+        frame = make_test_detectionframe()
+        frame.robots_yellow[0].x = -5000
+        frame.robots_yellow[0].y = 9000
+        frame.balls[0].x = 4000
+        frame.balls[0].y = -2400
+        field_info = FieldInfo(frame, transform = self.transform)
+
+        # Off the field objects pack as the nearest edge instead of failing
+        unpacked = FieldInfo.unpack(field_info.pack())
+        self.assertEquals(Vector2D(0, MAX_PACKED_FLOAT),
+                          unpacked.robots[0].pos)
+        self.assertEquals(Vector2D(MAX_PACKED_FLOAT, 0), unpacked.balls[0])
+
+        # The default transform only covers part of the field
+        field_info = FieldInfo(frame, X_SHIFT, Y_SHIFT, SCALE)
+        self.assertEquals(Vector2D(0, MAX_PACKED_FLOAT),
+                          FieldInfo.unpack(field_info.pack()).robots[0].pos)
+
+    def test_empty_field(self):
+        field = ssl_wrapper.SSL_WrapperPacket().geometry.field
+        self.assertRaises(ValueError, FieldTransform.from_field_size, field)
+
+class TestDeltaCodec(unittest.TestCase):
+    def setUp(self):
+        self.frame = make_test_detectionframe()
+        self.encoder = DeltaEncoder(keyframe_interval = 3)
+        self.decoder = DeltaDecoder()
+
+    def round_trip(self):
+        field_info = FieldInfo(self.frame)
+        data = self.encoder.encode(field_info)
+        self.assertEquals(field_info.pack(),
+                          self.decoder.decode(data).pack())
+        return data
+
+    def test_key_frame(self):
+        data = self.round_trip()
+        self.assertEquals(DeltaEncoder.KEY_FRAME, ord(data[0]))
+        self.assertEquals(0, ord(data[1]))
+        self.assertEquals(FieldInfo(self.frame).pack(), data[2:])
+
+    def test_unchanged(self):
+        self.round_trip()
+        data = self.round_trip()
+
+        # Just the type, the sequence and the mask
+        self.assertEquals(DeltaEncoder.DELTA_FRAME, ord(data[0]))
+        self.assertEquals(1, ord(data[1]))
+        self.assertEquals(3, len(data))
+
+    def test_changed(self):
+        self.round_trip()
+
+        self.frame.robots_blue[0].orientation += 1
+        self.frame.balls[1].x += 10
+        data = self.round_trip()
+        self.assertEquals(DeltaEncoder.DELTA_FRAME, ord(data[0]))
+        self.assertEquals(0x0a, ord(data[2]))
+        self.assertEquals(3 + RobotInfo.PACKED_SIZE + Vector2D.PACKED_SIZE,
+                          len(data))
+
+    def test_below_quantization(self):
+        self.round_trip()
+        self.frame.balls[0].x += 0.1
+        self.assertEquals(3, len(self.round_trip()))
+
+    def test_no_sync_marker(self):
+        # Enough objects that whole mask bytes change at once
+        for i in xrange(0, 30):
+            ball = self.frame.balls.add()
+            ball.x = i * 10
+            ball.y = 5
+        self.encoder = DeltaEncoder(keyframe_interval = 1000)
+        self.round_trip()
+
+        for step in xrange(1, 300):
+            for ball in self.frame.balls:
+                ball.x += 5
+            for robot in list(self.frame.robots_yellow) + \
+                list(self.frame.robots_blue):
+                robot.x += 5
+            data = self.round_trip()
+            self.assertEquals(DeltaEncoder.DELTA_FRAME, ord(data[0]))
+            self.assertFalse(chr(255) in data)
+
+    def test_missed_frame(self):
+        self.round_trip()
+        self.round_trip()
+
+        # The decoder never sees this delta
+        self.frame.balls[0].x += 10
+        self.encoder.encode(FieldInfo(self.frame))
+
+        self.frame.balls[1].x += 10
+        data = self.encoder.encode(FieldInfo(self.frame))
+        self.assertEquals(DeltaEncoder.DELTA_FRAME, ord(data[0]))
+        self.assertRaises(ValueError, self.decoder.decode, data)
+
+        # Refused until the next key frame puts it right
+        data = self.encoder.encode(FieldInfo(self.frame))
+        self.assertEquals(DeltaEncoder.KEY_FRAME, ord(data[0]))
+        self.assertEquals(FieldInfo(self.frame).pack(),
+                          self.decoder.decode(data).pack())
+
+    def test_missed_key_frame(self):
+        self.encoder = DeltaEncoder(keyframe_interval = 1)
+        self.round_trip()
+        self.round_trip()
+
+        # The decoder never sees the key frame the next delta builds on
+        data = self.encoder.encode(FieldInfo(self.frame))
+        self.assertEquals(DeltaEncoder.KEY_FRAME, ord(data[0]))
+
+        self.frame.balls[0].x += 10
+        data = self.encoder.encode(FieldInfo(self.frame))
+        self.assertEquals(DeltaEncoder.DELTA_FRAME, ord(data[0]))
+        self.assertRaises(ValueError, self.decoder.decode, data)
+
+    def test_sequence_wraps(self):
+        self.encoder = DeltaEncoder(keyframe_interval = 1000)
+        seqs = []
+        for i in xrange(0, DeltaEncoder.SEQ_MODULUS + 2):
+            seqs.append(ord(self.round_trip()[1]))
+        self.assertEquals([253, 254, 0, 1], seqs[-4:])
+
+    def test_count_change(self):
+        self.round_trip()
+        ball = self.frame.balls.add()
+        ball.x = 1
+        ball.y = 2
+        self.assertEquals(DeltaEncoder.KEY_FRAME, ord(self.round_trip()[0]))
+
+    def test_keyframe_interval(self):
+        frame_types = [ord(self.round_trip()[0]) for i in xrange(0, 8)]
+        self.assertEquals([0, 1, 1, 1, 0, 1, 1, 1], frame_types)
+
+    def test_delta_without_key(self):
+        self.encoder.encode(FieldInfo(self.frame))
+        data = self.encoder.encode(FieldInfo(self.frame))
+        self.assertRaises(ValueError, self.decoder.decode, data)
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestArrayFieldInfo(unittest.TestCase):
+    def setUp(self):
+        self.frame = make_test_detectionframe()
+
+        # Headings which exercise the wrap around and the sign byte
+        robot = self.frame.robots_yellow.add()
+        robot.x = 120
+        robot.y = 7.25
+        robot.robot_id = 2
+        robot.orientation = -math.pi * 1.7
+
+        robot = self.frame.robots_blue.add()
+        robot.x = 0
+        robot.y = 500
+        robot.robot_id = 300
+        robot.orientation = math.pi * 5.25
+
+    def test_compress_float_array(self):
+        nums = [-50.0, -0.2, 0, 0.25, 0.75, 2.5, 5.0, 117.8, 127.0, 300.0]
+        expected = [compress_float(num) for num in nums]
+        self.assertEquals(expected, list(compress_float_array(nums)))
+
+    def test_encode_angle_array(self):
+        angles = [i * 0.37 - 10.0 for i in xrange(0, 60)]
+        signs, mags = encode_angle_array(angles)
+        self.assertEquals([encode_angle(angle) for angle in angles],
+                          zip(signs, mags))
+
+    def test_pack_matches_field_info(self):
+        expected = FieldInfo(self.frame, 12.5, 3.0, 0.1).pack()
+        array_field_info = ArrayFieldInfo(self.frame, 12.5, 3.0, 0.1)
+        self.assertEquals(expected, array_field_info.pack())
+
+    def test_empty(self):
+        frame = ssl_detection.SSL_DetectionFrame()
+        self.assertEquals(FieldInfo(frame).pack(),
+                          ArrayFieldInfo(frame).pack())
+
+    def test_transform(self):
+        transform = FieldTransform(12.5, 3.0, 0.1)
+        self.assertEquals(FieldInfo(self.frame, transform = transform).pack(),
+                          ArrayFieldInfo(self.frame,
+                                         transform = transform).pack())
+
+    def test_decode_tables(self):
+        raws = numpy.arange(0, 256, dtype = numpy.uint8)
+        self.assertEquals([uncompress_float(raw) for raw in xrange(0, 256)],
+                          list(uncompress_float_array(raws)))
+        for sign in (0, 1, 7):
+            self.assertEquals(
+                [decode_angle(sign, raw) for raw in xrange(0, 256)],
+                list(decode_angle_array([sign] * 256, raws)))
+
+    def test_unpack(self):
+        data = 'xx' + FieldInfo(self.frame, 12.5, 3.0, 0.1).pack()
+        expected = FieldInfo.unpack(data, 2)
+        array_field_info = ArrayFieldInfo.unpack(data, 2)
+
+        self.assertEquals(expected.pack(), array_field_info.pack())
+        field_info = array_field_info.to_field_info()
+        self.assertEquals(expected.robots, field_info.robots)
+        self.assertEquals(expected.balls, field_info.balls)
+
+    def test_to_field_info(self):
+        field_info = ArrayFieldInfo(self.frame).to_field_info()
+        self.assertEquals(FieldInfo(self.frame).pack(), field_info.pack())
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+# Standard Imports
+import time
+import unittest
+
+
+__doc__ = """
+Paces writes to slow links (the 9600 baud bluetooth serial ports) so each
+brick gets the freshest frame its link can carry, instead of queuing up
+frames it can't send in time.
+"""
+
+# Start bit, 8 data bits and a stop bit for every byte on a 8N1 serial link
+SERIAL_BITS_PER_BYTE = 10
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class TokenBucket(object):
+    """
+    Byte token bucket which refills at rate bytes per second, up to burst
+    bytes.  A send may overdraw the bucket, the next one then has to wait for
+    the debt to be paid off, so frames larger than the burst still go out.
+    """
+
+    def __init__(self, rate, burst, clock = time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self):
+        """
+        Seconds until the next send is allowed (0 if it can go now)
+        """
+        self._refill()
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+    def consume(self, size):
+        self._refill()
+        self._tokens -= size
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = float(rate)
+
+class LinkPacer(object):
+    """
+    Measures the throughput and write latency of a link and paces sends to
+    its capacity.  The send rate is the baud rate derived byte rate, lowered
+    to the throughput actually observed if the link can't keep up.
+    """
+
+    def __init__(self, baudrate, bits_per_byte = SERIAL_BITS_PER_BYTE,
+                 burst_time = 0.05, smoothing = 0.2, clock = time.time):
+        self.link_rate = float(baudrate) / bits_per_byte
+        self.bucket = TokenBucket(self.link_rate,
+                                  self.link_rate * burst_time, clock)
+        self._smoothing = smoothing
+        self._clock = clock
+
+        # Measurements
+        self.throughput = self.link_rate
+        self.write_latency = 0.0
+        self.bytes_written = 0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self._start = clock()
+
+    def delay(self):
+        """
+        Seconds to wait before the next frame can be sent
+        """
+        return self.bucket.delay()
+
+    def record_write(self, size, elapsed):
+        """
+        Records that size bytes took elapsed seconds to write out, and
+        adjusts the send rate to match
+        """
+        self.bucket.consume(size)
+        self.bytes_written += size
+        self.frames_sent += 1
+
+        alpha = self._smoothing
+        self.write_latency += alpha * (elapsed - self.write_latency)
+        if elapsed > 0:
+            observed = min(self.link_rate, size / elapsed)
+            self.throughput += alpha * (observed - self.throughput)
+        else:
+            self.throughput += alpha * (self.link_rate - self.throughput)
+
+        self.bucket.set_rate(self.throughput)
+
+    def record_skip(self):
+        """
+        Records a frame dropped because a newer one came in while waiting
+        """
+        self.frames_skipped += 1
+
+    def stats_line(self):
+        elapsed = max(1e-6, self._clock() - self._start)
+        return "%.1f B/s achieved (%.1f B/s pace) %.1f ms write, " \
+            "%d frames sent %d skipped" % \
+            (self.bytes_written / elapsed, self.bucket.rate,
+             self.write_latency * 1000, self.frames_sent, self.frames_skipped)
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(100, 10, self.clock)
+
+    def test_burst(self):
+        self.assertEquals(0, self.bucket.delay())
+        self.bucket.consume(10)
+        self.assertEquals(0, self.bucket.delay())
+
+    def test_debt(self):
+        self.bucket.consume(30)
+        self.assertAlmostEquals(0.2, self.bucket.delay())
+
+        self.clock.now = 0.1
+        self.assertAlmostEquals(0.1, self.bucket.delay())
+
+        self.clock.now = 0.2
+        self.assertEquals(0, self.bucket.delay())
+
+    def test_burst_cap(self):
+        self.clock.now = 100
+        self.bucket.consume(20)
+        self.assertAlmostEquals(0.1, self.bucket.delay())
+
+class TestLinkPacer(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pacer = LinkPacer(9600, clock = self.clock, smoothing = 1.0)
+
+    def test_link_rate(self):
+        self.assertEquals(960, self.pacer.link_rate)
+
+        self.pacer.record_write(96, 0.0)
+        self.assertAlmostEquals(0.1 - 0.05, self.pacer.delay())
+
+    def test_slow_link(self):
+        self.pacer.record_write(96, 0.2)
+        self.assertEquals(480, self.pacer.throughput)
+        self.assertEquals(0.2, self.pacer.write_latency)
+        self.assertEquals(480, self.pacer.bucket.rate)
+
+    def test_fast_write(self):
+        self.pacer.record_write(96, 0.001)
+        self.assertEquals(960, self.pacer.throughput)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# Standard Imports
+import struct
+import unittest
+
+
+__doc__ = """
+Minimal protocol buffer wire format reading.  It walks the fields of an
+encoded message in place, so large or frequent messages can be split up or
+inspected without running the full protobuf parser over them.
+"""
+
+# Wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def decode_varint(data, offset = 0):
+    """
+    Decodes the varint at offset, returns the value and the offset just past
+    it.  Raises ValueError if the data ends in the middle of it.
+    """
+    value = 0
+    shift = 0
+    end = len(data)
+    while offset < end:
+        byte = ord(data[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+    raise ValueError("Truncated varint")
+
+def read_field(data, offset, end):
+    """
+    Reads the field starting at offset, returns (field_number, wire_type,
+    value, next_offset).  For varints value is the decoded number, for every
+    other wire type it is the (start, end) offsets of the field's bytes in
+    data.  Raises ValueError on malformed data.
+    """
+    key, offset = decode_varint(data, offset)
+    field_number = key >> 3
+    wire_type = key & 0x7
+
+    if wire_type == WIRE_VARINT:
+        value, offset = decode_varint(data, offset)
+    else:
+        if wire_type == WIRE_LENGTH_DELIMITED:
+            size, offset = decode_varint(data, offset)
+        elif wire_type == WIRE_FIXED64:
+            size = 8
+        elif wire_type == WIRE_FIXED32:
+            size = 4
+        else:
+            raise ValueError("Unsupported wire type: %d" % wire_type)
+
+        if offset + size > end:
+            raise ValueError("Truncated field %d" % field_number)
+        value = (offset, offset + size)
+        offset += size
+
+    return field_number, wire_type, value, offset
+
+def iter_fields(data, offset = 0, end = None):
+    """
+    Yields (field_number, wire_type, value) for every field of the message
+    encoded in data[offset:end], see read_field
+    """
+    if end is None:
+        end = len(data)
+
+    while offset < end:
+        field_number, wire_type, value, offset = read_field(data, offset, end)
+        yield field_number, wire_type, value
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestWire(unittest.TestCase):
+    def test_decode_varint(self):
+        self.assertEquals((1, 1), decode_varint('\x01'))
+        self.assertEquals((300, 3), decode_varint('x\xac\x02', 1))
+        self.assertRaises(ValueError, decode_varint, '\xac')
+
+    def test_iter_fields(self):
+        # 1: varint 150, 2: "ab", 3: fixed32, 4: fixed64
+        data = '\x08\x96\x01' + '\x12\x02ab' + '\x1d' + struct.pack('<f', 1) +\
+               '\x21' + struct.pack('<d', 2)
+        fields = list(iter_fields(data))
+
+        self.assertEquals((1, WIRE_VARINT, 150), fields[0])
+        self.assertEquals((2, WIRE_LENGTH_DELIMITED, (5, 7)), fields[1])
+        self.assertEquals('ab', data[5:7])
+        self.assertEquals((3, WIRE_FIXED32, (8, 12)), fields[2])
+        self.assertEquals((4, WIRE_FIXED64, (13, 21)), fields[3])
+
+    def test_read_field(self):
+        data = 'xx\x08\x96\x01\x12\x02ab'
+        self.assertEquals((1, WIRE_VARINT, 150, 5), read_field(data, 2, 9))
+        self.assertEquals((2, WIRE_LENGTH_DELIMITED, (7, 9), 9),
+                          read_field(data, 5, 9))
+        self.assertRaises(ValueError, read_field, data, 5, 8)
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, list, iter_fields('\x12\x05ab'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+# Standard Imports
+import struct
+import unittest
+
+# Project Imports
+import pbwire
+import proto.messages_robocup_ssl_wrapper_pb2 as ssl_wrapper
+
+
+__doc__ = """
+Decides which SSL_WrapperPackets are worth parsing by reading their raw
+bytes.  Only the top level field tags of the wrapper and the frame_number,
+t_capture and camera_id at the front of the detection frame are read, which
+is far cheaper than running the protobuf parser over the whole packet.
+"""
+
+# Field numbers of SSL_WrapperPacket
+WRAPPER_DETECTION_FIELD = 1
+WRAPPER_GEOMETRY_FIELD = 2
+
+# Field numbers of SSL_DetectionFrame, the balls and robots follow these
+FRAME_NUMBER_FIELD = 1
+T_CAPTURE_FIELD = 2
+CAMERA_ID_FIELD = 4
+
+DOUBLE = struct.Struct('<d')
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def peek_wrapper(data):
+    """
+    Returns the (start, end) byte ranges of the detection and geometry
+    fields of the encoded wrapper packet, None for the ones it doesn't have.
+    Raises ValueError on malformed data.
+    """
+    detection = None
+    geometry = None
+    for field_number, wire_type, value in pbwire.iter_fields(data):
+        if wire_type != pbwire.WIRE_LENGTH_DELIMITED:
+            continue
+        if field_number == WRAPPER_DETECTION_FIELD:
+            detection = value
+        elif field_number == WRAPPER_GEOMETRY_FIELD:
+            geometry = value
+    return detection, geometry
+
+def peek_detection(data, start, end):
+    """
+    Reads the leading fields of the detection frame encoded in
+    data[start:end].  Returns (camera_id, frame_number, t_capture,
+    objects_start) where objects_start is the offset the balls and robots
+    begin at, or None if they came before camera_id (protobuf writes fields
+    in number order, so that only happens with odd encoders).
+    """
+    camera_id = 0
+    frame_number = 0
+    t_capture = 0.0
+
+    offset = start
+    while offset < end:
+        field_number, wire_type, value, next_offset = \
+            pbwire.read_field(data, offset, end)
+        if field_number > CAMERA_ID_FIELD:
+            return camera_id, frame_number, t_capture, offset
+
+        if field_number == FRAME_NUMBER_FIELD:
+            frame_number = value
+        elif field_number == T_CAPTURE_FIELD and \
+             wire_type == pbwire.WIRE_FIXED64:
+            t_capture = DOUBLE.unpack_from(data, value[0])[0]
+        elif field_number == CAMERA_ID_FIELD:
+            camera_id = value
+        offset = next_offset
+
+    return camera_id, frame_number, t_capture, offset
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class WrapperPrefilter(object):
+    """
+    Picks out the parts of a batch of datagrams which need parsing:
+
+     - only the newest frame of each camera in a batch, the older ones would
+       be replaced straight away downstream (superseded)
+     - repeats of the last frame_number seen from a camera are dropped
+       (duplicate)
+
+    Those frames carry nothing new, nothing downstream sees a difference.
+    With skip_unchanged it also drops frames which do carry news, trading
+    them for less parsing:
+
+     - frames whose balls and robots are byte for byte the same as the last
+       one passed on from that camera are dropped (unchanged), but one is
+       still let through every refresh_interval seconds of capture time so
+       the frame merger keeps the camera alive
+     - geometry is only passed on when it differs from the last one
+    """
+
+    def __init__(self, skip_unchanged = False, refresh_interval = 0.1):
+        self._skip_unchanged = skip_unchanged
+        self._refresh_interval = refresh_interval
+        self._last_frame_number = {}
+        self._last_objects = {}
+        self._last_t_capture = {}
+        self._last_geometry = None
+
+        # Counters
+        self.datagrams = 0
+        self.parsed = 0
+        self.duplicates = 0
+        self.unchanged = 0
+        self.superseded = 0
+        self.geometry_repeats = 0
+        self.malformed = 0
+
+    def select(self, datagrams):
+        """
+        Returns a list of (data, detection, geometry) for the datagrams in
+        the batch which have something to parse, where detection and
+        geometry are the (start, end) byte ranges of the fields to parse or
+        None.  data is a memoryview over the datagram.
+        """
+        peeked = []
+        newest = {}
+        for data in datagrams:
+            self.datagrams += 1
+            view = memoryview(data)
+            try:
+                detection, geometry = peek_wrapper(view)
+                info = None
+                if detection is not None:
+                    info = peek_detection(view, *detection)
+                    newest[info[0]] = len(peeked)
+            except ValueError:
+                self.malformed += 1
+                continue
+            peeked.append((view, detection, geometry, info))
+
+        selected = []
+        for i, (view, detection, geometry, info) in enumerate(peeked):
+            if geometry is not None and self._skip_unchanged and \
+               not self._geometry_changed(view, geometry):
+                geometry = None
+
+            if detection is not None:
+                if newest[info[0]] != i:
+                    self.superseded += 1
+                    detection = None
+                elif not self._detection_changed(view, detection, info):
+                    detection = None
+
+            if detection is not None or geometry is not None:
+                self.parsed += 1
+                selected.append((view, detection, geometry))
+
+        return selected
+
+    def _geometry_changed(self, view, geometry):
+        start, end = geometry
+        if self._last_geometry is not None and \
+           view[start:end] == self._last_geometry:
+            self.geometry_repeats += 1
+            return False
+        self._last_geometry = view[start:end].tobytes()
+        return True
+
+    def _detection_changed(self, view, detection, info):
+        camera_id, frame_number, t_capture, objects_start = info
+        if self._last_frame_number.get(camera_id, None) == frame_number:
+            self.duplicates += 1
+            return False
+        self._last_frame_number[camera_id] = frame_number
+        if not self._skip_unchanged:
+            return True
+
+        objects = view[objects_start:detection[1]]
+        last_objects = self._last_objects.get(camera_id, None)
+        last_t_capture = self._last_t_capture.get(camera_id, None)
+        if last_objects is not None and objects == last_objects and \
+           t_capture - last_t_capture < self._refresh_interval:
+            self.unchanged += 1
+            return False
+
+        self._last_objects[camera_id] = objects.tobytes()
+        self._last_t_capture[camera_id] = t_capture
+        return True
+
+    def stats_line(self):
+        skipped = self.datagrams - self.parsed
+        return "prefilter: %d datagrams %d parsed (%.1f%% skipped), " \
+            "%d superseded %d duplicate %d unchanged %d geometry repeats " \
+            "%d malformed" % \
+            (self.datagrams, self.parsed,
+             100.0 * skipped / max(1, self.datagrams), self.superseded,
+             self.duplicates, self.unchanged, self.geometry_repeats,
+             self.malformed)
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+def make_wrapper(camera_id, frame_number, t_capture, ball_x = 1.0,
+                 geometry_length = None):
+    packet = ssl_wrapper.SSL_WrapperPacket()
+    frame = packet.detection
+    frame.frame_number = frame_number
+    frame.t_capture = t_capture
+    frame.t_sent = t_capture + 0.001
+    frame.camera_id = camera_id
+
+    ball = frame.balls.add()
+    ball.confidence = 1
+    ball.x = ball_x
+    ball.y = 2
+    ball.pixel_x = ball.pixel_y = 0
+
+    if geometry_length is not None:
+        field = packet.geometry.field
+        for name in ('line_width', 'field_length', 'field_width',
+                     'boundary_width', 'referee_width', 'goal_width',
+                     'goal_depth', 'goal_wall_width', 'center_circle_radius',
+                     'defense_radius', 'defense_stretch',
+                     'free_kick_from_defense_dist',
+                     'penalty_spot_from_field_line_dist',
+                     'penalty_line_from_spot_dist'):
+            setattr(field, name, 10)
+        field.field_length = geometry_length
+
+    return packet.SerializeToString()
+
+class TestPrefilter(unittest.TestCase):
+    def setUp(self):
+        self.prefilter = WrapperPrefilter(skip_unchanged = True,
+                                          refresh_interval = 0.1)
+
+    def selected_frames(self, datagrams):
+        results = []
+        for view, detection, geometry in self.prefilter.select(datagrams):
+            if detection is not None:
+                results.append(peek_detection(view, *detection)[:2])
+        return results
+
+    def test_peek(self):
+        data = make_wrapper(3, 77, 12.5, geometry_length = 6050)
+        detection, geometry = peek_wrapper(data)
+        packet = ssl_wrapper.SSL_WrapperPacket.FromString(data)
+
+        self.assertEquals(packet.detection.SerializeToString(),
+                          data[detection[0]:detection[1]])
+        self.assertEquals(packet.geometry.SerializeToString(),
+                          data[geometry[0]:geometry[1]])
+        self.assertEquals((3, 77, 12.5),
+                          peek_detection(data, *detection)[:3])
+
+    def test_superseded(self):
+        batch = [make_wrapper(0, 1, 0.0), make_wrapper(1, 1, 0.0),
+                 make_wrapper(0, 2, 0.01, ball_x = 5)]
+        self.assertEquals([(1, 1), (0, 2)], self.selected_frames(batch))
+        self.assertEquals(1, self.prefilter.superseded)
+
+    def test_duplicate(self):
+        self.selected_frames([make_wrapper(0, 1, 0.0)])
+        self.assertEquals([], self.selected_frames([make_wrapper(0, 1, 0.0)]))
+        self.assertEquals(1, self.prefilter.duplicates)
+
+    def test_unchanged(self):
+        frames = [self.selected_frames([make_wrapper(0, i, i * 0.03)])
+                  for i in xrange(0, 6)]
+        self.assertEquals([[(0, 0)], [], [], [], [(0, 4)], []], frames)
+        self.assertEquals(4, self.prefilter.unchanged)
+
+        moved = make_wrapper(0, 6, 0.18, ball_x = 3)
+        self.assertEquals([(0, 6)], self.selected_frames([moved]))
+
+    def test_keep_unchanged(self):
+        # By default only the redundant frames go
+        self.prefilter = WrapperPrefilter()
+        frames = [self.selected_frames([make_wrapper(0, i, i * 0.03)])
+                  for i in xrange(0, 3)]
+        self.assertEquals([[(0, 0)], [(0, 1)], [(0, 2)]], frames)
+        self.assertEquals([], self.selected_frames([make_wrapper(0, 2, 0.06)]))
+        self.assertEquals(0, self.prefilter.unchanged)
+        self.assertEquals(1, self.prefilter.duplicates)
+
+        geometry = make_wrapper(0, 2, 0.06, geometry_length = 6050)
+        for i in xrange(0, 2):
+            self.assertNotEquals(None, self.prefilter.select([geometry])[0][2])
+        self.assertEquals(0, self.prefilter.geometry_repeats)
+
+    def test_geometry(self):
+        first = make_wrapper(0, 1, 0.0, geometry_length = 6050)
+        repeat = make_wrapper(0, 1, 0.0, geometry_length = 6050)
+        changed = make_wrapper(0, 1, 0.0, geometry_length = 7000)
+
+        self.assertNotEquals(None, self.prefilter.select([first])[0][2])
+        self.assertEquals([], self.prefilter.select([repeat]))
+        self.assertNotEquals(None, self.prefilter.select([changed])[0][2])
+        self.assertEquals(1, self.prefilter.geometry_repeats)
+
+    def test_malformed(self):
+        self.assertEquals([], self.prefilter.select(['\x0a\x05ab']))
+        self.assertEquals(1, self.prefilter.malformed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,573 @@
+# Python Imports
+import os
+import select
+import errno
+import fcntl
+import heapq
+import time
+import threading
+import unittest
+import collections
+
+
+__doc__ = """
+A small single threaded event loop built on poll.  It lets one thread serve
+the multicast socket, the inotify watch and every output port, instead of
+running a thread per consumer.  The loop can also run on a thread of its
+own (ReactorThread), so one writer thread serves every output port while
+the rest of the server blocks elsewhere.
+"""
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def fileno(obj):
+    """
+    Returns the file descriptor for the given file like object or fd
+    """
+    if isinstance(obj, (int, long)):
+        return obj
+    return obj.fileno()
+
+def set_nonblocking(fd):
+    """
+    Puts the file descriptor into non blocking mode
+    """
+    fd = fileno(fd)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def write_nonblocking(fd, data):
+    """
+    Writes as much of data as the descriptor will take right now, returns the
+    number of bytes written
+    """
+    try:
+        return os.write(fd, data)
+    except OSError, e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return 0
+        raise
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class Timer(object):
+    """
+    Handle for a callback scheduled with Reactor.call_later
+    """
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+class Reactor(object):
+    """
+    Calls back readers and writers when their file descriptors are ready, and
+    runs callbacks queued with call_soon and call_later.  Everything except
+    call_soon_threadsafe must be called from the thread running the loop.
+    """
+
+    READ = select.POLLIN | select.POLLPRI
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def __init__(self):
+        self._poller = select.poll()
+        self._readers = {}
+        self._writers = {}
+        self._masks = {}
+        self._ready = collections.deque()
+        self._timers = []
+        self._running = False
+
+        # Other threads wake the poll up by writing to this pipe
+        self._wake_read, self._wake_write = os.pipe()
+        set_nonblocking(self._wake_read)
+        set_nonblocking(self._wake_write)
+        self.add_reader(self._wake_read, self._drain_wakeup)
+
+    def add_reader(self, fd, callback, *args):
+        """
+        Calls callback(*args) whenever fd is readable (or has an error)
+        """
+        fd = fileno(fd)
+        self._readers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        fd = fileno(fd)
+        if self._readers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def add_writer(self, fd, callback, *args):
+        """
+        Calls callback(*args) whenever fd is writable
+        """
+        fd = fileno(fd)
+        self._writers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        fd = fileno(fd)
+        if self._writers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def call_soon(self, callback, *args):
+        """
+        Runs callback(*args) on the next pass through the loop
+        """
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Like call_soon, but safe to call from any thread
+        """
+        self._ready.append((callback, args))
+        self.wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Runs callback(*args) after delay seconds, returns a cancelable Timer
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def wakeup(self):
+        """
+        Breaks the loop out of its current poll
+        """
+        write_nonblocking(self._wake_write, 'x')
+
+    def run(self):
+        """
+        Runs the loop until stop is called
+        """
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def run_once(self, timeout = None):
+        """
+        Waits for events once (at most timeout seconds) and dispatches them
+        """
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            delay = max(0, self._timers[0].when - time.time())
+            if timeout is None or delay < timeout:
+                timeout = delay
+
+        # Poll wants milliseconds, and a negative number to block forever
+        if timeout is None:
+            poll_timeout = -1
+        else:
+            poll_timeout = int(timeout * 1000)
+
+        try:
+            events = self._poller.poll(poll_timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        for fd, event in events:
+            if event & (self.READ | self.ERROR) and fd in self._readers:
+                callback, args = self._readers[fd]
+                callback(*args)
+            if event & (self.WRITE | self.ERROR) and fd in self._writers:
+                callback, args = self._writers[fd]
+                callback(*args)
+
+        # Expired timers
+        now = time.time()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._ready.append((timer.callback, timer.args))
+
+        # Only run what is queued now, callbacks may queue more for next time
+        for i in xrange(0, len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+    def stop(self):
+        """
+        Makes run return after the current pass, safe from any thread
+        """
+        self._running = False
+        self.wakeup()
+
+    def close(self):
+        self.remove_reader(self._wake_read)
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _update(self, fd):
+        mask = 0
+        if fd in self._readers:
+            mask |= self.READ
+        if fd in self._writers:
+            mask |= self.WRITE
+
+        if mask:
+            if fd in self._masks:
+                self._poller.modify(fd, mask)
+            else:
+                self._poller.register(fd, mask)
+            self._masks[fd] = mask
+        elif fd in self._masks:
+            self._poller.unregister(fd)
+            del self._masks[fd]
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+class ReactorThread(threading.Thread):
+    """
+    Runs a Reactor on its own thread.  Other threads may only hand it work
+    with reactor.call_soon_threadsafe.
+    """
+
+    def __init__(self, name = 'reactor'):
+        threading.Thread.__init__(self, name = name)
+        self.daemon = True
+        self.reactor = Reactor()
+
+    def run(self):
+        self.reactor.run()
+
+    def stop(self):
+        self.reactor.stop()
+        self.join()
+        self.reactor.close()
+
+class PortWriter(object):
+    """
+    Writes whole frames to a file or serial port without blocking.  Whatever
+    the port won't take right away is queued and sent when poll says it is
+    writable, with everything queued going out in one write.
+
+    If max_buffer is set, the queue is kept to about that many bytes by
+    dropping the oldest frames which haven't started going out.  A frame is
+    never cut short once its first byte is written, so the receiver always
+    sees whole frames starting with their sync marker, and the newest frame
+    is always kept.  A max_buffer of 0 keeps just the newest frame waiting
+    behind the one going out.  Only use it for frames which stand on their
+    own, dropping one from a delta stream (see messages.DeltaEncoder) would
+    leave the reader on the wrong base until the next key frame.
+
+    Write errors are raised, unless on_error is given, then the writer is
+    closed and on_error(error) called instead.
+    """
+
+    def __init__(self, reactor, port, on_drained = None, max_buffer = None,
+                 on_error = None):
+        self._reactor = reactor
+        self._port = port
+        self._fd = fileno(port)
+        self._frames = collections.deque()
+        # Bytes of the first frame already written, and of all the frames
+        self._offset = 0
+        self._queued = 0
+        self._on_drained = on_drained
+        self._on_error = on_error
+        self.max_buffer = max_buffer
+
+        # Counters
+        self.bytes_written = 0
+        self.writes = 0
+        self.frames_dropped = 0
+
+        set_nonblocking(self._fd)
+
+    def pending(self):
+        """
+        Number of bytes still waiting to be written
+        """
+        return self._queued - self._offset
+
+    def full(self):
+        """
+        True when another frame would push out a queued one, without a
+        max_buffer that is whenever anything is still waiting
+        """
+        if self.max_buffer is None:
+            return self.pending() > 0
+        return self.pending() >= self.max_buffer
+
+    def write(self, frame):
+        self._frames.append(frame)
+        self._queued += len(frame)
+        if len(self._frames) == 1:
+            try:
+                drained = self._flush()
+            except OSError, e:
+                if self._on_error is None:
+                    raise
+                self._failed(e)
+                return
+            if not drained:
+                self._reactor.add_writer(self._fd, self._on_writable)
+        elif self.max_buffer is not None:
+            self._trim()
+
+    def close(self):
+        self._reactor.remove_writer(self._fd)
+        self._frames.clear()
+        self._offset = 0
+        self._queued = 0
+
+    def stats_line(self):
+        return "writer: %d bytes in %d writes, %d pending, %d frames " \
+            "dropped" % (self.bytes_written, self.writes, self.pending(),
+                         self.frames_dropped)
+
+    def _trim(self):
+        # The first frame can't go once it has been partly written
+        first = 0
+        if self._offset:
+            first = 1
+
+        while self.pending() > self.max_buffer and \
+              len(self._frames) - first > 1:
+            frame = self._frames[first]
+            del self._frames[first]
+            self._queued -= len(frame)
+            self.frames_dropped += 1
+
+    def _flush(self):
+        """
+        Writes as much of the queue as the port takes, returns True once
+        the queue is empty
+        """
+        if len(self._frames) == 1:
+            data = self._frames[0]
+        else:
+            data = ''.join(self._frames)
+        sent = write_nonblocking(self._fd, buffer(data, self._offset))
+        self.bytes_written += sent
+        self.writes += 1
+
+        # Forget the frames which are all the way out
+        sent += self._offset
+        while self._frames and sent >= len(self._frames[0]):
+            frame = self._frames.popleft()
+            sent -= len(frame)
+            self._queued -= len(frame)
+        self._offset = sent
+
+        return not self._frames
+
+    def _failed(self, error):
+        self.close()
+        self._on_error(error)
+
+    def _on_writable(self):
+        try:
+            drained = self._flush()
+        except OSError, e:
+            if self._on_error is None:
+                raise
+            self._failed(e)
+            return
+
+        if drained:
+            self._reactor.remove_writer(self._fd)
+            if self._on_drained is not None:
+                self._on_drained()
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestReactor(unittest.TestCase):
+    def setUp(self):
+        self.reactor = Reactor()
+        self.calls = []
+        self.read_fd, self.write_fd = os.pipe()
+
+    def tearDown(self):
+        self.reactor.close()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def record(self, *args):
+        self.calls.append(args)
+
+    def test_call_soon(self):
+        def queue_more():
+            self.record('more')
+            self.reactor.call_soon(self.record, 'next pass')
+
+        self.reactor.call_soon(self.record, 1)
+        self.reactor.call_soon(queue_more)
+        self.reactor.call_soon(self.record, 2, 3)
+        self.reactor.run_once(0)
+        self.assertEquals([(1,), ('more',), (2, 3)], self.calls)
+
+        # Queued callbacks don't let the poll block
+        self.reactor.run_once()
+        self.assertEquals(('next pass',), self.calls[-1])
+
+    def test_call_later(self):
+        self.reactor.call_later(0.03, self.record, 3)
+        self.reactor.call_later(0.01, self.record, 1)
+        self.reactor.call_later(0.02, self.record, 2)
+        self.reactor.call_later(0.015, self.record, 'cancelled').cancel()
+
+        self.reactor.run_once(0)
+        self.assertEquals([], self.calls)
+
+        start = time.time()
+        while len(self.calls) < 3 and time.time() - start < 1:
+            self.reactor.run_once()
+        self.assertEquals([(1,), (2,), (3,)], self.calls)
+        self.assertTrue(time.time() - start >= 0.02)
+
+    def test_call_soon_threadsafe(self):
+        thread = ReactorThread()
+        thread.start()
+        try:
+            done = threading.Event()
+            ran_on = []
+            def callback():
+                ran_on.append(threading.current_thread())
+                done.set()
+
+            # The loop is blocked in poll with nothing to do until woken
+            time.sleep(0.01)
+            thread.reactor.call_soon_threadsafe(callback)
+            done.wait(1)
+            self.assertEquals([thread], ran_on)
+        finally:
+            thread.stop()
+        self.assertFalse(thread.is_alive())
+
+    def test_reader(self):
+        self.reactor.add_reader(self.read_fd, self.record, 'read')
+        self.reactor.run_once(0)
+        self.assertEquals([], self.calls)
+
+        os.write(self.write_fd, 'x')
+        self.reactor.run_once(0)
+        self.assertEquals([('read',)], self.calls)
+
+        self.reactor.remove_reader(self.read_fd)
+        self.reactor.run_once(0)
+        self.assertEquals([('read',)], self.calls)
+
+    def test_writer(self):
+        self.reactor.add_writer(self.write_fd, self.record, 'write')
+        self.reactor.add_reader(self.read_fd, self.record, 'read')
+        self.reactor.run_once(0)
+        self.assertEquals([('write',)], self.calls)
+
+        # Both on one pass once there is data to read
+        os.write(self.write_fd, 'x')
+        self.reactor.run_once(0)
+        self.assertEquals(set([('read',), ('write',)]), set(self.calls[1:]))
+
+        self.reactor.remove_writer(self.write_fd)
+        self.reactor.remove_reader(self.read_fd)
+        self.reactor.run_once(0)
+        self.assertEquals(3, len(self.calls))
+
+class TestPortWriter(unittest.TestCase):
+    def setUp(self):
+        self.reactor = Reactor()
+        self.read_fd, self.write_fd = os.pipe()
+        self.drained = []
+        self.writer = PortWriter(self.reactor, self.write_fd,
+                                 on_drained = lambda: self.drained.append(1),
+                                 max_buffer = 20)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reactor.close()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def fill_pipe(self):
+        # Returns how much went in before the pipe stopped taking more
+        filled = 0
+        while True:
+            sent = write_nonblocking(self.write_fd, 'x' * 4096)
+            if sent == 0:
+                return filled
+            filled += sent
+
+    def read_all(self):
+        set_nonblocking(self.read_fd)
+        data = ''
+        while True:
+            try:
+                chunk = os.read(self.read_fd, 65536)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                return data
+            data += chunk
+
+    def test_direct(self):
+        self.writer.write('\xff\xffabc')
+        self.assertEquals(0, self.writer.pending())
+        self.assertEquals('\xff\xffabc', self.read_all())
+
+    def test_drop_whole_frames(self):
+        filled = self.fill_pipe()
+        frames = ['\xff\xff%08d' % i for i in xrange(0, 5)]
+        for frame in frames:
+            self.writer.write(frame)
+
+        # Only the two newest frames fit
+        self.assertEquals(3, self.writer.frames_dropped)
+        self.assertEquals(20, self.writer.pending())
+        self.assertTrue(self.writer.full())
+
+        self.assertEquals(filled, len(self.read_all()))
+        self.reactor.run_once(0)
+        self.assertEquals(''.join(frames[-2:]), self.read_all())
+        self.assertEquals([1], self.drained)
+
+    def test_partial_frame_kept(self):
+        # Leave room in the pipe for part of the first frame
+        filled = self.fill_pipe()
+        os.read(self.read_fd, 4096)
+        frame = '\xff\xff' + 'a' * 4200
+        self.writer.write(frame)
+        started = len(frame) - self.writer.pending()
+        self.assertTrue(0 < started < len(frame))
+
+        self.writer.write('\xff\xffb')
+        self.writer.write('\xff\xffc')
+        self.assertEquals(1, self.writer.frames_dropped)
+
+        data = ''
+        while self.writer.pending():
+            data += self.read_all()
+            self.reactor.run_once(0)
+        data += self.read_all()
+        self.assertEquals(frame + '\xff\xffc',
+                          data[filled - 4096:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+# Python Imports
+import os
+import time
+import errno
+import struct
+import socket
+import tempfile
+import unittest
+
+
+__doc__ = """
+Multicast socket helpers and batched datagram receiving.  Bursts of packets
+(ssl-vision sends one per camera back to back) are pulled off the socket in
+one go into a ring of preallocated buffers, instead of allocating a new
+string per datagram.
+"""
+
+# Largest datagram we expect from ssl-vision
+MAX_DATAGRAM_SIZE = 1500
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def open_mcast_socket(ip_addr_str, port, rcvbuf = None):
+    """
+    Opens a UDP socket which has joined the given multicast group
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind(('', port))
+    mreq = struct.pack("=4sl", socket.inet_aton(ip_addr_str), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
+
+def open_mcast_sender(ttl = 1, loop = True):
+    """
+    Opens a UDP socket for sending to multicast groups, with the given time
+    to live and loop back to this host turned on or off
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                    struct.pack('b', ttl))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP,
+                    struct.pack('b', int(loop)))
+    return sock
+
+def read_udp_drops(sock, proc_files = ('/proc/net/udp', '/proc/net/udp6')):
+    """
+    Returns the number of datagrams the kernel dropped for this socket
+    (because its receive buffer was full), or None if it can't be found.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+
+    for proc_file in proc_files:
+        try:
+            lines = open(proc_file).readlines()
+        except IOError:
+            continue
+
+        # Columns: sl local rem st queues tr retrnsmt uid timeout inode ref
+        #          pointer drops
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) >= 13 and fields[9] == inode:
+                return int(fields[12])
+
+    return None
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class DatagramReceiver(object):
+    """
+    Receives up to batch_size datagrams per call into reused buffers
+    """
+
+    def __init__(self, sock, batch_size = 64, max_size = MAX_DATAGRAM_SIZE):
+        self._sock = sock
+        self._buffers = [bytearray(max_size) for i in xrange(0, batch_size)]
+        self._views = [memoryview(buf) for buf in self._buffers]
+
+        # Counters
+        self.datagrams = 0
+        self.batches = 0
+        self._sampled = self.snapshot()
+
+    def receive(self, block = True):
+        """
+        Returns a list of memoryviews holding the waiting datagrams.  Only
+        the first receive blocks (if block is True and the socket is
+        blocking), the rest take what is already queued.  The views are
+        only valid until the next call.
+        """
+        datagrams = []
+        flags = 0
+        if not block:
+            flags = socket.MSG_DONTWAIT
+
+        for view in self._views:
+            try:
+                size = self._sock.recv_into(view, 0, flags)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            datagrams.append(view[:size])
+            flags = socket.MSG_DONTWAIT
+
+        if datagrams:
+            self.datagrams += len(datagrams)
+            self.batches += 1
+        return datagrams
+
+    def snapshot(self):
+        """
+        The (time, datagrams) now, to measure a rate from later
+        """
+        return time.time(), self.datagrams
+
+    def sample(self):
+        """
+        Starts a new window for the rate stats_line reports, only the
+        periodic stats logger should call this
+        """
+        self._sampled = self.snapshot()
+
+    def rate(self, since = None):
+        """
+        Datagrams per second since the given snapshot, or since the last
+        sample.  Nothing is reset.
+        """
+        if since is None:
+            since = self._sampled
+        now, datagrams = self.snapshot()
+        elapsed = now - since[0]
+
+        if elapsed <= 0:
+            return 0.0
+        return (datagrams - since[1]) / elapsed
+
+    def kernel_drops(self):
+        return read_udp_drops(self._sock)
+
+    def stats_line(self):
+        """
+        One line summary of the receive counters for periodic logging, the
+        rate is since the last sample
+        """
+        return "recv: %.1f datagrams/s %d total %d batches, " \
+            "kernel drops: %s" % \
+            (self.rate(), self.datagrams, self.batches, self.kernel_drops())
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestReadUdpDrops(unittest.TestCase):
+    # Laid out like /proc/net/udp, the inode of the second socket is
+    # filled in with the test socket's
+    PROC_NET_UDP = \
+"""  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  123: 00000000:0044 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 16734 2 ffff8800368f4000 0
+  124: 00000000:2712 00000000:0000 07 00000000:00000000 00:00000000 00000000  1000        0 %s 2 ffff8800368f4400 42
+"""
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.inode = os.fstat(self.sock.fileno()).st_ino
+        handle, self.path = tempfile.mkstemp()
+        os.write(handle, self.PROC_NET_UDP % self.inode)
+        os.close(handle)
+
+    def tearDown(self):
+        self.sock.close()
+        os.remove(self.path)
+
+    def test_drops(self):
+        self.assertEquals(42, read_udp_drops(self.sock, (self.path,)))
+
+    def test_missing_file(self):
+        self.assertEquals(42, read_udp_drops(self.sock, (self.path + 'x',
+                                                         self.path)))
+        self.assertEquals(None, read_udp_drops(self.sock, (self.path + 'x',)))
+
+    def test_not_found(self):
+        other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.assertEquals(None, read_udp_drops(other, (self.path,)))
+        finally:
+            other.close()
+
+class TestDatagramReceiver(unittest.TestCase):
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver = DatagramReceiver(self.sock, batch_size = 3,
+                                         max_size = 16)
+
+    def tearDown(self):
+        self.sock.close()
+        self.sender.close()
+
+    def send(self, datagrams):
+        for data in datagrams:
+            self.sender.sendto(data, self.sock.getsockname())
+
+    def test_batch(self):
+        # The last one fills a buffer exactly
+        sent = ['a', 'bc', 'd' * 16]
+        self.send(sent)
+        datagrams = self.receiver.receive()
+        self.assertEquals(sent, [view.tobytes() for view in datagrams])
+        self.assertEquals(3, self.receiver.datagrams)
+        self.assertEquals(1, self.receiver.batches)
+
+        # Nothing left
+        self.assertEquals([], self.receiver.receive(block = False))
+        self.assertEquals(1, self.receiver.batches)
+
+    def test_batch_size(self):
+        sent = [str(i) * (i + 1) for i in xrange(0, 5)]
+        self.send(sent)
+        first = [view.tobytes() for view in self.receiver.receive()]
+        second = [view.tobytes() for view in self.receiver.receive()]
+        self.assertEquals(sent[:3], first)
+        self.assertEquals(sent[3:], second)
+        self.assertEquals(5, self.receiver.datagrams)
+        self.assertEquals(2, self.receiver.batches)
+
+    def test_rate(self):
+        start = self.receiver.snapshot()
+        self.send(['a', 'b'])
+        self.receiver.receive()
+        time.sleep(0.01)
+
+        # Reading the stats changes nothing
+        self.receiver.stats_line()
+        first = self.receiver.rate(start)
+        self.assertTrue(0 < first <= 2 / 0.01)
+        self.assertTrue(self.receiver.rate() > 0)
+        self.assertTrue(self.receiver.rate(start) <= first)
+
+        self.receiver.sample()
+        self.assertEquals(0.0, self.receiver.rate())
+        self.assertTrue(self.receiver.rate(start) > 0)
+
+    def test_views_reused(self):
+        self.send(['first'])
+        view = self.receiver.receive()[0]
+        self.send(['again'])
+        self.receiver.receive()
+        self.assertEquals('again', view.tobytes())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+
+# Python Imports
+import os
+import sys
+import mmap
+import optparse
+import itertools
+import tempfile
+import unittest
+import multiprocessing
+
+# Project Imports
+import messages
+import pbwire
+import proto.messages_robocup_ssl_refbox_log_pb2 as refbox_log
+
+
+__doc__ = """
+Converts Refbox_Log files offline.  Each Log_Frame is run through
+messages.FieldInfo and written out either as the packed byte stream the
+bricks would have received, or as one line of statistics per frame.
+
+Logs are never parsed as one big Refbox_Log message.  The file is memory
+mapped, split into Log_Frame byte ranges by walking the wire format, and
+the ranges are handed out in chunks to a pool of worker processes which
+parse and encode their frames.  Output keeps the frame order.
+
+Usage:
+  refbox_convert.py [options] LOG...
+"""
+
+# Field number of Refbox_Log.log
+LOG_FRAME_FIELD = 1
+
+STATS_COLUMNS = 'frame_number,camera_id,t_capture,refbox_cmd,robots,balls,' \
+                'bytes'
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def iter_log_frames(data):
+    """
+    Yields the (start, end) byte range of every Log_Frame in the encoded
+    Refbox_Log
+    """
+    for field_number, wire_type, value in pbwire.iter_fields(data):
+        if field_number == LOG_FRAME_FIELD and \
+           wire_type == pbwire.WIRE_LENGTH_DELIMITED:
+            yield value
+
+def chunk_ranges(ranges, chunk_size):
+    """
+    Groups the iterable of ranges into lists of at most chunk_size
+    """
+    chunk = []
+    for frame_range in ranges:
+        chunk.append(frame_range)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def convert_frame(log_frame, mode, transform):
+    """
+    Returns the output for one Log_Frame, the sync marker and packed
+    FieldInfo in 'packed' mode or a line of STATS_COLUMNS in 'stats' mode
+    """
+    frame = log_frame.frame
+    field_info = messages.FieldInfo(frame, *transform)
+    data = field_info.pack()
+
+    if mode == 'packed':
+        return messages.SYNC_MARKER + data
+
+    return '%d,%d,%.6f,%s,%d,%d,%d\n' % \
+        (frame.frame_number, frame.camera_id, frame.t_capture,
+         log_frame.refbox_cmd, len(field_info.robots), len(field_info.balls),
+         len(messages.SYNC_MARKER) + len(data))
+
+# Memory maps of the logs open in this (worker) process
+_log_maps = {}
+
+def _map_log(path):
+    log_map = _log_maps.get(path, None)
+    if log_map is None:
+        fileobj = open(path, 'rb')
+        log_map = mmap.mmap(fileobj.fileno(), 0, access = mmap.ACCESS_READ)
+        fileobj.close()
+        _log_maps[path] = log_map
+    return log_map
+
+def convert_chunk(args):
+    """
+    Converts a chunk of Log_Frame ranges from the log at path, returns the
+    number of frames and the output for all of them.  Runs in the worker
+    processes.
+    """
+    path, ranges, mode, transform = args
+    log_map = _map_log(path)
+    log_frame = refbox_log.Log_Frame()
+
+    output = []
+    for start, end in ranges:
+        log_frame.ParseFromString(buffer(log_map, start, end - start))
+        output.append(convert_frame(log_frame, mode, transform))
+    return len(output), ''.join(output)
+
+def convert_log(path, outfile, mode = 'packed',
+                transform = (messages.X_SHIFT, messages.Y_SHIFT,
+                             messages.SCALE),
+                chunk_size = 500, pool = None):
+    """
+    Converts the log at path and writes the output to outfile, through the
+    given multiprocessing pool or in this process if there is none.  Returns
+    the number of frames converted.  Chunks are handed out and written as
+    they go, so only a few are ever held in memory.
+    """
+    if mode == 'stats':
+        outfile.write(STATS_COLUMNS + '\n')
+    if os.path.getsize(path) == 0:
+        return 0
+
+    log_map = _map_log(path)
+    chunks = ((path, chunk, mode, transform)
+              for chunk in chunk_ranges(iter_log_frames(log_map), chunk_size))
+
+    if pool is None:
+        results = itertools.imap(convert_chunk, chunks)
+    else:
+        results = pool.imap(convert_chunk, chunks)
+
+    frames = 0
+    for count, output in results:
+        outfile.write(output)
+        frames += count
+
+    return frames
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = optparse.OptionParser(usage = "%prog [options] LOG...")
+    parser.set_defaults(mode = 'packed', x_shift = messages.X_SHIFT,
+                        y_shift = messages.Y_SHIFT, scale = messages.SCALE,
+                        jobs = multiprocessing.cpu_count(), chunk_size = 500,
+                        output_dir = None)
+    parser.add_option("-m", "--mode", dest="mode", type="choice",
+                      choices=['packed', 'stats'],
+                      help="packed: the byte stream sent to the bricks, "
+                      "stats: a CSV line per frame")
+    parser.add_option("-x", "--x-shift", dest="x_shift", type="float",
+                      help="Added to the scaled x positions")
+    parser.add_option("-y", "--y-shift", dest="y_shift", type="float",
+                      help="Added to the scaled y positions")
+    parser.add_option("-s", "--scale", dest="scale", type="float",
+                      help="Multiplies the ssl-vision positions")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="Worker processes (0 converts in this process)")
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int",
+                      help="Frames per chunk handed to a worker")
+    parser.add_option("-o", "--output-dir", dest="output_dir", type="string",
+                      help="Where to write the output (default: next to "
+                      "each log)")
+    (options, args) = parser.parse_args(argv[1:])
+
+    if not args:
+        parser.error("No logs given")
+
+    pool = None
+    if options.jobs > 0:
+        pool = multiprocessing.Pool(options.jobs)
+
+    transform = (options.x_shift, options.y_shift, options.scale)
+    extension = {'packed' : '.bin', 'stats' : '.csv'}[options.mode]
+    for path in args:
+        output_dir = options.output_dir or os.path.dirname(path)
+        name = os.path.splitext(os.path.basename(path))[0] + extension
+        output_path = os.path.join(output_dir, name)
+
+        outfile = open(output_path, 'wb')
+        frames = convert_log(path, outfile, options.mode, transform,
+                             options.chunk_size, pool)
+        outfile.close()
+        print "%s: %d frames -> %s" % (path, frames, output_path)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestRefboxConvert(unittest.TestCase):
+    def setUp(self):
+        self.log = refbox_log.Refbox_Log()
+        for i in xrange(0, 5):
+            log_frame = self.log.log.add()
+            log_frame.frame.CopyFrom(messages.make_test_detectionframe())
+            log_frame.frame.frame_number = i
+            log_frame.frame.camera_id = i % 2
+            log_frame.frame.t_capture = i
+            log_frame.frame.t_sent = i
+            for ball in log_frame.frame.balls:
+                ball.confidence = 1
+                ball.pixel_x = ball.pixel_y = 0
+                ball.x += i
+            for robot in log_frame.frame.robots_yellow:
+                robot.confidence = 1
+                robot.pixel_x = robot.pixel_y = 0
+            for robot in log_frame.frame.robots_blue:
+                robot.confidence = 1
+                robot.pixel_x = robot.pixel_y = 0
+            log_frame.refbox_cmd = 'S'
+
+        handle, self.path = tempfile.mkstemp()
+        os.write(handle, self.log.SerializeToString())
+        os.close(handle)
+
+    def tearDown(self):
+        log_map = _log_maps.pop(self.path, None)
+        if log_map is not None:
+            log_map.close()
+        os.remove(self.path)
+
+    def convert(self, mode, chunk_size = 2, pool = None):
+        outfile = tempfile.TemporaryFile()
+        frames = convert_log(self.path, outfile, mode, (0, 0, 1), chunk_size,
+                             pool)
+        outfile.seek(0)
+        return frames, outfile.read()
+
+    def test_iter_log_frames(self):
+        data = self.log.SerializeToString()
+        frames = [refbox_log.Log_Frame.FromString(data[start:end])
+                  for start, end in iter_log_frames(data)]
+        self.assertEquals(list(self.log.log), frames)
+
+    def test_packed(self):
+        frames, output = self.convert('packed')
+        expected = ''.join([messages.SYNC_MARKER +
+                            messages.FieldInfo(log_frame.frame).pack()
+                            for log_frame in self.log.log])
+        self.assertEquals(5, frames)
+        self.assertEquals(expected, output)
+
+    def test_stats(self):
+        frames, output = self.convert('stats', chunk_size = 10)
+        lines = output.splitlines()
+        self.assertEquals(STATS_COLUMNS, lines[0])
+        self.assertEquals('3,1,3.000000,S,2,2,18', lines[4])
+
+    def test_pool(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEquals(self.convert('packed'),
+                              self.convert('packed', pool = pool))
+        finally:
+            pool.close()
+            pool.join()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+# Python Imports
+import sys
+import time
+import struct
+import optparse
+import unittest
+
+# Project Imports
+import messages
+import receiver
+import proto.messages_robocup_ssl_detection_pb2 as ssl_detection
+
+
+__doc__ = """
+The stream the server republishes to a second multicast group, so sims,
+loggers and dashboards get positions without joining the ssl-vision group
+and parsing full protobufs themselves.  Every datagram carries one frame
+behind a small fixed header:
+
+  version   uint8    HEADER_VERSION
+  kind      uint8    KIND_PACKED, KIND_TRACKED or KIND_FRAME
+  seq       uint32   counts up by one per datagram, wrapping at 2**32
+  t_capture double   ssl-vision capture time of the frame (0 if unknown)
+
+A KIND_PACKED body is a packed messages.FieldInfo (without the sync marker,
+datagrams are framed already), a KIND_TRACKED body a packed
+messages.TrackedFieldInfo and a KIND_FRAME body is a serialized merged
+SSL_DetectionFrame.  Receivers spot lost datagrams from gaps in seq.
+
+Listen to the stream with:
+
+  python republish.py -H 224.5.23.3 -p 10010
+"""
+
+HEADER = struct.Struct('<BBId')
+HEADER_VERSION = 1
+
+KIND_PACKED = 0
+KIND_FRAME = 1
+KIND_TRACKED = 2
+
+SEQ_MODULUS = 1 << 32
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class SequenceTracker(object):
+    """
+    Follows the sequence numbers of a republished stream.  Datagrams which
+    skip ahead count the ones in between as lost, ones from behind the
+    newest seen are late (reordered or duplicated), unless they are more
+    than restart_window behind, which is taken as the server restarting.
+    """
+
+    def __init__(self, restart_window = 1000):
+        self._restart_window = restart_window
+        self._expected = None
+
+        # Counters
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.restarts = 0
+
+    def update(self, seq):
+        """
+        Records the datagram with the given seq, returns how many were lost
+        right before it
+        """
+        self.received += 1
+        if self._expected is None:
+            self._expected = (seq + 1) % SEQ_MODULUS
+            return 0
+
+        ahead = (seq - self._expected) % SEQ_MODULUS
+        if ahead < SEQ_MODULUS // 2:
+            self.lost += ahead
+            self._expected = (seq + 1) % SEQ_MODULUS
+            return ahead
+
+        behind = SEQ_MODULUS - ahead
+        if behind > self._restart_window:
+            self.restarts += 1
+            self._expected = (seq + 1) % SEQ_MODULUS
+        else:
+            self.late += 1
+        return 0
+
+    def stats_line(self):
+        return "republish: %d received %d lost %d late %d restarts" % \
+            (self.received, self.lost, self.late, self.restarts)
+
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def pack_datagram(kind, seq, t_capture, body):
+    return HEADER.pack(HEADER_VERSION, kind, seq, t_capture) + body
+
+def unpack_datagram(data):
+    """
+    Returns (kind, seq, t_capture, body) of a republished datagram, raises
+    ValueError if it isn't one
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Datagram too short: %d bytes" % len(data))
+
+    version, kind, seq, t_capture = HEADER.unpack_from(data)
+    if version != HEADER_VERSION:
+        raise ValueError("Unknown version: %d" % version)
+    return kind, seq, t_capture, data[HEADER.size:]
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = optparse.OptionParser()
+    parser.set_defaults(host="224.5.23.3", port=10010, verbose=False,
+                        stats_interval=1.0)
+    parser.add_option("-H", "--host", dest="host",
+                      type="string", help="republished multicast group")
+    parser.add_option("-p", "--port", dest="port",
+                      type="int", help="republished port")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                      help="Print every frame")
+    parser.add_option("-s", "--stats-interval", dest="stats_interval",
+                      type="float", help="Print stats every N seconds")
+    (options, args) = parser.parse_args(argv[1:])
+
+    sock = receiver.open_mcast_socket(options.host, options.port)
+    tracker = SequenceTracker()
+    frame = ssl_detection.SSL_DetectionFrame()
+    last_stats = time.time()
+
+    try:
+        while 1:
+            data = sock.recv(receiver.MAX_DATAGRAM_SIZE)
+            try:
+                kind, seq, t_capture, body = unpack_datagram(data)
+            except ValueError, e:
+                print "Bad datagram:", e
+                continue
+
+            lost = tracker.update(seq)
+            if lost:
+                print "Lost %d datagrams before %d" % (lost, seq)
+
+            if options.verbose:
+                if kind == KIND_PACKED:
+                    print seq, messages.FieldInfo.unpack(body)
+                elif kind == KIND_TRACKED:
+                    print seq, messages.TrackedFieldInfo.unpack(body)
+                else:
+                    frame.ParseFromString(body)
+                    print seq, frame
+
+            now = time.time()
+            if options.stats_interval > 0 and \
+               now - last_stats >= options.stats_interval:
+                print tracker.stats_line()
+                last_stats = now
+
+    except KeyboardInterrupt:
+        print tracker.stats_line()
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestDatagram(unittest.TestCase):
+    def test_round_trip(self):
+        data = pack_datagram(KIND_PACKED, 7, 12.5, 'body')
+        self.assertEquals(HEADER.size + 4, len(data))
+        self.assertEquals((KIND_PACKED, 7, 12.5, 'body'),
+                          unpack_datagram(data))
+
+    def test_bad(self):
+        self.assertRaises(ValueError, unpack_datagram, 'ab')
+        data = '\x09' + pack_datagram(KIND_FRAME, 1, 0.0, '')[1:]
+        self.assertRaises(ValueError, unpack_datagram, data)
+
+class TestSequenceTracker(unittest.TestCase):
+    def setUp(self):
+        self.tracker = SequenceTracker(restart_window = 100)
+
+    def test_gaps(self):
+        self.assertEquals([0, 0, 2, 0, 0],
+                          [self.tracker.update(seq)
+                           for seq in (10, 11, 14, 15, 13)])
+        self.assertEquals((5, 2, 1), (self.tracker.received,
+                                      self.tracker.lost, self.tracker.late))
+
+    def test_wrap(self):
+        self.assertEquals([0, 0, 1],
+                          [self.tracker.update(seq)
+                           for seq in (SEQ_MODULUS - 2, SEQ_MODULUS - 1, 1)])
+
+    def test_restart(self):
+        self.tracker.update(5000)
+        self.assertEquals(0, self.tracker.update(0))
+        self.assertEquals(1, self.tracker.update(2))
+        self.assertEquals(1, self.tracker.restarts)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,73 +1,353 @@
 
 # Python Imports
 import threading
-import Queue
 import sys
 import optparse
-import struct
+import time
 import socket
 import os
+import errno
+import struct
+import Queue
+import tempfile
+import unittest
 
 # Project Imports
 import messages
+import reactor as reactor_mod
+import receiver
+import merger
+import pacing
+import prefilter
+import encode_pool
+import latency
+import republish
+import spatial
+import proto.messages_robocup_ssl_detection_pb2 as ssl_detection
+import proto.messages_robocup_ssl_geometry_pb2 as ssl_geometry
 import proto.messages_robocup_ssl_wrapper_pb2 as ssl_wrapper
 
 # Library Imports
 import pyinotify
+import serial
+
+# Optional Imports (the tracker needs numpy)
+try:
+    import tracker
+except ImportError:
+    tracker = None
+
+X_SHIFT = messages.X_SHIFT
+Y_SHIFT = messages.Y_SHIFT
+SCALE = messages.SCALE
+
+SYNC_MARKER = messages.SYNC_MARKER
+
+class FrameEncoder(object):
+    """
+    Turns SSL_DetectionFrames into the bytes written out to each brick, the
+    sync marker followed by the packed FieldInfo.  Positions go through the
+    fixed X_SHIFT, Y_SHIFT and SCALE transform until update_geometry is given
+    the field size, after that through one fitted to the field.
+
+    tracker.TrackedFrames are sent as a TrackedFieldInfo after the
+    TRACKED_SYNC_MARKER, moved ahead to track_lead seconds after they were
+    sent (to make up for the time it takes to reach the bricks).
+    """
+
+    def __init__(self, follow_geometry = True, track_lead = 0.0):
+        self.transform = messages.FieldTransform(X_SHIFT, Y_SHIFT, SCALE)
+        self._follow_geometry = follow_geometry
+        self._field_key = None
+        self._track_lead = track_lead
 
-X_SHIFT = 121.92;
-Y_SHIFT = 121.92/2.0;
-SCALE = 0.1;
+    def update_geometry(self, field_size):
+        """
+        Rebuilds the transform if the field size changed since the last call,
+        returns True if it did
+        """
+        if not self._follow_geometry:
+            return False
+
+        key = (field_size.field_length, field_size.field_width,
+               field_size.boundary_width)
+        if key == self._field_key:
+            return False
+
+        try:
+            transform = messages.FieldTransform.from_field_size(field_size)
+        except ValueError, e:
+            print "Ignoring geometry:", e
+            return False
+
+        self._field_key = key
+        self.transform = transform
+        print "Field %d x %d (boundary %d): %s, %.1f mm resolution" % \
+            (key + (transform, transform.resolution))
+        return True
+
+    def field_info(self, frame):
+        """
+        The FieldInfo (or TrackedFieldInfo) of the frame
+        """
+        if tracker is not None and isinstance(frame, tracker.TrackedFrame):
+            lead = self._track_lead + time.time() - frame.received
+            return frame.field_info(self.transform, lead)
+        return messages.FieldInfo(frame, transform = self.transform)
+
+    @staticmethod
+    def pack(field_info):
+        if isinstance(field_info, messages.TrackedFieldInfo):
+            return messages.TRACKED_SYNC_MARKER + field_info.pack()
+        return SYNC_MARKER + field_info.pack()
+
+    @staticmethod
+    def unpack(payload):
+        """
+        The FieldInfo (or TrackedFieldInfo) of an encoded payload
+        """
+        if payload.startswith(messages.TRACKED_SYNC_MARKER):
+            return messages.TrackedFieldInfo.unpack(
+                payload[len(messages.TRACKED_SYNC_MARKER):])
+        return messages.FieldInfo.unpack(payload[len(SYNC_MARKER):])
+
+    def __call__(self, frame):
+        return self.pack(self.field_info(frame))
+
+class LatestMailbox(object):
+    """
+    A single slot mailbox where the newest item always wins.  Putting into a
+    full mailbox replaces the waiting item and counts it as dropped, so a
+    slow reader never builds up a backlog.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._item = None
+        self._full = False
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Puts the item in the mailbox, returns the item it replaced or None
+        """
+        self._cond.acquire()
+        replaced = None
+        if self._full:
+            self.dropped += 1
+            replaced = self._item
+        self._item = item
+        self._full = True
+        self._cond.notify()
+        self._cond.release()
+        return replaced
+
+    def get(self, block = True):
+        """
+        Waits for the next item, returns None once the mailbox is closed (or
+        right away when empty if block is False)
+        """
+        self._cond.acquire()
+        try:
+            while block and not self._full and not self._closed:
+                self._cond.wait()
+
+            item = self._item
+            self._item = None
+            self._full = False
+            return item
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """
+        Wakes up any waiting reader, get returns None from then on
+        """
+        self._cond.acquire()
+        self._closed = True
+        self._item = None
+        self._full = False
+        self._cond.notify_all()
+        self._cond.release()
 
 class FieldUpdateConsumer(threading.Thread):
     """
-    Grabs new SSL_DetectionFrame packets off its queue and sends them for
+    Grabs new SSL_DetectionFrame packets out of its mailbox and sends them for
     processing until its told to stop
     """
 
+    # When True the consumer is handed the already encoded wire bytes from
+    # FrameEncoder (shared with every other consumer) instead of the frame
+    wants_payload = False
+
+    # When True the consumer is handed a spatial.FieldIndex of the encoded
+    # frame instead (also shared), to pick out its own part of the frame
+    wants_index = False
+
+    # Set when the consumer runs on a reactor instead of its own thread
+    _reactor = None
+
     def start(self):
-        self._lock = threading.Lock()
         self._running = True
-        # Infinite size FIFO queue (insertion never blocks)
-        self._queue = Queue.Queue(maxsize = 0)
+        # Only the latest frame is kept (insertion never blocks)
+        self._mailbox = LatestMailbox()
+        self.latency = latency.LatencyStats(self.name,
+                                            latency.CONSUMER_STAGES)
 
         # Start thread
         threading.Thread.start(self)
 
+    def attach(self, reactor, threadsafe = False):
+        """
+        Runs the consumer on the given reactor's thread instead of starting
+        its own, frames are processed from a reactor callback with the same
+        latest frame semantics.  Use this instead of start.  Set threadsafe
+        when frames are put from a thread other than the reactor's.
+        """
+        self._running = True
+        self._mailbox = LatestMailbox()
+        self.latency = latency.LatencyStats(self.name,
+                                            latency.CONSUMER_STAGES)
+        self._reactor = reactor
+        self._threadsafe = threadsafe
+        self._scheduled = False
+
+    def join(self, timeout = None):
+        # Reactor driven consumers have no thread to wait on
+        if self._reactor is None:
+            threading.Thread.join(self, timeout)
+
     def running(self):
-        running = None
-        self._lock.acquire()
-        running = self._running
-        self._lock.release()
-        return running
+        # A plain attribute read, the mailbox wakes us when this changes
+        return self._running
 
     def set_running(self, running):
-        self._lock.acquire()
         self._running = running
-        self._lock.release()
+        if not running:
+            self._mailbox.close()
+
+    def dropped_frames(self):
+        """
+        Number of frames replaced by a newer one before we could process them
+        """
+        return self._mailbox.dropped
+
+    def stats_line(self):
+        return "%s: %d frames dropped" % (self.name, self.dropped_frames())
+
+    def put(self, frame, timing = None):
+        """
+        Hands the consumer a frame, with the latency.FrameTiming of its
+        trip through the server so far if there is one
+        """
+        replaced = self._mailbox.put((frame, timing, time.time()))
+        if replaced is not None:
+            self._record_drop('replaced', replaced)
+        if self._reactor is not None:
+            self.wake()
+
+    def _record_drop(self, stage, item):
+        # How old the frame was when a newer one took its place
+        frame, timing, put_time = item
+        if timing is not None:
+            self.latency.record(stage, time.time() - timing.received)
+
+    def _process(self, item):
+        frame, timing, put_time = item
+        self._timing = timing
+        self._dequeued = time.time()
+        self.latency.record('queue', self._dequeued - put_time)
+        self.process_frame(frame)
+
+    def frame_written(self):
+        """
+        Call this once the frame given to process_frame has been written out
+        to record how long it took to get there
+        """
+        now = time.time()
+        self.latency.record('write', now - self._dequeued)
+        timing = self._timing
+        if timing is not None:
+            self.latency.record('total', now - timing.received)
+            if timing.t_capture is not None:
+                self.latency.record('capture', now - timing.t_capture)
+
+    def ready(self):
+        """
+        Over ride this to hold frames back (in the mailbox) while the
+        consumer is busy, only used when running on a reactor
+        """
+        return True
+
+    def send_delay(self):
+        """
+        Over ride this to return how many seconds to wait before the next
+        frame can be processed, frames that come in meanwhile replace it
+        """
+        return 0
+
+    def frame_skipped(self):
+        """
+        Called when a frame is replaced by a newer one during a send_delay
+        """
+        pass
+
+    def wake(self):
+        """
+        Schedules processing of the waiting frame on the reactor
+        """
+        if not self._scheduled:
+            self._scheduled = True
+            if self._threadsafe:
+                self._reactor.call_soon_threadsafe(self._service)
+            else:
+                self._reactor.call_soon(self._service)
+
+    def _in_loop(self, callback):
+        """
+        Runs callback on the reactor's thread, right away if we are on it
+        """
+        if self._threadsafe:
+            self._reactor.call_soon_threadsafe(callback)
+        else:
+            callback()
 
-    def put(self,frame):
-        self._queue.put_nowait(frame)
+    def _service(self):
+        self._scheduled = False
+        if self.running() and self.ready():
+            # Come back once we may send, the newest frame waits in the
+            # mailbox until then
+            delay = self.send_delay()
+            if delay > 0:
+                self._scheduled = True
+                self._reactor.call_later(delay, self._service)
+                return
+
+            item = self._mailbox.get(block = False)
+            if item is not None:
+                self._process(item)
 
     def run(self):
         while self.running():
-            frame = None
-            try:
-                # Wait on an frame
-                frame = self._queue.get(block = True, timeout = 0.1)
-
-                # Empty the queue leaving us with the last (and most recent
-                # frame)
-                while not self._queue.empty():
-                    frame = self._queue.get_nowait()
-                
-            except Queue.Empty:
-                pass
+            # Wait on the newest frame
+            item = self._mailbox.get()
+
+            # Hold off until we may send, picking up any newer frame which
+            # comes in meanwhile
+            delay = self.send_delay()
+            if delay > 0 and item is not None:
+                time.sleep(delay)
+                newer = self._mailbox.get(block = False)
+                if newer is not None:
+                    self._record_drop('skipped', item)
+                    item = newer
+                    self.frame_skipped()
 
             # Now lets process this frame, only if we are still running
             if self.running():
-                if frame is not None:
-                    self.process_frame(frame)
+                if item is not None:
+                    self._process(item)
 
     def process_frame(self, frame):
         """
@@ -80,34 +360,125 @@ class DebugConsumer(FieldUpdateConsumer):
     Grabs frames and prints them
     """
 
+    def __init__(self):
+        FieldUpdateConsumer.__init__(self, name = 'debug')
+
     def process_frame(self, frame):
         #print messages.FieldInfo(frame,X_SHIFT,Y_SHIFT,SCALE)
         pass
 
 class BluetoothConsumer(FieldUpdateConsumer):
     """
-    Consumes frames and writes out on the given port
+    Consumes encoded frames and writes them out on the given port, as
+    delta frames (see messages.DeltaEncoder) if keyframe_interval is set.
+    Writes to serial ports are paced to what the link can carry.
+
+    With a spatial.Subscription the brick only gets the part of each frame
+    it subscribes to, picked out of the pool's shared FieldIndex, which
+    keeps its frames short on the slow link.
     """
+
+    wants_payload = True
+
+    BAUDRATE = 9600
+
+    _writer = None
+    _pacer = None
+
+    def __init__(self, keyframe_interval = 0, subscription = None):
+        FieldUpdateConsumer.__init__(self)
+        self._subscription = subscription
+        if subscription is not None and not subscription.passes_all():
+            self.wants_payload = False
+            self.wants_index = True
+        self._delta_encoder = None
+        if keyframe_interval > 0:
+            self._delta_encoder = messages.DeltaEncoder(keyframe_interval)
     
-    def start(self, devfile, testmode = False):
+    def start(self, devfile, testmode = False, reactor = None,
+              threadsafe = False, max_buffer = None):
+        """
+        Opens the port and starts writing to it, from our own thread or if
+        given, with non blocking writes from the reactor's thread.  Those
+        keep up to max_buffer bytes of frames queued for the port (see
+        reactor.PortWriter), or only one frame if it is None.
+        """
+        self.name = devfile
         if not testmode:
             self.port = self._open_port(devfile)
+            self._pacer = pacing.LinkPacer(self.BAUDRATE)
         else:
             self.port = open(devfile,'w')
-        FieldUpdateConsumer.start(self)
 
-    def process_frame(self, frame):
-        if self.port is not None:
-	    self.port.write(struct.pack('BB',255,255))
-	    self.port.write(data)
-            field_info = messages.FieldInfo(frame,X_SHIFT,Y_SHIFT,SCALE)
-            field_info.send_data(self.port)
+        if reactor is None:
+            FieldUpdateConsumer.start(self)
+        else:
+            self._writer = reactor_mod.PortWriter(reactor, self.port,
+                                                  on_drained = self._drained,
+                                                  max_buffer = max_buffer)
+            self.attach(reactor, threadsafe)
+
+    def set_running(self, running):
+        FieldUpdateConsumer.set_running(self, running)
+        if not running and self._writer is not None:
+            # The writer belongs to the reactor's thread
+            self._in_loop(self._writer.close)
+
+    def ready(self):
+        # Don't pick up a new frame until the writer has room for it
+        return not self._writer.full()
+
+    def send_delay(self):
+        if self._pacer is None:
+            return 0
+        return self._pacer.delay()
+
+    def frame_skipped(self):
+        if self._pacer is not None:
+            self._pacer.record_skip()
+
+    def stats_line(self):
+        line = FieldUpdateConsumer.stats_line(self)
+        if self._pacer is not None:
+            line += ", " + self._pacer.stats_line()
+        if self._writer is not None:
+            line += ", " + self._writer.stats_line()
+        return line
+
+    def process_frame(self, payload):
+        if self.wants_index:
+            payload = FrameEncoder.pack(self._subscription.apply(payload))
+
+        if self._delta_encoder is not None:
+            payload = SYNC_MARKER + self._delta_encoder.encode_packed(
+                payload[len(SYNC_MARKER):])
+
+        self._write_start = time.time()
+        self._write_size = len(payload)
+
+        if self._writer is not None:
+            self._writer.write(payload)
+            if self._writer.pending() == 0:
+                self._record_write()
+        elif self.port is not None:
+            self.port.write(payload)
             self.port.flush()
+            self._record_write()
+
+    def _record_write(self):
+        if self._pacer is not None:
+            self._pacer.record_write(self._write_size,
+                                     time.time() - self._write_start)
+        self.frame_written()
 
-    def _open_port(devfile):
+    def _drained(self):
+        self._record_write()
+        self.wake()
+
+    def _open_port(self, devfile):
         port = serial.Serial()
         port.setPort(devfile)
-        port.setBaudrate(9600)
+        port.setBaudrate(self.BAUDRATE)
         port.setStopbits(1)
         port.setByteSize(8)
         port.setTimeout(500)
@@ -115,54 +486,411 @@ class BluetoothConsumer(FieldUpdateConsumer):
         port.open()
         return port    
 
-class ConsumerPool(object):
+class RepublishConsumer(FieldUpdateConsumer):
+    """
+    Sends every frame on to another multicast group in the republish format
+    (see republish.py), either the packed FieldInfo payload (or
+    TrackedFieldInfo, when tracking) or with kind republish.KIND_FRAME the
+    (merged) SSL_DetectionFrame
+    """
+
+    def __init__(self, group, port, kind = republish.KIND_PACKED, ttl = 1):
+        FieldUpdateConsumer.__init__(self, name = 'republish')
+        self.wants_payload = kind == republish.KIND_PACKED
+        self._kind = kind
+        self._address = (group, port)
+        self._sock = receiver.open_mcast_sender(ttl)
+        self._seq = 0
+
+        # Counters
+        self.sent = 0
+        self.send_errors = 0
+
+    def put(self, frame, timing = None):
+        # The frame may be reused by the time our thread gets to it
+        if not self.wants_payload:
+            frame = frame.SerializeToString()
+        FieldUpdateConsumer.put(self, frame, timing)
+
+    def stats_line(self):
+        return "%s, %d sent %d send errors, next seq %d" % \
+            (FieldUpdateConsumer.stats_line(self), self.sent,
+             self.send_errors, self._seq)
+
+    def process_frame(self, data):
+        kind = self._kind
+        if self.wants_payload:
+            if data.startswith(messages.TRACKED_SYNC_MARKER):
+                kind = republish.KIND_TRACKED
+            data = data[len(SYNC_MARKER):]
+
+        t_capture = 0.0
+        if self._timing is not None and self._timing.t_capture is not None:
+            t_capture = self._timing.t_capture
+
+        datagram = republish.pack_datagram(kind, self._seq, t_capture, data)
+        # Lost sends still use up their number, so receivers see the gap
+        self._seq = (self._seq + 1) % republish.SEQ_MODULUS
+        try:
+            self._sock.sendto(datagram, self._address)
+        except socket.error:
+            self.send_errors += 1
+            return
+
+        self.sent += 1
+        self.frame_written()
+
+class SocketConsumer(FieldUpdateConsumer):
+    """
+    Serves the packed frames to any number of clients over TCP or UNIX
+    stream sockets, all from one reactor.  Each frame is sent as its length
+    (4 byte big endian unsigned int) followed by the packed FieldInfo.
+
+    Every client has its own non blocking writer which only keeps the
+    newest frame waiting behind the one going out to it, so a slow client
+    just misses frames (counted as dropped) instead of holding up the rest.
+    Clients aren't expected to send anything, they are dropped when they
+    hang up or a write to them fails.
+    """
+
+    wants_payload = True
+
+    LENGTH = struct.Struct('!I')
+
+    def __init__(self, addresses):
+        """
+        addresses is a list of (host, port) tuples to listen on with TCP
+        and paths to listen on with UNIX sockets
+        """
+        FieldUpdateConsumer.__init__(self, name = 'sockets')
+        self._addresses = addresses
+        self._listeners = []
+        self._clients = {}
+
+        # Counters
+        self.accepted = 0
+        self.disconnected = 0
+        self._retired_drops = 0
+
+    def serve(self, reactor, threadsafe = False):
+        """
+        Starts listening and serving clients from the given reactor, use
+        this instead of start
+        """
+        for address in self._addresses:
+            if isinstance(address, tuple):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            else:
+                if os.path.exists(address):
+                    os.remove(address)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(address)
+            sock.listen(128)
+            sock.setblocking(0)
+            self._listeners.append(sock)
+
+        self.attach(reactor, threadsafe)
+        self._in_loop(self._start_listening)
+
+    def addresses(self):
+        """
+        The addresses we are listening on, with the ports picked for TCP
+        addresses given port 0
+        """
+        return [sock.getsockname() for sock in self._listeners]
+
+    def clients(self):
+        return len(self._clients)
+
+    def set_running(self, running):
+        FieldUpdateConsumer.set_running(self, running)
+        if not running:
+            self._in_loop(self._close)
+
+    def stats_line(self):
+        dropped = self._retired_drops + \
+            sum([writer.frames_dropped
+                 for sock, writer in self._clients.values()])
+        return "%s: %d clients, %d accepted %d disconnected, %d frames " \
+            "dropped by slow clients" % (self.name, len(self._clients),
+                                         self.accepted, self.disconnected,
+                                         dropped)
+
+    def process_frame(self, payload):
+        frame = self.LENGTH.pack(len(payload) - len(SYNC_MARKER)) + \
+            payload[len(SYNC_MARKER):]
+        for sock, writer in self._clients.values():
+            writer.write(frame)
+        self.frame_written()
+
+    def _start_listening(self):
+        for sock in self._listeners:
+            self._reactor.add_reader(sock, self._accept, sock)
+
+    def _accept(self, listener):
+        # Take the whole backlog at once
+        while True:
+            try:
+                sock, address = listener.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    return
+                raise
+
+            sock.setblocking(0)
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            fd = sock.fileno()
+            writer = reactor_mod.PortWriter(
+                self._reactor, sock, max_buffer = 0,
+                on_error = lambda error, fd = fd: self._drop_client(fd))
+            self._clients[fd] = (sock, writer)
+            self._reactor.add_reader(sock, self._client_readable, fd)
+            self.accepted += 1
+
+    def _client_readable(self, fd):
+        sock, writer = self._clients[fd]
+        try:
+            data = sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+
+        # Anything the client says is ignored, we only listen for the hang up
+        if not data:
+            self._drop_client(fd)
+
+    def _drop_client(self, fd):
+        sock, writer = self._clients.pop(fd)
+        self._reactor.remove_reader(fd)
+        writer.close()
+        sock.close()
+        self._retired_drops += writer.frames_dropped
+        self.disconnected += 1
+
+    def _close(self):
+        for fd in self._clients.keys():
+            self._drop_client(fd)
+
+        for sock in self._listeners:
+            self._reactor.remove_reader(sock)
+            if sock.family == socket.AF_UNIX:
+                os.remove(sock.getsockname())
+            sock.close()
+        self._listeners = []
+
+class ConsumerReaper(threading.Thread):
     """
-    Manages all our consumer threads which push data to serial port or screen
+    Joins retired consumers on its own thread, so whoever retires them
+    doesn't wait for their last write to finish
     """
+
     def __init__(self):
+        threading.Thread.__init__(self, name = 'reaper')
+        self.daemon = True
+        self._queue = Queue.Queue()
+        self.reaped = 0
+
+    def reap(self, consumer):
+        self._queue.put(consumer)
+
+    def run(self):
+        while True:
+            consumer = self._queue.get()
+            if consumer is None:
+                break
+            consumer.join()
+            self.reaped += 1
+
+    def stop(self):
+        """
+        Waits for the consumers queued so far to be joined
+        """
+        self._queue.put(None)
+        self.join()
+
+class ConsumerPool(object):
+    """
+    Manages all our consumer threads which push data to serial port or screen.
+
+    The consumers are kept in a tuple which is never changed, adding or
+    removing one builds a new tuple and swaps it in.  put and put_payload
+    just loop over whichever tuple is current, so they never wait on a lock
+    (only membership changes take one, to not lose each other's updates).
+    """
+    def __init__(self, encoder = None):
         self._lock = threading.Lock()
-        self._consumers = []
+        self._consumers = ()
+        if encoder is None:
+            encoder = FrameEncoder()
+        self._encoder = encoder
+        self.latency = latency.LatencyStats('pipeline',
+                                            latency.PIPELINE_STAGES)
+        self._reaper = ConsumerReaper()
+        self._reaper.start()
+
+        # Churn counters
+        self.added = 0
+        self.removed = 0
+
+        # Frames dropped because they could not be encoded
+        self.bad_frames = 0
+
+    def consumers(self):
+        return self._consumers
 
     def add_consumer(self, consumer):
         self._lock.acquire()
-        self._consumers.append(consumer)
+        self._consumers = self._consumers + (consumer,)
+        self.added += 1
         self._lock.release()
 
     def remove_consumer(self, consumer):
         self._lock.acquire()
-        self._consumers.remove(consumer)
+        self._consumers = tuple([other for other in self._consumers
+                                 if other is not consumer])
+        self.removed += 1
         self._lock.release()
 
+    def retire_consumer(self, consumer):
+        """
+        Removes the consumer, stops it and leaves the join to the reaper
+        """
+        self.remove_consumer(consumer)
+        consumer.set_running(False)
+        self._reaper.reap(consumer)
+
     def stop_all(self):
-        self._lock.acquire()
         for consumer in self._consumers:
             consumer.set_running(False)
-        self._lock.release()
 
     def join_all(self):
-        self._lock.acquire()
         for consumer in self._consumers:
             consumer.join()
-        self._lock.release()
+        self._reaper.stop()
 
-    def put(self, frame):
-        self._lock.acquire()
+    def stats_line(self):
+        """
+        The stats of the pool and every consumer, one per line
+        """
+        consumers = self._consumers
+        lines = ["pool: %d consumers, %d added %d removed %d reaped, "
+                 "%d bad frames" %
+                 (len(consumers), self.added, self.removed,
+                  self._reaper.reaped, self.bad_frames)]
+        lines.extend([consumer.stats_line() for consumer in consumers])
+        lines.extend([stats.stats_line() for stats in self.latency_stats()])
+        return "\n".join(lines)
+
+    def put(self, frame, timing = None):
+        """
+        Hands the frame to every consumer, the frame is encoded at most once
+        and the same payload (or FieldIndex) is shared by all consumers which
+        want it.  A frame which fails to encode is counted and dropped, it
+        must not take the receive loop down with it.
+        """
+        field_info = None
+        payload = None
+        index = None
+        start = time.time()
+        encode_time = 0
         for consumer in self._consumers:
-            consumer.put(frame)
-        self._lock.release()
+            if consumer.wants_payload or consumer.wants_index:
+                encode_start = time.time()
+                try:
+                    if field_info is None:
+                        field_info = self._encoder.field_info(frame)
+                    if consumer.wants_index:
+                        if index is None:
+                            index = spatial.FieldIndex(field_info)
+                        item = index
+                    else:
+                        if payload is None:
+                            payload = self._encoder.pack(field_info)
+                        item = payload
+                except Exception, e:
+                    self._bad_frame(e)
+                    return
+                encode_time += time.time() - encode_start
+                consumer.put(item, timing)
+            else:
+                consumer.put(frame, timing)
+        if field_info is not None:
+            self.latency.record('encode', encode_time)
+        self.latency.record('put', time.time() - start - encode_time)
+
+    def put_payload(self, payload, timing = None):
+        """
+        Hands an already encoded payload to the consumers which want one,
+        or a FieldIndex of it
+        """
+        start = time.time()
+        if timing is not None:
+            self.latency.record('encode', start - timing.parsed)
+
+        index = None
+        for consumer in self._consumers:
+            if consumer.wants_index:
+                if index is None:
+                    try:
+                        index = spatial.FieldIndex(
+                            self._encoder.unpack(payload))
+                    except Exception, e:
+                        self._bad_frame(e)
+                        return
+                consumer.put(index, timing)
+            elif consumer.wants_payload:
+                consumer.put(payload, timing)
+        self.latency.record('put', time.time() - start)
+
+    def _bad_frame(self, error):
+        self.bad_frames += 1
+        if self.bad_frames == 1:
+            # Only the first, the stats line counts the rest
+            print "Dropping frame which failed to encode:", error
+
+    def latency_stats(self):
+        """
+        The pipeline's latency.LatencyStats followed by every consumer's
+        """
+        return [self.latency] + \
+            [consumer.latency for consumer in self._consumers]
 
 class BluetoothDevWatcher(pyinotify.ProcessEvent):
     """
-    Watches the device directory, and create BluetoothConsumers for new devices
+    Watches the device directory, and create BluetoothConsumers for new devices.
+    subscriptions maps device paths (or just their names) to the
+    spatial.Subscription of the brick on them.
     """
     
-    def __init__(self, prefix, pool, testmode = False):
+    def __init__(self, prefix, pool, testmode = False, reactor = None,
+                 keyframe_interval = 0, threadsafe = False,
+                 max_buffer = None, subscriptions = None):
         pyinotify.ProcessEvent.__init__(self)
 
         self._pool = pool
         self._prefix = prefix
         self._blueConsumers = {}
         self._testmode = testmode
+        self._reactor = reactor
+        self._keyframe_interval = keyframe_interval
+        self._threadsafe = threadsafe
+        self._max_buffer = max_buffer
+        self._subscriptions = subscriptions or {}
+
+    def subscription(self, full_path):
+        """
+        The Subscription of the device's brick, or None
+        """
+        subscription = self._subscriptions.get(full_path, None)
+        if subscription is None:
+            subscription = self._subscriptions.get(
+                os.path.basename(full_path), None)
+        return subscription
 
     def process_IN_CREATE(self, event):
         full_path = os.path.join(event.path, event.name)
@@ -170,11 +898,13 @@ class BluetoothDevWatcher(pyinotify.ProcessEvent):
             print "Connecting to:",full_path
             
             # Create and store the consumer for future shutdown
-            blue_con = BluetoothConsumer()
+            blue_con = BluetoothConsumer(self._keyframe_interval,
+                                         self.subscription(full_path))
             self._blueConsumers[full_path] = blue_con
 
             # Start up and add to the pool
-            blue_con.start(full_path, self._testmode)
+            blue_con.start(full_path, self._testmode, self._reactor,
+                           self._threadsafe, self._max_buffer)
             self._pool.add_consumer(blue_con)
 
     def process_IN_DELETE(self, event):
@@ -185,20 +915,171 @@ class BluetoothDevWatcher(pyinotify.ProcessEvent):
         full_path = os.path.join(event.path, event.name)
         if full_path in self._blueConsumers:
             print "Removing:",full_path
-            blue_con = self._blueConsumers[full_path]
-            blue_con.set_running(False)
-            self._pool.remove_consumer(blue_con)
-            blue_con.join()
+            blue_con = self._blueConsumers.pop(full_path)
+            self._pool.retire_consumer(blue_con)
+
+
+class StatsLogger(threading.Thread):
+    """
+    Prints the stats_line of each of its sources every interval seconds,
+    then moves the rate window of the sources which have one (sample)
+    """
+
+    def __init__(self, interval, sources):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._interval = interval
+        self._sources = sources
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            for source in self._sources:
+                print source.stats_line()
+                sample = getattr(source, 'sample', None)
+                if sample is not None:
+                    sample()
+
+class DatagramHandler(object):
+    """
+    Parses SSL_WrapperPackets and puts their detection frames in the pool,
+    through the frame merger if there is one.  Field geometry is passed on to
+    the frame encoder.  With a WrapperPrefilter only the parts of each batch
+    it selects are parsed.  With a ProcessEncoder frames are sent to it for
+    packing, using the frame encoder's transform, instead of to the pool.
+    With a tracker.Tracker the pool gets its TrackedFrames instead of the
+    detection frames.
+    """
+
+    def __init__(self, pool, datagram_receiver, frame_merger = None,
+                 frame_encoder = None, wrapper_prefilter = None,
+                 process_encoder = None, frame_tracker = None):
+        self._pool = pool
+        self._receiver = datagram_receiver
+        self._merger = frame_merger
+        self._encoder = frame_encoder
+        self._prefilter = wrapper_prefilter
+        self._process_encoder = process_encoder
+        self._tracker = frame_tracker
+        self._latency = pool.latency
+        self._wrapper_packet = ssl_wrapper.SSL_WrapperPacket()
+        self._frame = ssl_detection.SSL_DetectionFrame()
+        self._geometry = ssl_geometry.SSL_GeometryData()
+
+    def datagram_received(self, data, received = None):
+        if received is None:
+            received = time.time()
+
+        self._wrapper_packet.ParseFromString(data)
+        if self._encoder is not None and \
+           self._wrapper_packet.HasField('geometry'):
+            self._encoder.update_geometry(self._wrapper_packet.geometry.field)
+
+        if self._wrapper_packet.HasField('detection'):
+            self.frame_received(self._wrapper_packet.detection,
+                                latency.FrameTiming(received))
+
+    def frame_received(self, frame, timing):
+        timing.parsed = time.time()
+        timing.t_capture = frame.t_capture
+        self._latency.record('vision', timing.received - frame.t_capture)
+        self._latency.record('parse', timing.parsed - timing.received)
+
+        if self._merger is not None:
+            frame = self._merger.add(frame)
+
+        if frame is None:
+            return
+
+        if self._tracker is not None:
+            frame = self._tracker.update(frame, timing.received)
+
+        if self._process_encoder is not None:
+            self._process_encoder.submit(frame.SerializeToString(),
+                                         self._encoder.transform, timing)
+        else:
+            self._pool.put(frame, timing)
+
+    def read_socket(self, block = False):
+        """
+        Handles a batch of datagrams from the socket, only waits for the
+        first one if block is True
+        """
+        datagrams = self._receiver.receive(block)
+        received = time.time()
+        if self._prefilter is None:
+            for data in datagrams:
+                self.datagram_received(data, received)
+            return
+
+        for view, detection, geometry in self._prefilter.select(datagrams):
+            if geometry is not None and self._encoder is not None:
+                self._geometry.ParseFromString(view[geometry[0]:geometry[1]])
+                self._encoder.update_geometry(self._geometry.field)
+
+            if detection is None:
+                continue
+
+            data = view[detection[0]:detection[1]]
+            if self._process_encoder is not None and self._merger is None:
+                # Nothing to do with the frame here, the worker parses it
+                self._process_encoder.submit(data.tobytes(),
+                                             self._encoder.transform,
+                                             latency.FrameTiming(received))
+            else:
+                self._frame.ParseFromString(data)
+                self.frame_received(self._frame,
+                                    latency.FrameTiming(received))
+
+def run_threads(handler, pool, debug, wm, blueWatcher, output = None):
+    """
+    Runs the receive loop on this thread, with a thread per consumer except
+    for those served from the given output ReactorThread
+    """
+    notifier = pyinotify.ThreadedNotifier(wm, blueWatcher)
+
+    # Start the theads!!
+    notifier.start()
+    debug.start()
 
+    try:
+        while 1:
+            handler.read_socket(block = True)
+            
+    except KeyboardInterrupt:
+        pool.stop_all()
+        pool.join_all()
+        notifier.stop()
+        if output is not None:
+            output.stop()
 
-def open_mcast_socket(ip_addr_str, port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', port))
-    mreq = struct.pack("=4sl", socket.inet_aton(ip_addr_str), socket.INADDR_ANY)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-    return sock
+def run_reactor(sock, handler, pool, debug, wm, blueWatcher, loop):
+    """
+    Serves the socket, the device watcher and every consumer from one thread
+    """
+    notifier = pyinotify.Notifier(wm, blueWatcher)
+
+    def inotify_ready():
+        notifier.read_events()
+        notifier.process_events()
 
+    loop.add_reader(wm.get_fd(), inotify_ready)
+
+    sock.setblocking(0)
+    loop.add_reader(sock, handler.read_socket)
+
+    debug.attach(loop)
+
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pool.stop_all()
+        pool.join_all()
+        notifier.stop()
 
 def main(argv=None):
     if argv is None:
@@ -207,53 +1088,739 @@ def main(argv=None):
     # Parse arguments
     parser = optparse.OptionParser()
     parser.set_defaults(host="224.5.23.2", port= 10002, testmode=False,
-                        devprefix='/dev/rfcomm')
-    parser.add_option("-H", "--host", dest="hostname",
+                        devprefix='/dev/rfcomm', engine='threads',
+                      rcvbuf=None, batch=64, stats_interval=0,
+                      merge_window=0, keyframe_interval=0,
+                      fixed_transform=False, prefilter=True,
+                      skip_unchanged=False, refresh_interval=0.1, encode_workers=0,
+                      stats_socket=None, serial_buffer=0,
+                      republish=None, republish_frames=False,
+                      republish_ttl=1, listen=[], track=False,
+                      track_lead=0.0, nearest_balls=0, brick_robots=[],
+                      subscriptions=[])
+    parser.add_option("-H", "--host", dest="host",
                       type="string", help="specify UDP multicast ip address")
-    parser.add_option("-p", "--port", dest="portnum",
+    parser.add_option("-p", "--port", dest="port",
                       type="int", help="port number to run on")
     parser.add_option("-t", "--test", dest="testmode", action="store_true",
                        help="Enables writing to normal file")
     parser.add_option("-d","--devprefix", dest="devprefix", type="string",
                       help="The prefix for the files that are watched")
-    (options, args) = parser.parse_args()
-    
-    # Open up the UDP multicast
-    sock = open_mcast_socket(options.host, options.port)
+    parser.add_option("-e", "--engine", dest="engine", type="choice",
+                      choices=['threads', 'reactor'],
+                      help="threads: a thread per consumer, reactor: serve "
+                      "everything from one thread with non blocking IO")
+    parser.add_option("-r", "--rcvbuf", dest="rcvbuf", type="int",
+                      help="Socket receive buffer size in bytes")
+    parser.add_option("-b", "--batch", dest="batch", type="int",
+                      help="Max datagrams read from the socket at once")
+    parser.add_option("-s", "--stats-interval", dest="stats_interval",
+                      type="float", help="Print stats every N seconds")
+    parser.add_option("-m", "--merge-window", dest="merge_window",
+                      type="float", help="Merge the cameras into one frame "
+                      "per this many seconds of capture time (0 is off)")
+    parser.add_option("-k", "--delta-keyframes", dest="keyframe_interval",
+                      type="int", help="Send delta frames to the bricks with "
+                      "a full key frame every N frames (0 is off)")
+    parser.add_option("-f", "--fixed-transform", dest="fixed_transform",
+                      action="store_true", help="Always use the built in "
+                      "position transform, ignore the field geometry")
+    parser.add_option("--no-prefilter", dest="prefilter",
+                      action="store_false", help="Fully parse every datagram "
+                      "instead of skipping superseded and duplicate frames")
+    parser.add_option("--skip-unchanged", dest="skip_unchanged",
+                      action="store_true", help="Also skip frames whose "
+                      "objects didn't change and repeated geometry")
+    parser.add_option("-u", "--refresh-interval", dest="refresh_interval",
+                      type="float", help="With --skip-unchanged, still pass "
+                      "on unchanged frames from a camera this often in "
+                      "seconds")
+    parser.add_option("-w", "--encode-workers", dest="encode_workers",
+                      type="int", help="Pack frames on this many worker "
+                      "processes (0 packs them in the server process)")
+    parser.add_option("-S", "--stats-socket", dest="stats_socket",
+                      type="string", help="Serve the latency stats as JSON "
+                      "on a UNIX socket at this path")
+    parser.add_option("-W", "--serial-buffer", dest="serial_buffer",
+                      type="int", help="Write the ports without blocking "
+                      "(from one writer thread with the threads engine), "
+                      "queueing up to this many bytes per port and dropping "
+                      "the oldest whole frames past that (0 is off)")
+    parser.add_option("-R", "--republish", dest="republish",
+                      type="string", help="Republish the packed frames to "
+                      "this GROUP:PORT multicast address")
+    parser.add_option("--republish-frames", dest="republish_frames",
+                      action="store_true", help="Republish the (merged) "
+                      "SSL_DetectionFrame instead of the packed frame, not "
+                      "available with --encode-workers")
+    parser.add_option("--republish-ttl", dest="republish_ttl", type="int",
+                      help="Multicast time to live of republished frames")
+    parser.add_option("-L", "--listen", dest="listen", action="append",
+                      type="string", help="Serve the packed frames to "
+                      "clients connecting to this HOST:PORT (TCP) or path "
+                      "(UNIX socket), may be given more than once")
+    parser.add_option("-T", "--track", dest="track", action="store_true",
+                      help="Track the balls and robots and send their "
+                      "filtered positions, with ball velocities, as "
+                      "TrackedFieldInfo messages (needs numpy)")
+    parser.add_option("--track-lead", dest="track_lead", type="float",
+                      help="Send tracked positions this many seconds ahead "
+                      "of when they are encoded")
+    parser.add_option("-n", "--nearest-balls", dest="nearest_balls",
+                      type="int", help="Only send each brick given with "
+                      "--brick-robot the N balls nearest its robot")
+    parser.add_option("--brick-robot", dest="brick_robots", action="append",
+                      type="string", help="DEVICE=ID, the brick on DEVICE "
+                      "(path or name, ie rfcomm0) is on robot ID, may be "
+                      "given more than once")
+    parser.add_option("--subscribe", dest="subscriptions", action="append",
+                      type="string", help="'DEVICE NAME=VALUE ...', only "
+                      "send the brick on DEVICE the robots and balls in "
+                      "region=X0,Y0,X1,Y1 (packed units, 0 to 127), of "
+                      "team=yellow|blue, with robots=ID,ID... and at most "
+                      "balls=N balls nearest robot=ID, may be given more "
+                      "than once")
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.serial_buffer > 0 and options.keyframe_interval > 0:
+        parser.error("--serial-buffer drops queued frames, which breaks the "
+                     "deltas of --delta-keyframes")
+
+    if options.republish_frames and options.encode_workers > 0:
+        parser.error("--republish-frames needs the frames, which stay in "
+                     "the workers with --encode-workers")
+
+    if options.track:
+        if tracker is None:
+            parser.error("--track needs numpy")
+        for option, name in ((options.encode_workers > 0, '--encode-workers'),
+                             (options.keyframe_interval > 0,
+                              '--delta-keyframes'),
+                             (options.republish_frames,
+                              '--republish-frames')):
+            if option:
+                parser.error("--track does not work with %s" % name)
+
+    republish_address = None
+    if options.republish is not None:
+        try:
+            group, port = options.republish.split(':')
+            republish_address = (group, int(port))
+        except ValueError:
+            parser.error("--republish takes GROUP:PORT")
+
+    listen_addresses = []
+    for address in options.listen:
+        if '/' in address:
+            listen_addresses.append(address)
+            continue
+        try:
+            host, port = address.rsplit(':', 1)
+            listen_addresses.append((host, int(port)))
+        except ValueError:
+            parser.error("--listen takes HOST:PORT or a path")
+
+    brick_robots = {}
+    for brick in options.brick_robots:
+        try:
+            device, robot_id = brick.rsplit('=', 1)
+            brick_robots[device] = int(robot_id)
+        except ValueError:
+            parser.error("--brick-robot takes DEVICE=ID")
+
+    # Bricks named with --brick-robot get the balls nearest their robot
+    subscriptions = {}
+    for device, robot_id in brick_robots.items():
+        subscriptions[device] = spatial.Subscription(
+            max_balls = options.nearest_balls, robot_id = robot_id)
+
+    for spec in options.subscriptions:
+        words = spec.split()
+        if not words:
+            parser.error("--subscribe takes 'DEVICE NAME=VALUE ...'")
+        device = words[0]
+        try:
+            subscriptions[device] = spatial.Subscription.parse(
+                words[1:], brick_robots.get(device, None),
+                options.nearest_balls)
+        except ValueError, e:
+            parser.error("--subscribe %s: %s" % (device, e))
+
+        # Teams are lost packing the frames in the encoder workers
+        if subscriptions[device].team is not None and \
+           options.encode_workers > 0:
+            parser.error("--subscribe team does not work with "
+                         "--encode-workers")
 
     # Consumer pool
-    pool = ConsumerPool()
+    frame_encoder = FrameEncoder(not options.fixed_transform,
+                                 options.track_lead)
+    pool = ConsumerPool(frame_encoder)
     
     # Create the debug consumer
     debug = DebugConsumer()
     pool.add_consumer(debug)
 
+    loop = None
+    if options.engine == 'reactor':
+        loop = reactor_mod.Reactor()
+
+    # One thread writes every port and socket client when the receive loop
+    # blocks on its own
+    output = None
+    if loop is None and (options.serial_buffer > 0 or listen_addresses):
+        output = reactor_mod.ReactorThread('output')
+    output_reactor = loop
+    if output is not None:
+        output_reactor = output.reactor
+
+    port_reactor = loop
+    max_buffer = None
+    if options.serial_buffer > 0:
+        max_buffer = options.serial_buffer
+        port_reactor = output_reactor
+
+    # Start the encoder processes before opening anything they could inherit
+    process_encoder = None
+    if options.encode_workers > 0:
+        if loop is None:
+            deliver = pool.put_payload
+        else:
+            deliver = lambda payload, timing: loop.call_soon_threadsafe(
+                pool.put_payload, payload, timing)
+        process_encoder = encode_pool.ProcessEncoder(deliver,
+                                                     options.encode_workers)
+
+    # Open up the UDP multicast
+    sock = receiver.open_mcast_socket(options.host, options.port,
+                                      options.rcvbuf)
+    datagram_receiver = receiver.DatagramReceiver(sock, options.batch)
+
+    # Republishing and client sockets
+    if republish_address is not None:
+        kind = republish.KIND_PACKED
+        if options.republish_frames:
+            kind = republish.KIND_FRAME
+        republisher = RepublishConsumer(republish_address[0],
+                                        republish_address[1], kind,
+                                        options.republish_ttl)
+        if loop is None:
+            republisher.start()
+        else:
+            republisher.attach(loop)
+        pool.add_consumer(republisher)
+
+    if listen_addresses:
+        socket_consumer = SocketConsumer(listen_addresses)
+        socket_consumer.serve(output_reactor, threadsafe = output is not None)
+        pool.add_consumer(socket_consumer)
+
     # Create the watcher
-    mask = pyinotify.EventsCodes.IN_DELETE | pyinotify.EventsCodes.IN_CREATE
+
+    mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE
     wm = pyinotify.WatchManager()
 
     blueWatcher = BluetoothDevWatcher(options.devprefix, pool,
-                                      testmode = options.testmode)
-    notifier = pyinotify.ThreadedNotifier(wm, blueWatcher)
+                                      testmode = options.testmode,
+                                      reactor = port_reactor,
+                                      keyframe_interval =
+                                      options.keyframe_interval,
+                                      threadsafe = port_reactor is not loop,
+                                      max_buffer = max_buffer,
+                                      subscriptions = subscriptions)
     watchdir, fileprefix = os.path.split(options.devprefix)
     wdd = wm.add_watch(watchdir, mask, rec=False)
 
-    # Start the theads!!
-    notifier.start()
-    debug.start()
+    # Optional camera merging
+    stats_sources = [datagram_receiver, pool]
+    frame_merger = None
+    if options.merge_window > 0:
+        frame_merger = merger.FrameMerger(options.merge_window)
+        stats_sources.append(frame_merger)
 
-    wrapper_packet = ssl_wrapper.SSL_WrapperPacket()
-    try:
-        while 1:
-            data, sender = sock.recvfrom(1500)
+    wrapper_prefilter = None
+    if options.prefilter:
+        wrapper_prefilter = prefilter.WrapperPrefilter(
+            options.skip_unchanged, options.refresh_interval)
+        stats_sources.append(wrapper_prefilter)
 
-            wrapper_packet.ParseFromString(data)
-            frame = wrapper_packet.detection
-            pool.put(frame)
-            
-    except KeyboardInterrupt:
+    if process_encoder is not None:
+        stats_sources.append(process_encoder)
+
+    frame_tracker = None
+    if options.track:
+        frame_tracker = tracker.Tracker()
+        stats_sources.append(frame_tracker)
+
+    stats_logger = None
+    if options.stats_interval > 0:
+        stats_logger = StatsLogger(options.stats_interval, stats_sources)
+        stats_logger.start()
+
+    stats_server = None
+    if options.stats_socket is not None:
+        stats_server = latency.StatsServer(options.stats_socket,
+                                           pool.latency_stats)
+        stats_server.start()
+
+    if output is not None:
+        output.start()
+
+    handler = DatagramHandler(pool, datagram_receiver, frame_merger,
+                              frame_encoder, wrapper_prefilter,
+                              process_encoder, frame_tracker)
+    if loop is None:
+        run_threads(handler, pool, debug, wm, blueWatcher, output)
+    else:
+        run_reactor(sock, handler, pool, debug, wm, blueWatcher, loop)
+
+    if process_encoder is not None:
+        process_encoder.close()
+
+    if stats_logger is not None:
+        stats_logger.stop()
+    if stats_server is not None:
+        stats_server.stop()
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class RecordingConsumer(object):
+    """
+    Stands in for a FieldUpdateConsumer, keeps what it is given
+    """
+
+    def __init__(self, wants_payload = True, on_put = None,
+                 wants_index = False):
+        self.wants_payload = wants_payload
+        self.wants_index = wants_index
+        self.items = []
+        self.running = True
+        self._on_put = on_put
+        self.latency = latency.LatencyStats('test', latency.CONSUMER_STAGES)
+
+    def put(self, item, timing = None):
+        self.items.append(item)
+        if self._on_put is not None:
+            self._on_put()
+
+    def set_running(self, running):
+        self.running = running
+
+    def join(self):
+        pass
+
+    def stats_line(self):
+        return "test"
+
+class RecordingEncoder(object):
+    """
+    Stands in for a FrameEncoder, keeps the frames it encodes
+    """
+
+    def __init__(self):
+        self.encoded = []
+
+    def field_info(self, frame):
+        self.encoded.append(frame)
+        return frame
+
+    def pack(self, field_info):
+        return 'payload:' + str(field_info)
+
+class SlowConsumer(FieldUpdateConsumer):
+    def process_frame(self, frame):
+        time.sleep(0.2)
+
+class TestLatestMailbox(unittest.TestCase):
+    def setUp(self):
+        self.mailbox = LatestMailbox()
+        self.got = []
+
+    def get_later(self):
+        # Starts a reader blocked in get, returns its thread
+        thread = threading.Thread(
+            target = lambda: self.got.append(self.mailbox.get()))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.05)
+        return thread
+
+    def test_newest_wins(self):
+        self.assertEquals(None, self.mailbox.put(1))
+        self.assertEquals(1, self.mailbox.put(2))
+        self.assertEquals(2, self.mailbox.put(3))
+        self.assertEquals(2, self.mailbox.dropped)
+
+        self.assertEquals(3, self.mailbox.get())
+        self.assertEquals(None, self.mailbox.get(block = False))
+
+        # Nothing unread is replaced after a get
+        self.assertEquals(None, self.mailbox.put(4))
+        self.assertEquals(2, self.mailbox.dropped)
+
+    def test_get_blocks(self):
+        thread = self.get_later()
+        self.assertTrue(thread.is_alive())
+        self.assertEquals([], self.got)
+
+        self.mailbox.put('frame')
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(['frame'], self.got)
+        self.assertEquals(0, self.mailbox.dropped)
+
+    def test_close_wakes(self):
+        thread = self.get_later()
+        self.mailbox.close()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals([None], self.got)
+        self.assertEquals(None, self.mailbox.get())
+
+class TestConsumerPool(unittest.TestCase):
+    def setUp(self):
+        self.encoder = RecordingEncoder()
+        self.pool = ConsumerPool(encoder = self.encoder)
+
+    def tearDown(self):
+        self.pool.stop_all()
+        self.pool.join_all()
+
+    def test_put_encodes_once(self):
+        consumers = [RecordingConsumer(), RecordingConsumer(),
+                     RecordingConsumer(wants_payload = False)]
+        for consumer in consumers:
+            self.pool.add_consumer(consumer)
+
+        self.pool.put('frame')
+        self.assertEquals(['frame'], self.encoder.encoded)
+        self.assertEquals([['payload:frame'], ['payload:frame'], ['frame']],
+                          [consumer.items for consumer in consumers])
+        self.assertEquals(1, self.pool.latency.histograms['put'].count)
+
+    def test_put_shares_index(self):
+        consumers = [RecordingConsumer(wants_index = True),
+                     RecordingConsumer(wants_index = True),
+                     RecordingConsumer()]
+        for consumer in consumers:
+            self.pool.add_consumer(consumer)
+
+        field_info = messages.FieldInfo()
+        field_info.header = messages.Header(0, 0)
+        self.pool.put(field_info)
+        self.assertEquals([field_info], self.encoder.encoded)
+        index = consumers[0].items[0]
+        self.assertTrue(isinstance(index, spatial.FieldIndex))
+        self.assertTrue(index is consumers[1].items[0])
+        self.assertTrue(index.field_info is field_info)
+        self.assertEquals(['payload:' + str(field_info)], consumers[2].items)
+
+    def test_bad_frame(self):
+        consumers = [RecordingConsumer(wants_payload = False),
+                     RecordingConsumer()]
+        for consumer in consumers:
+            self.pool.add_consumer(consumer)
+
+        def fail(field_info):
+            raise struct.error("ubyte format requires 0 <= number <= 255")
+        self.encoder.pack = fail
+
+        # Dropped and counted instead of raised into the receive loop
+        self.pool.put('frame')
+        self.assertEquals(1, self.pool.bad_frames)
+        self.assertEquals([], consumers[1].items)
+
+        del self.encoder.pack
+        self.pool.put('frame2')
+        self.assertEquals(['payload:frame2'], consumers[1].items)
+
+    def test_off_field_frame(self):
+        consumer = RecordingConsumer()
+        pool = ConsumerPool()
+        pool.add_consumer(consumer)
+
+        frame = messages.make_test_detectionframe()
+        frame.robots_yellow[0].x = -2000
+        pool.put(frame)
         pool.stop_all()
         pool.join_all()
+        self.assertEquals(0, pool.bad_frames)
+        self.assertEquals(1, len(consumer.items))
+
+    def test_change_during_put(self):
+        late = RecordingConsumer()
+        last = RecordingConsumer()
+        first = RecordingConsumer(
+            on_put = lambda: (self.pool.remove_consumer(last),
+                              self.pool.add_consumer(late)))
+        self.pool.add_consumer(first)
+        self.pool.add_consumer(last)
+
+        # The put in progress still sees the consumers it started with
+        self.pool.put('frame')
+        self.assertEquals(['payload:frame'], last.items)
+        self.assertEquals([], late.items)
+        self.assertEquals((first, late), self.pool.consumers())
+        self.assertEquals((3, 1), (self.pool.added, self.pool.removed))
+
+    def test_retire_off_path(self):
+        consumer = SlowConsumer()
+        consumer.start()
+        self.pool.add_consumer(consumer)
+        self.pool.put('frame')
+        time.sleep(0.05)
+
+        # Returns straight away while the consumer finishes its frame
+        start = time.time()
+        self.pool.retire_consumer(consumer)
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertEquals((), self.pool.consumers())
+
+        self.pool.join_all()
+        self.assertEquals(1, self.pool._reaper.reaped)
+        self.assertFalse(consumer.is_alive())
+
+class TestRepublishConsumer(unittest.TestCase):
+    GROUP = '224.5.23.3'
+    PORT = 10779
+
+    def setUp(self):
+        self.sock = receiver.open_mcast_socket(self.GROUP, self.PORT)
+        self.sock.settimeout(2)
+        self.loop = reactor_mod.Reactor()
+
+    def tearDown(self):
+        self.sock.close()
+        self.loop.close()
+
+    def republish(self, kind, frames):
+        consumer = RepublishConsumer(self.GROUP, self.PORT, kind)
+        consumer.attach(self.loop)
+        for frame in frames:
+            timing = latency.FrameTiming(time.time(), 12.5)
+            consumer.put(frame, timing)
+            self.loop.run_once(0)
+        return [republish.unpack_datagram(self.sock.recv(1500))
+                for frame in frames]
+
+    def test_packed(self):
+        frame = messages.make_test_detectionframe()
+        payload = FrameEncoder()(frame)
+        datagrams = self.republish(republish.KIND_PACKED, [payload] * 3)
+
+        self.assertEquals([0, 1, 2], [seq for kind, seq, t, body in datagrams])
+        kind, seq, t_capture, body = datagrams[0]
+        self.assertEquals((republish.KIND_PACKED, 12.5), (kind, t_capture))
+        self.assertEquals(payload[len(SYNC_MARKER):], body)
+
+    @unittest.skipIf(tracker is None, "needs numpy")
+    def test_tracked(self):
+        frame_tracker = tracker.Tracker(min_ball_hits = 1)
+        tracked = frame_tracker.update(tracker.make_frame(0.0, [(100, 200)]),
+                                       time.time())
+        payload = FrameEncoder()(tracked)
+        self.assertTrue(payload.startswith(messages.TRACKED_SYNC_MARKER))
+
+        kind, seq, t_capture, body = \
+            self.republish(republish.KIND_PACKED, [payload])[0]
+        self.assertEquals(republish.KIND_TRACKED, kind)
+        field_info = messages.TrackedFieldInfo.unpack(body)
+        self.assertEquals(messages.Header(0, 1), field_info.header)
+
+    def test_frames(self):
+        frame = messages.make_test_detectionframe()
+        frame.frame_number = frame.camera_id = 0
+        frame.t_capture = frame.t_sent = 12.5
+        for obj in list(frame.balls) + list(frame.robots_yellow) + \
+            list(frame.robots_blue):
+            obj.confidence = 1
+            obj.pixel_x = obj.pixel_y = 0
+
+        kind, seq, t_capture, body = \
+            self.republish(republish.KIND_FRAME, [frame])[0]
+        self.assertEquals(republish.KIND_FRAME, kind)
+        self.assertEquals(frame, ssl_detection.SSL_DetectionFrame.FromString(
+            body))
+
+class TestSocketConsumer(unittest.TestCase):
+    def setUp(self):
+        self.loop = reactor_mod.Reactor()
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'frames')
+        self.consumer = SocketConsumer([('127.0.0.1', 0), self.path])
+        self.consumer.serve(self.loop)
+
+    def tearDown(self):
+        self.consumer.set_running(False)
+        self.loop.close()
+        os.rmdir(self.dirname)
+
+    def connect(self):
+        tcp = socket.create_connection(self.consumer.addresses()[0])
+        unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix.connect(self.path)
+        self.loop.run_once(0.1)
+        return tcp, unix
+
+    def put(self, payload):
+        self.consumer.put(SYNC_MARKER + payload)
+        self.loop.run_once(0)
+
+    def read_frames(self, sock, data = ''):
+        # Returns the whole frames waiting on the socket
+        sock.setblocking(0)
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.error:
+            pass
+
+        frames = []
+        while data:
+            size = SocketConsumer.LENGTH.unpack_from(data)[0]
+            start = SocketConsumer.LENGTH.size
+            self.assertTrue(len(data) >= start + size)
+            frames.append(data[start:start + size])
+            data = data[start + size:]
+        return frames
+
+    def test_framing(self):
+        clients = self.connect()
+        self.assertEquals(2, self.consumer.clients())
+
+        self.put('abc')
+        self.put('defg')
+        for client in clients:
+            self.assertEquals(['abc', 'defg'], self.read_frames(client))
+            client.close()
+
+    def test_slow_client(self):
+        fast, slow = self.connect()
+        for sock, writer in self.consumer._clients.values():
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+
+        payloads = ['%04d' % i + 'x' * 196 for i in xrange(0, 2000)]
+        received = []
+        for payload in payloads:
+            self.put(payload)
+            received.extend(self.read_frames(fast))
+        self.assertEquals(payloads, received)
+
+        # The slow client got whole frames, in order, ending with the newest
+        for i in xrange(0, 10):
+            self.loop.run_once(0.01)
+        frames = self.read_frames(slow)
+        while True:
+            self.loop.run_once(0.01)
+            more = self.read_frames(slow)
+            if not more:
+                break
+            frames.extend(more)
+
+        self.assertTrue(len(frames) < len(payloads))
+        self.assertEquals(payloads[-1], frames[-1])
+        self.assertEquals(sorted(frames), frames)
+        self.assertTrue(all([frame in payloads for frame in frames]))
+        self.assertTrue('frames dropped' in self.consumer.stats_line())
+
+        fast.close()
+        slow.close()
+
+    def test_hang_up(self):
+        tcp, unix = self.connect()
+        tcp.close()
+        self.loop.run_once(0.1)
+        self.assertEquals(1, self.consumer.clients())
+        self.assertEquals(1, self.consumer.disconnected)
+
+        self.put('abc')
+        self.assertEquals(['abc'], self.read_frames(unix))
+        unix.close()
+
+class TestBluetoothConsumer(unittest.TestCase):
+    def test_nearest_balls(self):
+        field_info = messages.FieldInfo()
+        field_info.robots = [
+            messages.RobotInfo(3, 0.0, messages.Vector2D(100, 100))]
+        field_info.balls = [messages.Vector2D(10, 10),
+                            messages.Vector2D(90, 90),
+                            messages.Vector2D(120, 120)]
+        field_info.header = messages.Header(1, 3)
+
+        consumer = BluetoothConsumer(subscription = spatial.Subscription(
+                max_balls = 2, robot_id = 3))
+        self.assertTrue(consumer.wants_index)
+        self.assertFalse(consumer.wants_payload)
+
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        consumer.start(path, testmode = True)
+        consumer.put(spatial.FieldIndex(field_info))
+        time.sleep(0.1)
+        consumer.set_running(False)
+        consumer.join()
+        consumer.port.close()
+        data = open(path).read()
+        os.remove(path)
+
+        # Only the two balls nearest robot 3, nearest first
+        subset = FrameEncoder.unpack(data)
+        self.assertEquals(messages.Header(1, 2), subset.header)
+        self.assertEquals([messages.Vector2D(90, 90),
+                           messages.Vector2D(120, 120)], subset.balls)
+
+class TestWriterThread(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'rfcomm0')
+        os.mkfifo(self.path)
+        self.read_fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self.writer = reactor_mod.ReactorThread('writer')
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.stop()
+        os.close(self.read_fd)
+        os.remove(self.path)
+        os.rmdir(self.dirname)
+
+    def test_frames_from_writer_thread(self):
+        consumers = [BluetoothConsumer(), BluetoothConsumer()]
+        for consumer in consumers:
+            consumer.start(self.path, testmode = True,
+                           reactor = self.writer.reactor, threadsafe = True,
+                           max_buffer = 64)
+
+        payloads = [SYNC_MARKER + 'frame%d' % i for i in xrange(0, 5)]
+        for payload in payloads:
+            for consumer in consumers:
+                consumer.put(payload)
+            time.sleep(0.01)
+
+        data = ''
+        deadline = time.time() + 2
+        while data.count(SYNC_MARKER) < 10 and time.time() < deadline:
+            time.sleep(0.01)
+            try:
+                data += os.read(self.read_fd, 4096)
+            except OSError:
+                pass
+
+        for consumer in consumers:
+            consumer.set_running(False)
+            consumer.port.close()
+
+        # Both ports got every frame whole
+        self.assertEquals(sorted(payloads * 2),
+                          sorted(SYNC_MARKER + frame for frame in
+                                 data.split(SYNC_MARKER)[1:]))
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,533 @@
+# Standard Imports
+import math
+import heapq
+import random
+import unittest
+
+# Project Imports
+import messages
+
+
+__doc__ = """
+Spatial lookups over the objects of a FieldInfo.  The robots and balls are
+bucketed into a uniform grid over the packed 0 to MAX_PACKED_FLOAT field
+the first time a frame is queried, after that nearest, radius and
+rectangle queries only look at the cells around the query instead of
+scanning every object.  Small sets of objects are never bucketed, they are
+just scanned.
+"""
+
+# Grid cell size in packed field units, 8 x 8 cells over the field
+DEFAULT_CELL_SIZE = 16.0
+
+# Queries over this few points just look at all of them, without a grid
+SCAN_SIZE = 16
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def object_pos(obj):
+    """
+    The position of a Ball or a plain Vector2D ball
+    """
+    return getattr(obj, 'pos', obj)
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class GridIndex(object):
+    """
+    Buckets a list of (x, y) points into square cells of cell_size.  Points
+    outside 0 to extent go in the nearest edge cell.  Queries return the
+    indices of the points.
+
+    The cells are only built by the first query that needs them, and never
+    for SCAN_SIZE or fewer points.
+    """
+
+    def __init__(self, points, cell_size = DEFAULT_CELL_SIZE,
+                 extent = messages.MAX_PACKED_FLOAT):
+        self.points = points
+        self._cell_size = float(cell_size)
+        self._cells_across = int(extent // cell_size) + 1
+        self._cells = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def _grid(self):
+        """
+        The cell to point indices dict, built on first use.  Readers on
+        other threads may build it at the same time, they get equal dicts.
+        """
+        cells = self._cells
+        if cells is not None:
+            return cells
+
+        size = self._cell_size
+        last = self._cells_across - 1
+        cells = {}
+        for i, (x, y) in enumerate(self.points):
+            cell = (min(max(int(x // size), 0), last),
+                    min(max(int(y // size), 0), last))
+            if cell in cells:
+                cells[cell].append(i)
+            else:
+                cells[cell] = [i]
+
+        self._cells = cells
+        return cells
+
+    def _cell(self, x, y):
+        last = self._cells_across - 1
+        return (min(max(int(x // self._cell_size), 0), last),
+                min(max(int(y // self._cell_size), 0), last))
+
+    def _ring(self, cx, cy, ring):
+        """
+        The occupied cells ring cells away from (cx, cy) in any direction
+        """
+        cells = self._grid()
+        if ring == 0:
+            if (cx, cy) in cells:
+                yield cells[(cx, cy)]
+            return
+
+        for x in xrange(cx - ring, cx + ring + 1):
+            for y in (cy - ring, cy + ring):
+                if (x, y) in cells:
+                    yield cells[(x, y)]
+        for y in xrange(cy - ring + 1, cy + ring):
+            for x in (cx - ring, cx + ring):
+                if (x, y) in cells:
+                    yield cells[(x, y)]
+
+    def nearest(self, x, y, k = 1):
+        """
+        Indices of the k points nearest (x, y), nearest first
+        """
+        k = min(k, len(self.points))
+        if k <= 0:
+            return []
+
+        points = self.points
+        if len(points) <= SCAN_SIZE:
+            found = [((px - x) ** 2 + (py - y) ** 2, i)
+                     for i, (px, py) in enumerate(points)]
+            return [i for distance, i in heapq.nsmallest(k, found)]
+
+        cx, cy = self._cell(x, y)
+        size = self._cell_size
+        last = self._cells_across - 1
+        found = []
+        ring = 0
+        while True:
+            for cell in self._ring(cx, cy, ring):
+                for i in cell:
+                    px, py = points[i]
+                    found.append(((px - x) ** 2 + (py - y) ** 2, i))
+
+            # Distances to the sides of the searched block with cells left
+            # beyond them, anything not looked at yet is at least that far
+            gaps = []
+            if cx - ring > 0:
+                gaps.append(x - (cx - ring) * size)
+            if cx + ring < last:
+                gaps.append((cx + ring + 1) * size - x)
+            if cy - ring > 0:
+                gaps.append(y - (cy - ring) * size)
+            if cy + ring < last:
+                gaps.append((cy + ring + 1) * size - y)
+            if not gaps:
+                break
+
+            if len(found) >= k:
+                bound = min(gaps)
+                if heapq.nsmallest(k, found)[-1][0] <= bound * bound:
+                    break
+            ring += 1
+
+        return [i for distance, i in heapq.nsmallest(k, found)]
+
+    def within(self, x, y, radius):
+        """
+        Indices of the points no further than radius from (x, y), nearest
+        first
+        """
+        r2 = radius * radius
+        points = self.points
+        found = []
+        if len(points) <= SCAN_SIZE:
+            for i, (px, py) in enumerate(points):
+                distance = (px - x) ** 2 + (py - y) ** 2
+                if distance <= r2:
+                    found.append((distance, i))
+            found.sort()
+            return [i for distance, i in found]
+
+        x0, y0 = self._cell(x - radius, y - radius)
+        x1, y1 = self._cell(x + radius, y + radius)
+        cells = self._grid()
+        for cell_x in xrange(x0, x1 + 1):
+            for cell_y in xrange(y0, y1 + 1):
+                for i in cells.get((cell_x, cell_y), ()):
+                    px, py = points[i]
+                    distance = (px - x) ** 2 + (py - y) ** 2
+                    if distance <= r2:
+                        found.append((distance, i))
+        found.sort()
+        return [i for distance, i in found]
+
+    def in_rect(self, x0, y0, x1, y1):
+        """
+        Indices of the points with x0 <= x <= x1 and y0 <= y <= y1, in index
+        order
+        """
+        points = self.points
+        if len(points) <= SCAN_SIZE:
+            return [i for i, (px, py) in enumerate(points)
+                    if x0 <= px <= x1 and y0 <= py <= y1]
+
+        cell_x0, cell_y0 = self._cell(x0, y0)
+        cell_x1, cell_y1 = self._cell(x1, y1)
+        cells = self._grid()
+        found = []
+        for cell_x in xrange(cell_x0, cell_x1 + 1):
+            for cell_y in xrange(cell_y0, cell_y1 + 1):
+                for i in cells.get((cell_x, cell_y), ()):
+                    px, py = points[i]
+                    if x0 <= px <= x1 and y0 <= py <= y1:
+                        found.append(i)
+        found.sort()
+        return found
+
+class FieldIndex(object):
+    """
+    Grid indexes over the robots and balls of a FieldInfo (or
+    TrackedFieldInfo) in packed field units.  Build one per frame and share
+    it, the queries return the RobotInfo and ball objects themselves.
+    Building one only collects the positions, the grids are left to the
+    first query on the consumer threads.
+    """
+
+    def __init__(self, field_info, cell_size = DEFAULT_CELL_SIZE):
+        self.field_info = field_info
+        self.robots = GridIndex([(robot.pos.x, robot.pos.y)
+                                 for robot in field_info.robots], cell_size)
+        balls = [object_pos(ball) for ball in field_info.balls]
+        self.balls = GridIndex([(pos.x, pos.y) for pos in balls], cell_size)
+
+        # (team, id) and (None, id) to the first robot with them
+        self._robot_keys = {}
+        for i, robot in enumerate(field_info.robots):
+            self._robot_keys.setdefault((robot.team, robot.id), i)
+            self._robot_keys.setdefault((None, robot.id), i)
+
+    def robot(self, robot_id, team = None):
+        """
+        The first robot with the given id (on the given team if there is
+        one), or None
+        """
+        i = self._robot_keys.get((team, robot_id), None)
+        if i is None:
+            return None
+        return self.field_info.robots[i]
+
+    def nearest_balls(self, x, y, k = 1):
+        balls = self.field_info.balls
+        return [balls[i] for i in self.balls.nearest(x, y, k)]
+
+    def nearest_robots(self, x, y, k = 1):
+        robots = self.field_info.robots
+        return [robots[i] for i in self.robots.nearest(x, y, k)]
+
+    def balls_within(self, x, y, radius):
+        balls = self.field_info.balls
+        return [balls[i] for i in self.balls.within(x, y, radius)]
+
+    def robots_within(self, x, y, radius):
+        robots = self.field_info.robots
+        return [robots[i] for i in self.robots.within(x, y, radius)]
+
+    def balls_in_rect(self, x0, y0, x1, y1):
+        balls = self.field_info.balls
+        return [balls[i] for i in self.balls.in_rect(x0, y0, x1, y1)]
+
+    def robots_in_rect(self, x0, y0, x1, y1):
+        robots = self.field_info.robots
+        return [robots[i] for i in self.robots.in_rect(x0, y0, x1, y1)]
+
+    def nearest_balls_to_robot(self, robot_id, k = 1):
+        """
+        The k balls nearest the robot, or [] if it isn't on the field
+        """
+        robot = self.robot(robot_id)
+        if robot is None:
+            return []
+        return self.nearest_balls(robot.pos.x, robot.pos.y, k)
+
+class Subscription(object):
+    """
+    The part of each frame a brick wants: only robots and balls inside
+    region, an (x0, y0, x1, y1) rectangle in packed field units, only
+    robots of team and with one of robot_ids, and no more than max_balls
+    balls.  Given the id of the brick's own robot (looked up on team when
+    there is one) the balls nearest it are kept, nearest first, otherwise
+    the first ones.  None, or 0 for max_balls, lets everything through.
+    """
+
+    TEAMS = {'yellow' : messages.TEAM_YELLOW, 'blue' : messages.TEAM_BLUE}
+
+    def __init__(self, region = None, team = None, robot_ids = None,
+                 max_balls = 0, robot_id = None):
+        self.region = region
+        self.team = team
+        self.robot_ids = robot_ids
+        if robot_ids is not None:
+            self.robot_ids = frozenset(robot_ids)
+        self.max_balls = max_balls
+        self.robot_id = robot_id
+
+    @classmethod
+    def parse(cls, words, robot_id = None, max_balls = 0):
+        """
+        Builds a Subscription from NAME=VALUE words, ie:
+
+          region=0,0,64,127 team=blue robots=1,2 balls=3 robot=1
+
+        robot_id and max_balls are used unless robot or balls are given.
+        Raises ValueError if a word doesn't make sense.
+        """
+        options = {'robot_id' : robot_id, 'max_balls' : max_balls}
+        for word in words:
+            name, value = word.split('=', 1)
+            if name == 'region':
+                region = tuple([float(part) for part in value.split(',')])
+                if len(region) != 4:
+                    raise ValueError("region takes X0,Y0,X1,Y1")
+                options['region'] = region
+            elif name == 'team':
+                if value not in cls.TEAMS:
+                    raise ValueError("Unknown team: %s" % value)
+                options['team'] = cls.TEAMS[value]
+            elif name == 'robots':
+                options['robot_ids'] = [int(part) for part in value.split(',')]
+            elif name == 'balls':
+                options['max_balls'] = int(value)
+            elif name == 'robot':
+                options['robot_id'] = int(value)
+            else:
+                raise ValueError("Unknown subscription option: %s" % name)
+        return cls(**options)
+
+    def passes_all(self):
+        return self.region is None and self.team is None and \
+            self.robot_ids is None and self.max_balls <= 0
+
+    def apply(self, index):
+        """
+        A copy of the index's FieldInfo with only what we subscribe to, its
+        Header counts what is left
+        """
+        field_info = index.field_info
+        region = self.region
+
+        if region is None:
+            robots = field_info.robots
+            balls = field_info.balls
+        else:
+            robots = index.robots_in_rect(*region)
+            balls = index.balls_in_rect(*region)
+
+        if self.team is not None:
+            robots = [robot for robot in robots if robot.team == self.team]
+        if self.robot_ids is not None:
+            robots = [robot for robot in robots if robot.id in self.robot_ids]
+
+        if self.max_balls > 0:
+            own = None
+            if self.robot_id is not None:
+                own = index.robot(self.robot_id, self.team)
+
+            if own is None:
+                balls = balls[:self.max_balls]
+            elif region is None:
+                balls = index.nearest_balls(own.pos.x, own.pos.y,
+                                            self.max_balls)
+            else:
+                x, y = own.pos.x, own.pos.y
+                balls = heapq.nsmallest(
+                    self.max_balls, balls, key = lambda ball:
+                    (object_pos(ball).x - x) ** 2 +
+                    (object_pos(ball).y - y) ** 2)
+
+        subset = field_info.__class__(transform = field_info.transform)
+        subset.robots = list(robots)
+        subset.balls = list(balls)
+        subset.header = messages.Header(len(subset.robots), len(subset.balls))
+        return subset
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class TestGridIndex(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(7)
+        self.points = [(rand.uniform(-5, 132), rand.uniform(-5, 132))
+                       for i in xrange(0, 300)]
+        self.index = GridIndex(self.points)
+
+    def distance(self, i, x, y):
+        px, py = self.points[i]
+        return math.sqrt((px - x) ** 2 + (py - y) ** 2)
+
+    def test_nearest(self):
+        for x, y in ((0, 0), (64, 64), (127, 3), (-20, 200), (33.3, 90.1)):
+            expected = sorted(xrange(0, len(self.points)),
+                              key = lambda i: self.distance(i, x, y))[:5]
+            self.assertEquals(expected, self.index.nearest(x, y, 5))
+
+        self.assertEquals(len(self.points),
+                          len(self.index.nearest(10, 10, 1000)))
+        self.assertEquals([], GridIndex([]).nearest(10, 10))
+
+    def test_within(self):
+        for x, y, radius in ((64, 64, 10), (0, 0, 30), (100, 20, 0.5),
+                             (64, 64, 500)):
+            expected = sorted([i for i in xrange(0, len(self.points))
+                               if self.distance(i, x, y) <= radius],
+                              key = lambda i: self.distance(i, x, y))
+            self.assertEquals(expected, self.index.within(x, y, radius))
+
+    def test_in_rect(self):
+        for rect in ((10, 20, 50, 30), (-10, -10, 5, 140), (60, 60, 60, 60)):
+            x0, y0, x1, y1 = rect
+            expected = [i for i, (x, y) in enumerate(self.points)
+                        if x0 <= x <= x1 and y0 <= y <= y1]
+            self.assertEquals(expected, self.index.in_rect(*rect))
+
+    def test_lazy(self):
+        self.assertEquals(None, self.index._cells)
+        self.index.within(64, 64, 10)
+        self.assertNotEquals(None, self.index._cells)
+
+    def test_small(self):
+        # Scanned without ever building the cells
+        points = self.points[:SCAN_SIZE]
+        index = GridIndex(points)
+        big = GridIndex(points + [(500, 500)] * 10)
+        for x, y in ((0, 0), (64, 64), (-20, 200)):
+            self.assertEquals(big.nearest(x, y, 3), index.nearest(x, y, 3))
+            self.assertEquals(big.within(x, y, 40), index.within(x, y, 40))
+        self.assertEquals(big.in_rect(10, 20, 80, 90),
+                          index.in_rect(10, 20, 80, 90))
+        self.assertEquals(None, index._cells)
+
+class TestFieldIndex(unittest.TestCase):
+    def setUp(self):
+        self.field_info = messages.FieldInfo()
+        self.field_info.robots = [
+            messages.RobotInfo(1, 0.0, messages.Vector2D(12, 10)),
+            messages.RobotInfo(2, 0.0, messages.Vector2D(100, 60))]
+        self.field_info.balls = [messages.Vector2D(x, 60)
+                                 for x in (0, 20, 40, 90, 120)]
+        self.field_info.header = messages.Header(2, 5)
+        self.index = FieldIndex(self.field_info)
+
+    def test_queries(self):
+        self.assertEquals([messages.Vector2D(90, 60),
+                           messages.Vector2D(120, 60)],
+                          self.index.nearest_balls_to_robot(2, 2))
+        self.assertEquals([2], [robot.id for robot in
+                                self.index.robots_within(95, 60, 10)])
+        self.assertEquals(3, len(self.index.balls_in_rect(0, 0, 50, 127)))
+        self.assertEquals([], self.index.nearest_balls_to_robot(9))
+
+    def test_nearest_balls(self):
+        subset = Subscription(max_balls = 2, robot_id = 1).apply(self.index)
+        self.assertEquals(messages.Header(2, 2), subset.header)
+        self.assertEquals([messages.Vector2D(20, 60),
+                           messages.Vector2D(0, 60)], subset.balls)
+        self.assertEquals(messages.Header.PACKED_SIZE +
+                          2 * messages.RobotInfo.PACKED_SIZE +
+                          2 * messages.Vector2D.PACKED_SIZE,
+                          len(subset.pack()))
+
+        # Unknown robots get the first balls
+        subset = Subscription(max_balls = 2, robot_id = 9).apply(self.index)
+        self.assertEquals(self.field_info.balls[:2], subset.balls)
+
+    def test_tracked(self):
+        field_info = messages.TrackedFieldInfo()
+        field_info.balls = [messages.Ball(messages.Vector2D(5, 5)),
+                            messages.Ball(messages.Vector2D(50, 50))]
+        field_info.header = messages.Header(0, 2)
+        index = FieldIndex(field_info)
+        self.assertEquals([field_info.balls[1]],
+                          index.nearest_balls(60, 60))
+        self.assertTrue(isinstance(Subscription(max_balls = 1).apply(index),
+                                   messages.TrackedFieldInfo))
+
+class TestSubscription(unittest.TestCase):
+    def setUp(self):
+        field_info = messages.FieldInfo()
+        field_info.robots = [
+            messages.RobotInfo(1, 0.0, messages.Vector2D(10, 10),
+                               messages.TEAM_YELLOW),
+            messages.RobotInfo(2, 0.0, messages.Vector2D(100, 100),
+                               messages.TEAM_YELLOW),
+            messages.RobotInfo(1, 0.0, messages.Vector2D(20, 100),
+                               messages.TEAM_BLUE)]
+        field_info.balls = [messages.Vector2D(x, x)
+                            for x in (5, 30, 60, 90, 120)]
+        field_info.header = messages.Header(3, 5)
+        self.index = FieldIndex(field_info)
+
+    def apply(self, words):
+        subset = Subscription.parse(words).apply(self.index)
+        return ([(robot.team, robot.id) for robot in subset.robots],
+                [ball.x for ball in subset.balls], subset.header)
+
+    def test_passes_all(self):
+        self.assertTrue(Subscription.parse([]).passes_all())
+        self.assertEquals(([(0, 1), (0, 2), (1, 1)], [5, 30, 60, 90, 120],
+                           messages.Header(3, 5)), self.apply([]))
+
+    def test_region(self):
+        self.assertEquals(([(0, 1), (1, 1)], [5, 30, 60],
+                           messages.Header(2, 3)),
+                          self.apply(['region=0,0,64,127']))
+
+    def test_team_and_ids(self):
+        self.assertEquals(([(1, 1)], [5, 30, 60, 90, 120],
+                           messages.Header(1, 5)),
+                          self.apply(['team=blue']))
+        self.assertEquals(([(0, 2)], [5, 30, 60, 90, 120],
+                           messages.Header(1, 5)),
+                          self.apply(['team=yellow', 'robots=2,5']))
+
+    def test_max_balls(self):
+        # Nearest the blue robot 1 at (20, 100), not the yellow one
+        self.assertEquals(([(1, 1)], [60, 30], messages.Header(1, 2)),
+                          self.apply(['team=blue', 'robot=1', 'balls=2']))
+        self.assertEquals([5, 30], self.apply(['region=0,0,64,127',
+                                               'robot=1', 'balls=2'])[1])
+
+        # Defaults only fill in what isn't given
+        subscription = Subscription.parse(['balls=1'], robot_id = 2,
+                                          max_balls = 4)
+        self.assertEquals((2, 1), (subscription.robot_id,
+                                   subscription.max_balls))
+
+    def test_bad(self):
+        for words in (['region=1,2'], ['team=red'], ['color=blue'],
+                      ['balls'], ['robots=a']):
+            self.assertRaises(ValueError, Subscription.parse, words)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,595 @@
+# Standard Imports
+import unittest
+
+# Project Imports
+import messages
+import proto.messages_robocup_ssl_detection_pb2 as ssl_detection
+
+# Library Imports
+import numpy
+
+
+__doc__ = """
+Tracks the balls and robots across detection frames, from every camera, with
+a constant velocity Kalman filter per object.  Robots are matched up by team
+and id, balls to the nearest predicted ball within a gate.  The filter state
+of every track lives in NumPy arrays so each predict and update step is a
+handful of array operations, however many objects are on the field.
+
+The tracker's output, a TrackedFrame, gives the filtered positions, the
+velocities and a confidence for each ball, and is packed as a
+messages.TrackedFieldInfo so the bricks can extrapolate the balls' positions
+to when they read them.
+"""
+
+# Robot keys are (TEAM_YELLOW or TEAM_BLUE, robot_id)
+TEAM_YELLOW = messages.TEAM_YELLOW
+TEAM_BLUE = messages.TEAM_BLUE
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def transition_matrices(dt):
+    """
+    The constant velocity state transition matrix for each of the dt
+    """
+    F = numpy.zeros((len(dt), 4, 4))
+    F[:, 0, 0] = F[:, 1, 1] = F[:, 2, 2] = F[:, 3, 3] = 1.0
+    F[:, 0, 2] = F[:, 1, 3] = dt
+    return F
+
+def process_noise_matrices(dt, acceleration_noise):
+    """
+    Process noise for each of the dt, from a white noise acceleration with
+    the given standard deviation in mm/s^2 on each axis
+    """
+    q = acceleration_noise ** 2
+    Q = numpy.zeros((len(dt), 4, 4))
+    Q[:, 0, 0] = Q[:, 1, 1] = q * dt ** 3 / 3.0
+    Q[:, 0, 2] = Q[:, 2, 0] = Q[:, 1, 3] = Q[:, 3, 1] = q * dt ** 2 / 2.0
+    Q[:, 2, 2] = Q[:, 3, 3] = q * dt
+    return Q
+
+def greedy_match(distances, gate):
+    """
+    Pairs up rows and columns of the distance matrix, closest first, leaving
+    out any pair further apart than gate.  Returns (rows, columns) arrays.
+    """
+    num_rows, num_columns = distances.shape
+    if num_rows == 0 or num_columns == 0:
+        return (numpy.array([], dtype = numpy.intp),
+                numpy.array([], dtype = numpy.intp))
+
+    # Pairs which are each other's nearest would be picked first anyway, on
+    # a normal frame that is nearly all of them
+    all_rows = numpy.arange(num_rows)
+    nearest_column = distances.argmin(axis = 1)
+    nearest_row = distances.argmin(axis = 0)
+    mutual = (nearest_row[nearest_column] == all_rows) & \
+        (distances[all_rows, nearest_column] < gate)
+    matched_rows = list(all_rows[mutual])
+    matched_columns = list(nearest_column[mutual])
+
+    # The rest closest first
+    free_rows = numpy.ones(num_rows, dtype = bool)
+    free_rows[matched_rows] = False
+    free_columns = numpy.ones(num_columns, dtype = bool)
+    free_columns[matched_columns] = False
+    row_ids = numpy.nonzero(free_rows)[0]
+    column_ids = numpy.nonzero(free_columns)[0]
+    rest = distances[row_ids][:, column_ids]
+
+    rows, columns = numpy.nonzero(rest < gate)
+    order = numpy.argsort(rest[rows, columns])
+    used_rows = set()
+    used_columns = set()
+    for i in order:
+        row = rows[i]
+        column = columns[i]
+        if row in used_rows or column in used_columns:
+            continue
+        used_rows.add(row)
+        used_columns.add(column)
+        matched_rows.append(row_ids[row])
+        matched_columns.append(column_ids[column])
+
+    return (numpy.array(matched_rows, dtype = numpy.intp),
+            numpy.array(matched_columns, dtype = numpy.intp))
+
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class TrackSet(object):
+    """
+    A constant velocity Kalman filter for each of a set of tracks.  Track i
+    has the state state[i] (x, y, vx, vy in mm and mm/s) and covariance
+    covariance[i], every step runs on all the tracks at once.  Tracks may be
+    given a key to find them by.
+    """
+
+    def __init__(self, acceleration_noise, measurement_noise,
+                 initial_velocity_noise, capacity = 16):
+        self._acceleration_noise = acceleration_noise
+        self._measurement_noise = measurement_noise
+        self._initial_velocity_noise = initial_velocity_noise
+
+        self.count = 0
+        self.state = numpy.zeros((capacity, 4))
+        self.covariance = numpy.zeros((capacity, 4, 4))
+        # Time the state is for, and time of the last measurement
+        self.time = numpy.zeros(capacity)
+        self.hit_time = numpy.zeros(capacity)
+        self.hits = numpy.zeros(capacity, dtype = numpy.intc)
+        self.confidence = numpy.zeros(capacity)
+        self.heading = numpy.zeros(capacity)
+        self.keys = []
+        self._index = {}
+
+    def __len__(self):
+        return self.count
+
+    def find(self, key):
+        return self._index.get(key, None)
+
+    def predict(self, t):
+        """
+        Moves every track forward to time t, tracks which are already past
+        it (from a camera whose frames come in a little behind) stay put
+        """
+        n = self.count
+        if n == 0:
+            return
+
+        dt = numpy.maximum(t - self.time[:n], 0.0)
+        F = transition_matrices(dt)
+        self.state[:n] = numpy.einsum('nij,nj->ni', F, self.state[:n])
+        self.covariance[:n] = numpy.einsum('nij,njk,nlk->nil', F,
+                                           self.covariance[:n], F) + \
+            process_noise_matrices(dt, self._acceleration_noise)
+        self.time[:n] = numpy.maximum(self.time[:n], t)
+
+    def update(self, indices, positions, confidences, t):
+        """
+        Measures the tracks at indices at the given (k, 2) positions.  Less
+        confident detections are trusted less.
+        """
+        if len(indices) == 0:
+            return
+
+        covariance = self.covariance[indices]
+        noise = self._measurement_noise ** 2 / \
+            numpy.maximum(confidences, 0.05)
+
+        # Innovation covariance S = HPH' + R and its 2x2 inverse
+        a = covariance[:, 0, 0] + noise
+        b = covariance[:, 0, 1]
+        c = covariance[:, 1, 0]
+        d = covariance[:, 1, 1] + noise
+        det = a * d - b * c
+        S_inv = numpy.empty((len(indices), 2, 2))
+        S_inv[:, 0, 0] = d / det
+        S_inv[:, 0, 1] = -b / det
+        S_inv[:, 1, 0] = -c / det
+        S_inv[:, 1, 1] = a / det
+
+        gain = numpy.einsum('nij,njk->nik', covariance[:, :, :2], S_inv)
+        innovation = positions - self.state[indices, :2]
+        self.state[indices] += numpy.einsum('nij,nj->ni', gain, innovation)
+        self.covariance[indices] = covariance - \
+            numpy.einsum('nij,njk->nik', gain, covariance[:, :2, :])
+
+        self.hit_time[indices] = t
+        self.hits[indices] += 1
+        self.confidence[indices] = 0.5 * (self.confidence[indices] +
+                                          confidences)
+
+    def add(self, positions, confidences, t, keys = None):
+        """
+        Starts a track at each of the (k, 2) positions, at rest
+        """
+        k = len(positions)
+        if k == 0:
+            return
+        self._reserve(self.count + k)
+
+        new = slice(self.count, self.count + k)
+        self.state[new] = 0.0
+        self.state[new, :2] = positions
+        self.covariance[new] = 0.0
+        self.covariance[new, 0, 0] = self.covariance[new, 1, 1] = \
+            self._measurement_noise ** 2
+        self.covariance[new, 2, 2] = self.covariance[new, 3, 3] = \
+            self._initial_velocity_noise ** 2
+        self.time[new] = t
+        self.hit_time[new] = t
+        self.hits[new] = 1
+        self.confidence[new] = confidences
+
+        if keys is None:
+            keys = [None] * k
+        for i, key in enumerate(keys):
+            self.keys.append(key)
+            if key is not None:
+                self._index[key] = self.count + i
+        self.count += k
+
+    def expire(self, t, timeout):
+        """
+        Drops the tracks which haven't been seen for timeout seconds
+        """
+        n = self.count
+        keep = numpy.nonzero(t - self.hit_time[:n] <= timeout)[0]
+        if len(keep) == n:
+            return
+
+        for array in (self.state, self.covariance, self.time, self.hit_time,
+                      self.hits, self.confidence, self.heading):
+            array[:len(keep)] = array[keep]
+        self.keys = [self.keys[i] for i in keep]
+        self._index = dict([(key, i) for i, key in enumerate(self.keys)
+                            if key is not None])
+        self.count = len(keep)
+
+    def _reserve(self, count):
+        capacity = len(self.time)
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+
+        for name in ('state', 'covariance', 'time', 'hit_time', 'hits',
+                     'confidence', 'heading'):
+            old = getattr(self, name)
+            new = numpy.zeros((capacity,) + old.shape[1:], dtype = old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+class TrackedFrame(object):
+    """
+    Snapshot of the tracks after a detection frame, all positions are in
+    ssl-vision millimeters at t_capture.  received is the local time the
+    frame that made it came in.
+    """
+
+    def __init__(self, frame_number, t_capture, received, robot_keys,
+                 robot_states, robot_headings, ball_states,
+                 ball_confidences):
+        self.frame_number = frame_number
+        self.t_capture = t_capture
+        self.received = received
+        self.robot_keys = robot_keys
+        self.robot_states = robot_states
+        self.robot_headings = robot_headings
+        self.ball_states = ball_states
+        self.ball_confidences = ball_confidences
+
+    def field_info(self, transform, lead = 0.0):
+        """
+        Builds the messages.TrackedFieldInfo for this frame with the given
+        messages.FieldTransform, with everything moved lead seconds ahead
+        """
+        field_info = messages.TrackedFieldInfo(transform = transform)
+        scale = transform.scale
+        top = messages.MAX_PACKED_FLOAT
+
+        robots = self.robot_states
+        xs = numpy.clip((robots[:, 0] + robots[:, 2] * lead) * scale +
+                        transform.x_shift, 0.0, top)
+        ys = numpy.clip((robots[:, 1] + robots[:, 3] * lead) * scale +
+                        transform.y_shift, 0.0, top)
+        for i, (team, robot_id) in enumerate(self.robot_keys):
+            field_info.robots.append(
+                messages.RobotInfo(robot_id, float(self.robot_headings[i]),
+                                   messages.Vector2D(float(xs[i]),
+                                                     float(ys[i])), team))
+
+        balls = self.ball_states
+        xs = numpy.clip((balls[:, 0] + balls[:, 2] * lead) * scale +
+                        transform.x_shift, 0.0, top)
+        ys = numpy.clip((balls[:, 1] + balls[:, 3] * lead) * scale +
+                        transform.y_shift, 0.0, top)
+        for i in xrange(0, len(balls)):
+            field_info.balls.append(messages.Ball(
+                messages.Vector2D(float(xs[i]), float(ys[i])),
+                messages.Vector2D(float(balls[i, 2] * scale),
+                                  float(balls[i, 3] * scale)),
+                float(self.ball_confidences[i])))
+
+        field_info.header = messages.Header(len(field_info.robots),
+                                            len(field_info.balls))
+        return field_info
+
+class Tracker(object):
+    """
+    Follows the balls and robots through detection frames from any number
+    of cameras (or the frame merger).  A ball detection joins the nearest
+    predicted ball within ball_gate mm, or starts a new ball.  Balls are
+    only reported once they have been seen min_ball_hits times, and any
+    track not seen for timeout seconds is dropped.
+
+    A ball's confidence is the running average of its detections'
+    confidences, fading out as it goes unseen.
+    """
+
+    def __init__(self, ball_gate = 500.0, timeout = 0.5, min_ball_hits = 2,
+                 ball_acceleration = 4000.0, robot_acceleration = 3000.0,
+                 measurement_noise = 10.0):
+        self._ball_gate = ball_gate
+        self._timeout = timeout
+        self._min_ball_hits = min_ball_hits
+        self.balls = TrackSet(ball_acceleration, measurement_noise, 2000.0)
+        self.robots = TrackSet(robot_acceleration, measurement_noise, 1000.0)
+
+        # Counters
+        self.frames = 0
+        self.balls_started = 0
+
+    def update(self, frame, received = 0.0):
+        """
+        Takes in an SSL_DetectionFrame, returns the TrackedFrame after it
+        """
+        t = frame.t_capture
+        self.frames += 1
+
+        self.balls.predict(t)
+        self.robots.predict(t)
+        self._update_balls(frame.balls, t)
+        self._update_robots(frame, t)
+        self.balls.expire(t, self._timeout)
+        self.robots.expire(t, self._timeout)
+
+        return self._snapshot(frame.frame_number, t, received)
+
+    def _update_balls(self, detections, t):
+        k = len(detections)
+        if k == 0:
+            return
+
+        positions = numpy.array([(ball.x, ball.y) for ball in detections])
+        confidences = numpy.array([ball.confidence for ball in detections])
+
+        n = self.balls.count
+        rows = columns = numpy.array([], dtype = numpy.intp)
+        if n:
+            offsets = self.balls.state[:n, None, :2] - positions[None, :, :]
+            distances = numpy.sqrt((offsets ** 2).sum(axis = 2))
+            rows, columns = greedy_match(distances, self._ball_gate)
+            self.balls.update(rows, positions[columns], confidences[columns],
+                              t)
+
+        unmatched = numpy.ones(k, dtype = bool)
+        unmatched[columns] = False
+        self.balls.add(positions[unmatched], confidences[unmatched], t)
+        self.balls_started += int(unmatched.sum())
+
+    def _update_robots(self, frame, t):
+        detections = [((TEAM_YELLOW, robot.robot_id), robot)
+                      for robot in frame.robots_yellow] + \
+                     [((TEAM_BLUE, robot.robot_id), robot)
+                      for robot in frame.robots_blue]
+        if not detections:
+            return
+
+        indices = []
+        matched = []
+        new = []
+        for key, robot in detections:
+            index = self.robots.find(key)
+            if index is None:
+                new.append((key, robot))
+            else:
+                indices.append(index)
+                matched.append(robot)
+
+        if matched:
+            indices = numpy.array(indices, dtype = numpy.intp)
+            self.robots.update(indices,
+                               numpy.array([(r.x, r.y) for r in matched]),
+                               numpy.array([r.confidence for r in matched]),
+                               t)
+            self.robots.heading[indices] = [r.orientation for r in matched]
+
+        if new:
+            start = self.robots.count
+            self.robots.add(numpy.array([(r.x, r.y) for key, r in new]),
+                            numpy.array([r.confidence for key, r in new]),
+                            t, [key for key, r in new])
+            self.robots.heading[start:self.robots.count] = \
+                [r.orientation for key, r in new]
+
+    def _snapshot(self, frame_number, t, received):
+        robots = self.robots
+        n = robots.count
+        order = sorted(xrange(0, n), key = lambda i: robots.keys[i])
+
+        balls = self.balls
+        m = balls.count
+        shown = numpy.nonzero(balls.hits[:m] >= self._min_ball_hits)[0]
+        age = t - balls.hit_time[shown]
+        fade = numpy.clip(1.0 - age / self._timeout, 0.0, 1.0)
+
+        return TrackedFrame(frame_number, t, received,
+                            [robots.keys[i] for i in order],
+                            robots.state[order].copy(),
+                            robots.heading[order].copy(),
+                            balls.state[shown].copy(),
+                            balls.confidence[shown] * fade)
+
+    def stats_line(self):
+        return "tracker: %d frames, %d balls %d robots tracked, %d balls " \
+            "started" % (self.frames, self.balls.count, self.robots.count,
+                         self.balls_started)
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+def make_frame(t, balls = (), robots = (), camera_id = 0):
+    """
+    Detection frame with balls at the given (x, y) and yellow robots at the
+    given (id, x, y)
+    """
+    frame = ssl_detection.SSL_DetectionFrame()
+    frame.frame_number = int(t * 60)
+    frame.t_capture = t
+    frame.t_sent = t
+    frame.camera_id = camera_id
+    for x, y in balls:
+        ball = frame.balls.add()
+        ball.confidence = 1.0
+        ball.x = x
+        ball.y = y
+        ball.pixel_x = ball.pixel_y = 0
+    for robot_id, x, y in robots:
+        robot = frame.robots_yellow.add()
+        robot.confidence = 1.0
+        robot.robot_id = robot_id
+        robot.x = x
+        robot.y = y
+        robot.orientation = 0.5
+        robot.pixel_x = robot.pixel_y = 0
+    return frame
+
+class TestGreedyMatch(unittest.TestCase):
+    def brute_force(self, distances, gate):
+        pairs = sorted([(distances[i, j], i, j)
+                        for i in xrange(0, distances.shape[0])
+                        for j in xrange(0, distances.shape[1])
+                        if distances[i, j] < gate])
+        rows = set()
+        columns = set()
+        matches = []
+        for distance, i, j in pairs:
+            if i not in rows and j not in columns:
+                rows.add(i)
+                columns.add(j)
+                matches.append((i, j))
+        return sorted(matches)
+
+    def test_matches_brute_force(self):
+        rand = numpy.random.RandomState(3)
+        for shape in ((0, 3), (4, 0), (5, 5), (8, 3), (3, 9), (30, 30)):
+            distances = rand.uniform(0, 100, shape)
+            rows, columns = greedy_match(distances, 60.0)
+            self.assertEquals(self.brute_force(distances, 60.0),
+                              sorted(zip(rows, columns)))
+
+class TestTrackSet(unittest.TestCase):
+    def test_batch_matches_single(self):
+        # Filtering tracks together gives the same as one at a time
+        together = TrackSet(1000.0, 10.0, 1000.0)
+        together.add(numpy.array([[0.0, 0.0], [100.0, 50.0]]),
+                     numpy.ones(2), 0.0)
+        alone = [TrackSet(1000.0, 10.0, 1000.0) for i in xrange(0, 2)]
+        alone[0].add(numpy.array([[0.0, 0.0]]), numpy.ones(1), 0.0)
+        alone[1].add(numpy.array([[100.0, 50.0]]), numpy.ones(1), 0.0)
+
+        measurements = numpy.array([[10.0, 5.0], [90.0, 60.0]])
+        for track_set in [together] + alone:
+            track_set.predict(0.1)
+        together.update(numpy.array([0, 1]), measurements, numpy.ones(2),
+                        0.1)
+        for i in xrange(0, 2):
+            alone[i].update(numpy.array([0]), measurements[i:i + 1],
+                            numpy.ones(1), 0.1)
+            self.assertTrue(numpy.allclose(alone[i].state[0],
+                                           together.state[i]))
+            self.assertTrue(numpy.allclose(alone[i].covariance[0],
+                                           together.covariance[i]))
+
+    def test_grow_and_expire(self):
+        track_set = TrackSet(1000.0, 10.0, 1000.0, capacity = 2)
+        track_set.add(numpy.zeros((3, 2)), numpy.ones(3), 0.0,
+                      ['a', 'b', 'c'])
+        track_set.add(numpy.zeros((2, 2)), numpy.ones(2), 1.0, ['d', 'e'])
+        self.assertEquals(5, len(track_set))
+
+        track_set.expire(1.0, 0.5)
+        self.assertEquals(['d', 'e'], track_set.keys)
+        self.assertEquals(1, track_set.find('e'))
+        self.assertEquals(None, track_set.find('a'))
+
+class TestTracker(unittest.TestCase):
+    def setUp(self):
+        self.tracker = Tracker()
+
+    def test_constant_velocity(self):
+        # Ball rolling at 1000 mm/s along x, seen at 60Hz
+        for i in xrange(0, 60):
+            t = i / 60.0
+            tracked = self.tracker.update(make_frame(t, [(t * 1000, 200.0)]))
+
+        self.assertEquals(1, len(tracked.ball_states))
+        x, y, vx, vy = tracked.ball_states[0]
+        self.assertAlmostEquals(t * 1000, x, -1)
+        self.assertAlmostEquals(1000.0, vx, -1)
+        self.assertAlmostEquals(0.0, vy, -1)
+        self.assertAlmostEquals(1.0, tracked.ball_confidences[0], 1)
+
+    def test_association(self):
+        # Two balls moving apart, seen by two cameras in turn
+        for i in xrange(0, 30):
+            t = i / 60.0
+            frame = make_frame(t, [(1000 - t * 500, 0.0),
+                                   (1500 + t * 500, 0.0)],
+                               camera_id = i % 2)
+            tracked = self.tracker.update(frame)
+
+        self.assertEquals(2, self.tracker.balls_started)
+        velocities = sorted(tracked.ball_states[:, 2])
+        self.assertAlmostEquals(-500.0, velocities[0], -1)
+        self.assertAlmostEquals(500.0, velocities[1], -1)
+
+    def test_min_hits_and_timeout(self):
+        tracked = self.tracker.update(make_frame(0.0, [(0.0, 0.0)]))
+        self.assertEquals(0, len(tracked.ball_states))
+        tracked = self.tracker.update(make_frame(0.02, [(1.0, 0.0)]))
+        self.assertEquals(1, len(tracked.ball_states))
+
+        # Unseen balls fade out then go
+        tracked = self.tracker.update(make_frame(0.27))
+        self.assertAlmostEquals(0.5, tracked.ball_confidences[0], 1)
+        tracked = self.tracker.update(make_frame(0.6))
+        self.assertEquals(0, len(tracked.ball_states))
+        self.assertEquals(0, self.tracker.balls.count)
+
+    def test_robots(self):
+        for i in xrange(0, 30):
+            t = i / 60.0
+            frame = make_frame(t, robots = [(4, 0.0, t * 600), (1, 50, 50)])
+            tracked = self.tracker.update(frame)
+
+        self.assertEquals([(TEAM_YELLOW, 1), (TEAM_YELLOW, 4)],
+                          tracked.robot_keys)
+        self.assertAlmostEquals(600.0, tracked.robot_states[1, 3], -1)
+        self.assertEquals(0.5, tracked.robot_headings[0])
+
+    def test_field_info(self):
+        for i in xrange(0, 30):
+            t = i / 60.0
+            frame = make_frame(t, [(t * 1000, 0.0)], robots = [(2, 0.0, 0.0)])
+            tracked = self.tracker.update(frame)
+
+        transform = messages.FieldTransform(60.0, 30.0, 0.01)
+        field_info = tracked.field_info(transform)
+        self.assertEquals(messages.Header(1, 1), field_info.header)
+        self.assertEquals(2, field_info.robots[0].id)
+        self.assertEquals(TEAM_YELLOW, field_info.robots[0].team)
+        ball = field_info.balls[0]
+        self.assertAlmostEquals(60.0 + t * 10, ball.pos.x, 0)
+        self.assertAlmostEquals(10.0, ball.velocity.x, 0)
+
+        ahead = tracked.field_info(transform, lead = 0.5)
+        self.assertAlmostEquals(ball.pos.x + 5.0, ahead.balls[0].pos.x, 0)
+
+        data = field_info.pack()
+        self.assertEquals(round(ball.velocity.x),
+                          messages.TrackedFieldInfo.unpack(data).balls[0]
+                          .velocity.x)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+#! /usr/bin/env python
+
+# Python Imports
+import os
+import sys
+import mmap
+import time
+import struct
+import optparse
+import tempfile
+import unittest
+
+# Project Imports
+import receiver
+
+
+__doc__ = """
+Records the raw SSL_WrapperPacket datagrams from the ssl-vision multicast
+group to a log file, and replays them back out to a multicast group in real
+time, faster, or as fast as possible.
+
+The log is LOG_MAGIC followed by one record per datagram: a RECORD_HEADER
+(the receive time as a double and the datagram length, little endian) and
+then the datagram itself.  Logs are read through mmap so recordings of whole
+matches don't have to fit in memory.
+
+Usage:
+  vision_log.py record FILE
+  vision_log.py replay FILE [--speed N | --fast]
+"""
+
+LOG_MAGIC = 'SSLVLOG1'
+RECORD_HEADER = struct.Struct('<dH')
+
+#-----------------------------------------------------------------------------#
+#                                C L A S S E S                                #
+#-----------------------------------------------------------------------------#
+
+class LogWriter(object):
+    """
+    Appends datagrams to a log file
+    """
+
+    def __init__(self, fileobj, write_magic = True):
+        self._fileobj = fileobj
+        if write_magic:
+            fileobj.write(LOG_MAGIC)
+        self.records = 0
+
+    def write(self, data, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._fileobj.write(RECORD_HEADER.pack(timestamp, len(data)))
+        self._fileobj.write(data)
+        self.records += 1
+
+    def flush(self):
+        self._fileobj.flush()
+
+class LogReader(object):
+    """
+    Iterates over the (timestamp, datagram) records of a log file.  The
+    datagrams are read only buffers into the memory mapped file.  A record
+    cut short at the end of the file (the recorder was killed mid write) is
+    skipped.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size < len(LOG_MAGIC):
+            raise ValueError("Not a vision log: %s" % path)
+
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access = mmap.ACCESS_READ)
+        if self._map[:len(LOG_MAGIC)] != LOG_MAGIC:
+            self.close()
+            raise ValueError("Not a vision log: %s" % path)
+
+    def __iter__(self):
+        offset = len(LOG_MAGIC)
+        end = len(self._map)
+        while offset + RECORD_HEADER.size <= end:
+            timestamp, size = RECORD_HEADER.unpack_from(self._map, offset)
+            offset += RECORD_HEADER.size
+            if offset + size > end:
+                break
+
+            yield timestamp, buffer(self._map, offset, size)
+            offset += size
+
+    def complete_size(self):
+        """
+        The size of the log up to the end of its last complete record
+        """
+        offset = len(LOG_MAGIC)
+        end = len(self._map)
+        while offset + RECORD_HEADER.size <= end:
+            timestamp, size = RECORD_HEADER.unpack_from(self._map, offset)
+            if offset + RECORD_HEADER.size + size > end:
+                break
+            offset += RECORD_HEADER.size + size
+        return offset
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+#-----------------------------------------------------------------------------#
+#                       H E L P E R   F U N C T I O N S                       #
+#-----------------------------------------------------------------------------#
+
+def open_log_writer(path):
+    """
+    Opens a LogWriter which appends to the log at path, creating it if
+    needed.  A record cut short at the end of the log is cut off, so the
+    new records start right after the last complete one.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return LogWriter(open(path, 'wb'))
+
+    reader = LogReader(path)
+    size = reader.complete_size()
+    reader.close()
+
+    fileobj = open(path, 'r+b')
+    fileobj.seek(size)
+    fileobj.truncate()
+    return LogWriter(fileobj, write_magic = False)
+
+def record(datagram_receiver, writer):
+    """
+    Writes everything the receiver gets to the log until interrupted
+    """
+    try:
+        while True:
+            datagrams = datagram_receiver.receive()
+            now = time.time()
+            for data in datagrams:
+                writer.write(data, now)
+    except KeyboardInterrupt:
+        pass
+    writer.flush()
+
+def replay(reader, sock, address, speed = 1.0, clock = time.time,
+           sleep = time.sleep):
+    """
+    Sends the logged datagrams to address, keeping their original spacing
+    sped up by speed times (None or 0 sends them as fast as possible).
+    Returns the number of datagrams sent.
+    """
+    sent = 0
+    start = None
+    for timestamp, data in reader:
+        if speed:
+            if start is None:
+                start = clock()
+                first = timestamp
+
+            delay = (timestamp - first) / speed - (clock() - start)
+            if delay > 0:
+                sleep(delay)
+
+        sock.sendto(data, address)
+        sent += 1
+
+    return sent
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = optparse.OptionParser(usage = "%prog record|replay FILE")
+    parser.set_defaults(host = "224.5.23.2", port = 10002, speed = 1.0,
+                        repeat = 1)
+    parser.add_option("-H", "--host", dest="host", type="string",
+                      help="UDP multicast ip address")
+    parser.add_option("-p", "--port", dest="port", type="int",
+                      help="UDP multicast port")
+    parser.add_option("-s", "--speed", dest="speed", type="float",
+                      help="Replay speed as a multiple of real time")
+    parser.add_option("-f", "--fast", dest="speed", action="store_const",
+                      const=0, help="Replay as fast as possible")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int",
+                      help="Number of times to replay the log")
+    (options, args) = parser.parse_args(argv[1:])
+
+    if len(args) != 2 or args[0] not in ('record', 'replay'):
+        parser.error("Need a command (record or replay) and a log file")
+    command, path = args
+
+    if command == 'record':
+        sock = receiver.open_mcast_socket(options.host, options.port)
+        writer = open_log_writer(path)
+        record(receiver.DatagramReceiver(sock), writer)
+        print "Recorded %d datagrams" % writer.records
+    else:
+        sock = receiver.open_mcast_sender()
+        reader = LogReader(path)
+        start = time.time()
+        sent = 0
+        for i in xrange(0, options.repeat):
+            sent += replay(reader, sock, (options.host, options.port),
+                           options.speed)
+        elapsed = time.time() - start
+        reader.close()
+        print "Sent %d datagrams in %.2f s (%.1f/s)" % \
+            (sent, elapsed, sent / max(elapsed, 1e-6))
+
+
+#-----------------------------------------------------------------------------#
+#                                T E S T S                                    #
+#-----------------------------------------------------------------------------#
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((str(data), address))
+
+class TestVisionLog(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+        writer = open_log_writer(self.path)
+        writer.write('first', 10.0)
+        writer.write('', 10.5)
+        writer.write('third', 12.0)
+        writer.flush()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def read_all(self):
+        reader = LogReader(self.path)
+        records = [(timestamp, str(data)) for timestamp, data in reader]
+        reader.close()
+        return records
+
+    def test_round_trip(self):
+        self.assertEquals([(10.0, 'first'), (10.5, ''), (12.0, 'third')],
+                          self.read_all())
+
+    def test_append(self):
+        writer = open_log_writer(self.path)
+        writer.write('fourth', 13.0)
+        writer.flush()
+        self.assertEquals((13.0, 'fourth'), self.read_all()[-1])
+
+    def test_truncated(self):
+        fileobj = open(self.path, 'ab')
+        fileobj.write(RECORD_HEADER.pack(14.0, 100) + 'cut short')
+        fileobj.close()
+        self.assertEquals(3, len(self.read_all()))
+
+    def test_append_after_truncated(self):
+        # The recorder was killed part way through the last record
+        size = os.path.getsize(self.path)
+        fileobj = open(self.path, 'r+b')
+        fileobj.truncate(size - 3)
+        fileobj.close()
+
+        writer = open_log_writer(self.path)
+        writer.write('fourth', 13.0)
+        writer.write('fifth', 14.0)
+        writer.flush()
+        self.assertEquals([(10.0, 'first'), (10.5, ''), (13.0, 'fourth'),
+                           (14.0, 'fifth')], self.read_all())
+
+        # A cut inside a record header too
+        size = os.path.getsize(self.path)
+        fileobj = open(self.path, 'r+b')
+        fileobj.truncate(size - len('fifth') - 4)
+        fileobj.close()
+
+        writer = open_log_writer(self.path)
+        writer.write('sixth', 15.0)
+        writer.flush()
+        self.assertEquals([(10.0, 'first'), (10.5, ''), (13.0, 'fourth'),
+                           (15.0, 'sixth')], self.read_all())
+
+    def test_bad_magic(self):
+        open(self.path, 'wb').write('NOTALOGFILE')
+        self.assertRaises(ValueError, LogReader, self.path)
+
+    def test_replay_timing(self):
+        sleeps = []
+        sock = FakeSocket()
+        reader = LogReader(self.path)
+        sent = replay(reader, sock, ('224.5.23.2', 10002), speed = 2.0,
+                      clock = lambda: 0.0, sleep = sleeps.append)
+        reader.close()
+
+        self.assertEquals(3, sent)
+        self.assertEquals([0.25, 1.0], sleeps)
+        self.assertEquals('third', sock.sent[2][0])
+
+    def test_replay_fast(self):
+        sleeps = []
+        reader = LogReader(self.path)
+        replay(reader, FakeSocket(), ('224.5.23.2', 10002), speed = 0,
+               sleep = sleeps.append)
+        reader.close()
+        self.assertEquals([], sleeps)
+
+if __name__ == '__main__':
+    sys.exit(main())